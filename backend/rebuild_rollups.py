@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+"""
+Backfill or rebuild the analytics_rollups collection from email_logs
+"""
+import argparse
+import asyncio
+
+from server import client, rebuild_rollups
+
+async def main(user_id=None):
+    """Rebuild rollups for one user, or for everyone"""
+    try:
+        target = f"user {user_id}" if user_id else "all users"
+        print(f"🔄 Rebuilding analytics rollups for {target}...")
+        written = await rebuild_rollups(user_id)
+        print(f"✅ Wrote {written} rollup documents")
+    except Exception as e:
+        print(f"❌ Error rebuilding rollups: {e}")
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--user-id", help="Only rebuild rollups for this user")
+    args = parser.parse_args()
+    asyncio.run(main(args.user_id))
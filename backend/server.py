@@ -1,21 +1,35 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, BackgroundTasks
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, BackgroundTasks, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo import DeleteOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, EmailStr, validator
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, EmailStr, ValidationError, model_validator, validator
+from typing import AsyncIterator, List, Optional, Dict, Any, Union
+from collections import OrderedDict, deque
+from email.message import EmailMessage
+from email.utils import formataddr, make_msgid
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from enum import Enum
 import asyncio
+import contextlib
+import heapq
+import random
 import hashlib
 import secrets
-# Email imports removed - not needed for current implementation
+import socket
+import time
+import aiosmtplib
 import json
+import re
+import base64
 
 
 ROOT_DIR = Path(__file__).parent
@@ -37,6 +51,7 @@ security = HTTPBearer()
 
 # Email Status Enum
 class EmailStatus(str, Enum):
+    SCHEDULED = "scheduled"
     QUEUED = "queued"
     PROCESSING = "processing"
     SENT = "sent"
@@ -64,6 +79,7 @@ class User(BaseModel):
     email_quota: int = 10000  # Monthly email quota
     emails_sent_this_month: int = 0
     plan_type: str = "free"  # free, pro, enterprise
+    preferred_providers: List[EmailProvider] = []  # Tried first, in order, while healthy
 
 class ApiKey(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -75,6 +91,9 @@ class ApiKey(BaseModel):
     last_used: Optional[datetime] = None
     is_active: bool = True
     permissions: List[str] = ["email:send", "email:read"]
+    # Optional per-key override of the plan's request rate limit
+    rate_limit_per_second: Optional[float] = None
+    rate_limit_burst: Optional[int] = None
 
 class EmailTemplate(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -95,6 +114,14 @@ class EmailAttachment(BaseModel):
     content: str  # Base64 encoded content
     size: int
 
+class AttachmentRef(BaseModel):
+    """Stored attachment; the bytes live in the attachment blob store under sha256"""
+    filename: str
+    content_type: str
+    size: int
+    sha256: Optional[str] = None
+    content: Optional[str] = None  # Inline base64 on documents written before the blob store
+
 class EmailRecipient(BaseModel):
     email: EmailStr
     name: Optional[str] = None
@@ -114,15 +141,22 @@ class EmailLog(BaseModel):
     subject: str
     html_content: Optional[str] = None
     text_content: Optional[str] = None
-    attachments: List[EmailAttachment] = []
+    attachments: List[AttachmentRef] = []
+    # Large bodies live once in email_bodies; html/text_content are then
+    # filled in on read. body_variables, when set, are rendered into it.
+    body_id: Optional[str] = None
+    body_variables: Optional[Dict[str, str]] = None
     
     # Tracking
     status: EmailStatus = EmailStatus.QUEUED
     provider: EmailProvider = EmailProvider.SMTP
     provider_message_id: Optional[str] = None
+    attempts: int = 0  # Failed delivery attempts so far
+    next_attempt_at: Optional[datetime] = None
     
     # Timestamps
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    scheduled_at: Optional[datetime] = None
     queued_at: Optional[datetime] = None
     sent_at: Optional[datetime] = None
     delivered_at: Optional[datetime] = None
@@ -141,14 +175,29 @@ class EmailLog(BaseModel):
     tags: List[str] = []
     metadata: Dict[str, Any] = {}
 
+class EmailLogSummary(BaseModel):
+    """Slim view of an EmailLog: identity, status and timestamps only"""
+    id: str
+    subject: str
+    status: EmailStatus
+    created_at: datetime
+    queued_at: Optional[datetime] = None
+    sent_at: Optional[datetime] = None
+    delivered_at: Optional[datetime] = None
+    opened_at: Optional[datetime] = None
+    clicked_at: Optional[datetime] = None
+    bounced_at: Optional[datetime] = None
+    failed_at: Optional[datetime] = None
+
 class EmailCampaign(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     user_id: str
     name: str
     template_id: Optional[str] = None
-    subject: str
+    subject: Optional[str] = None  # Overrides the template subject; may use {{variables}}
     from_email: EmailStr
     from_name: Optional[str] = None
+    tags: List[str] = []
     
     # Campaign Settings
     scheduled_at: Optional[datetime] = None
@@ -156,15 +205,30 @@ class EmailCampaign(BaseModel):
     
     # Status
     status: str = "draft"  # draft, scheduled, sending, sent, paused
+    status_reason: Optional[str] = None
     total_recipients: int = 0
+    emails_queued: int = 0
     emails_sent: int = 0
+    emails_failed: int = 0
     emails_delivered: int = 0
     emails_opened: int = 0
     emails_clicked: int = 0
     emails_bounced: int = 0
     
+    # Fan-out progress: recipients up to cursor_seq have been queued
+    cursor_seq: int = 0
+    runner: Optional[str] = None
+    runner_seen_at: Optional[datetime] = None
+    
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
+    started_at: Optional[datetime] = None
+    completed_at: Optional[datetime] = None
+
+class CampaignRecipient(BaseModel):
+    email: EmailStr
+    name: Optional[str] = None
+    variables: Dict[str, Any] = {}
 
 # API Request/Response Models
 class SendEmailRequest(BaseModel):
@@ -173,7 +237,7 @@ class SendEmailRequest(BaseModel):
     to: List[EmailRecipient]
     cc: List[EmailRecipient] = []
     bcc: List[EmailRecipient] = []
-    subject: str
+    subject: Optional[str] = None  # Taken from the template when template_id is set
     html_content: Optional[str] = None
     text_content: Optional[str] = None
     attachments: List[EmailAttachment] = []
@@ -183,6 +247,18 @@ class SendEmailRequest(BaseModel):
     metadata: Dict[str, Any] = {}
     send_immediately: bool = True
     scheduled_at: Optional[datetime] = None
+    
+    @model_validator(mode="after")
+    def check_subject(self):
+        if self.subject is None and self.template_id is None:
+            raise ValueError("subject is required unless template_id is given")
+        return self
+    
+    @model_validator(mode="after")
+    def check_schedule(self):
+        if not self.send_immediately and self.scheduled_at is None:
+            raise ValueError("scheduled_at is required when send_immediately is false")
+        return self
 
 class SendEmailResponse(BaseModel):
     id: str
@@ -190,152 +266,3113 @@ class SendEmailResponse(BaseModel):
     message: str
     created_at: datetime
 
-class StatusCheck(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    client_name: str
-    timestamp: datetime = Field(default_factory=datetime.utcnow)
+EMAIL_BATCH_MAX_SIZE = int(os.environ.get('EMAIL_BATCH_MAX_SIZE', '1000'))
+
+class BatchSendEmailRequest(BaseModel):
+    # Items are validated one by one so a bad item doesn't reject the whole batch
+    emails: List[Dict[str, Any]]
+
+class BatchSendEmailResult(BaseModel):
+    index: int
+    id: Optional[str] = None
+    status: Optional[EmailStatus] = None
+    error: Optional[str] = None
+
+class BatchSendEmailResponse(BaseModel):
+    accepted: int
+    rejected: int
+    results: List[BatchSendEmailResult]
+    created_at: datetime
+
+class CreateCampaignRequest(BaseModel):
+    name: str
+    template_id: str
+    subject: Optional[str] = None
+    from_email: EmailStr
+    from_name: Optional[str] = None
+    tags: List[str] = []
+
+CAMPAIGN_RECIPIENTS_MAX_PER_REQUEST = int(os.environ.get('CAMPAIGN_RECIPIENTS_MAX_PER_REQUEST', '10000'))
+
+class AddCampaignRecipientsRequest(BaseModel):
+    recipients: List[CampaignRecipient]
+
+class DeadLetter(BaseModel):
+    id: str  # The email's id
+    user_id: str
+    campaign_id: Optional[str] = None
+    reason: str  # permanent_error, retries_exhausted, processing_error
+    error: Optional[str] = None
+    attempts: int = 0
+    provider: Optional[EmailProvider] = None
+    dead_at: datetime = Field(default_factory=datetime.utcnow)
+
+DEAD_LETTER_REDRIVE_MAX = int(os.environ.get('DEAD_LETTER_REDRIVE_MAX', '10000'))
+
+class RedriveDeadLettersRequest(BaseModel):
+    email_ids: Optional[List[str]] = None  # Omit to re-drive the oldest dead letters
+    limit: int = Field(default=1000, ge=1, le=DEAD_LETTER_REDRIVE_MAX)
+
+class RedriveDeadLettersResponse(BaseModel):
+    redriven: int
+    email_ids: List[str]
+
+class StatusCheck(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    client_name: str
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
+
+class StatusCheckCreate(BaseModel):
+    client_name: str
+
+# Email Queue System (durable, backed by the email_queue collection)
+NODE_ID = os.environ.get('NODE_ID') or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+EMAIL_QUEUE_LEASE_SECONDS = float(os.environ.get('EMAIL_QUEUE_LEASE_SECONDS', '60'))
+EMAIL_QUEUE_POLL_INTERVAL = float(os.environ.get('EMAIL_QUEUE_POLL_INTERVAL', '0.5'))
+EMAIL_QUEUE_MAX_DELIVERIES = int(os.environ.get('EMAIL_QUEUE_MAX_DELIVERIES', '5'))
+EMAIL_QUEUE_LOCAL_PAYLOADS = int(os.environ.get('EMAIL_QUEUE_LOCAL_PAYLOADS', '10000'))
+EMAIL_QUEUE_SWEEP_INTERVAL_SECONDS = float(os.environ.get('EMAIL_QUEUE_SWEEP_INTERVAL_SECONDS', '300'))
+EMAIL_QUEUE_SWEEP_BATCH_SIZE = int(os.environ.get('EMAIL_QUEUE_SWEEP_BATCH_SIZE', '1000'))
+
+class MongoEmailQueue:
+    """Persistent work queue with visibility-timeout leases.
+    
+    A job is claimable once ``visible_at`` has passed. Claiming pushes
+    ``visible_at`` forward by the lease duration and stamps a lease token, so
+    a job whose owner crashed simply becomes visible again when the lease
+    expires and is reclaimed by whichever node polls next. Live leases are
+    kept alive by a per-node heartbeat.
+    
+    Jobs enqueued with a payload keep the validated ``EmailLog`` in a bounded
+    in-process map. When this node claims its own job on first delivery the
+    payload is handed straight to the worker; recovered jobs and jobs from
+    other nodes carry no payload and are read back from ``email_logs``.
+    
+    Emails are inserted before they are enqueued, so a crash in between
+    leaves a QUEUED email with no job. A sweep at startup and every
+    EMAIL_QUEUE_SWEEP_INTERVAL_SECONDS enqueues QUEUED emails older than a
+    lease that have none.
+    """
+    
+    def __init__(self, collection_name: str = "email_queue", lease_seconds: float = EMAIL_QUEUE_LEASE_SECONDS):
+        self.collection_name = collection_name
+        self.lease_seconds = lease_seconds
+        self._held: Dict[str, str] = {}  # job id -> lease token
+        self._payloads: "OrderedDict[str, EmailLog]" = OrderedDict()
+        self._wakeup = asyncio.Event()
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._sweep_task: Optional[asyncio.Task] = None
+        self.reclaimed = 0
+        self.requeued = 0
+    
+    @property
+    def collection(self):
+        return db[self.collection_name]
+    
+    async def enqueue(self, email_id: str, delay: float = 0, payload: Optional["EmailLog"] = None):
+        """Add an email id to the queue (idempotent per email id)"""
+        await self.enqueue_many([email_id], delay=delay, payloads=[payload] if payload else None)
+    
+    async def enqueue_many(self, email_ids: List[str], delay: float = 0, payloads: Optional[List["EmailLog"]] = None):
+        """Add several email ids in a single write"""
+        if not email_ids:
+            return
+        for payload in payloads or []:
+            self._payloads[payload.id] = payload
+        while len(self._payloads) > EMAIL_QUEUE_LOCAL_PAYLOADS:
+            self._payloads.popitem(last=False)
+        now = datetime.utcnow()
+        jobs = [{
+            "_id": email_id,
+            "email_id": email_id,
+            "enqueued_by": NODE_ID,
+            "enqueued_at": now,
+            "visible_at": now + timedelta(seconds=delay),
+            "lease_owner": None,
+            "lease_token": None,
+            "deliveries": 0,
+        } for email_id in email_ids]
+        try:
+            await self.collection.insert_many(jobs, ordered=False)
+        except BulkWriteError as e:
+            # Already-queued ids are fine, anything else is a real error
+            if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                raise
+        self._wakeup.set()
+    
+    async def claim(self) -> Optional[Dict[str, Any]]:
+        """Atomically lease the next visible job, or return None"""
+        now = datetime.utcnow()
+        token = uuid.uuid4().hex
+        lease = {
+            "visible_at": now + timedelta(seconds=self.lease_seconds),
+            "lease_owner": NODE_ID,
+            "lease_token": token,
+            "leased_at": now,
+        }
+        job = await self.collection.find_one_and_update(
+            {"visible_at": {"$lte": now}},
+            {"$set": lease, "$inc": {"deliveries": 1}},
+            sort=[("visible_at", 1)],
+            return_document=ReturnDocument.BEFORE,
+        )
+        if job is None:
+            return None
+        # Released jobs (retries) have no owner; a leftover owner means its lease expired
+        expired_owner = job.get("lease_owner")
+        job.update(lease, deliveries=job.get("deliveries", 0) + 1)
+        if expired_owner is not None:
+            self.reclaimed += 1
+            logging.info(f"Reclaimed expired lease for email {job['email_id']} (delivery {job['deliveries']})")
+        self._held[job["_id"]] = token
+        payload = self._payloads.pop(job["_id"], None)
+        if job["deliveries"] == 1 and job.get("enqueued_by") == NODE_ID:
+            job["payload"] = payload
+        return job
+    
+    async def wait_for_work(self, timeout: float = EMAIL_QUEUE_POLL_INTERVAL):
+        """Sleep until a local enqueue happens or the poll interval elapses"""
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+    
+    async def ack(self, job: Dict[str, Any]):
+        """Remove a finished job, provided we still hold its lease"""
+        await self.ack_many([job])
+    
+    async def ack_many(self, jobs: List[Dict[str, Any]]):
+        """Remove several finished jobs in a single write"""
+        if not jobs:
+            return
+        for job in jobs:
+            self._held.pop(job["_id"], None)
+        await self.collection.bulk_write([
+            DeleteOne({"_id": job["_id"], "lease_token": job["lease_token"]}) for job in jobs
+        ], ordered=False)
+    
+    async def release(self, job: Dict[str, Any], delay: float = 0):
+        """Give a job back so it becomes visible again after ``delay`` seconds"""
+        self._held.pop(job["_id"], None)
+        await self.collection.update_one(
+            {"_id": job["_id"], "lease_token": job["lease_token"]},
+            {"$set": {
+                "visible_at": datetime.utcnow() + timedelta(seconds=delay),
+                "lease_owner": None,
+                "lease_token": None,
+            }}
+        )
+    
+    async def release_many(self, releases: List[tuple]):
+        """Give back several (job, visible_at) pairs in a single write"""
+        if not releases:
+            return
+        for job, _ in releases:
+            self._held.pop(job["_id"], None)
+        await self.collection.bulk_write([
+            UpdateOne(
+                {"_id": job["_id"], "lease_token": job["lease_token"]},
+                {"$set": {"visible_at": visible_at, "lease_owner": None, "lease_token": None}}
+            )
+            for job, visible_at in releases
+        ], ordered=False)
+    
+    async def heartbeat(self):
+        """Extend every lease this node currently holds"""
+        if not self._held:
+            return
+        visible_at = datetime.utcnow() + timedelta(seconds=self.lease_seconds)
+        await self.collection.bulk_write([
+            UpdateOne({"_id": job_id, "lease_token": token}, {"$set": {"visible_at": visible_at}})
+            for job_id, token in list(self._held.items())
+        ], ordered=False)
+    
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                logging.error(f"Error extending email queue leases: {e}")
+    
+    async def requeue_stranded(self) -> int:
+        """Enqueue QUEUED emails older than a lease that have no job; returns how many"""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.lease_seconds)
+        cursor = db.email_logs.find(
+            {"status": EmailStatus.QUEUED, "created_at": {"$lt": cutoff}}, {"_id": 0, "id": 1}
+        ).batch_size(EMAIL_QUEUE_SWEEP_BATCH_SIZE)
+        requeued = 0
+        email_ids: List[str] = []
+        async for email_doc in cursor:
+            email_ids.append(email_doc["id"])
+            if len(email_ids) >= EMAIL_QUEUE_SWEEP_BATCH_SIZE:
+                requeued += await self._enqueue_missing(email_ids)
+                email_ids = []
+        requeued += await self._enqueue_missing(email_ids)
+        if requeued:
+            logging.warning(f"Re-enqueued {requeued} queued emails that had no queue job")
+        self.requeued += requeued
+        return requeued
+    
+    async def _enqueue_missing(self, email_ids: List[str]) -> int:
+        if not email_ids:
+            return 0
+        jobs = await self.collection.find({"_id": {"$in": email_ids}}, {"_id": 1}).to_list(len(email_ids))
+        queued = {job["_id"] for job in jobs}
+        missing = [email_id for email_id in email_ids if email_id not in queued]
+        await self.enqueue_many(missing)
+        return len(missing)
+    
+    async def _sweep_loop(self):
+        while True:
+            try:
+                await self.requeue_stranded()
+            except Exception as e:
+                logging.error(f"Error re-enqueueing stranded emails: {e}")
+            await asyncio.sleep(EMAIL_QUEUE_SWEEP_INTERVAL_SECONDS)
+    
+    def start(self):
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+        if self._sweep_task is None:
+            self._sweep_task = asyncio.create_task(self._sweep_loop())
+    
+    async def stop(self):
+        for task in (self._heartbeat_task, self._sweep_task):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._heartbeat_task = None
+        self._sweep_task = None
+    
+    async def size(self) -> int:
+        """Number of jobs waiting to be claimed"""
+        return await self.collection.count_documents({"visible_at": {"$lte": datetime.utcnow()}})
+    
+    async def get_stats(self) -> Dict[str, Any]:
+        now = datetime.utcnow()
+        return {
+            "node_id": NODE_ID,
+            "pending": await self.size(),
+            "leased": await self.collection.count_documents({"visible_at": {"$gt": now}, "lease_owner": {"$ne": None}}),
+            "held_by_this_node": len(self._held),
+            "local_payloads": len(self._payloads),
+            "reclaimed_by_this_node": self.reclaimed,
+            "requeued_by_this_node": self.requeued,
+        }
+
+email_queue = MongoEmailQueue()
+
+# Attachment Storage
+ATTACHMENT_BUCKET = os.environ.get('ATTACHMENT_BUCKET', 'attachments')
+ATTACHMENT_CHUNK_SIZE = int(os.environ.get('ATTACHMENT_CHUNK_SIZE', str(255 * 1024)))
+ATTACHMENT_KNOWN_HASHES = int(os.environ.get('ATTACHMENT_KNOWN_HASHES', '10000'))
+
+class AttachmentError(ValueError):
+    """Raised when an attachment's content can't be decoded"""
+
+class AttachmentStore:
+    """Content-addressed attachment storage in GridFS.
+    
+    Each distinct attachment body is stored once, as a GridFS file named by
+    the SHA-256 of its bytes; email logs keep only an AttachmentRef. Hashes
+    already seen are remembered in a bounded LRU so repeat attachments skip
+    the existence check entirely. Two nodes racing on a new hash may both
+    upload it, which only leaves an extra revision of identical bytes.
+    """
+    
+    def __init__(self, bucket_name: str = ATTACHMENT_BUCKET, chunk_size: int = ATTACHMENT_CHUNK_SIZE):
+        self.bucket_name = bucket_name
+        self.chunk_size = chunk_size
+        self._bucket: Optional[AsyncIOMotorGridFSBucket] = None
+        self._known: OrderedDict = OrderedDict()
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self.stats = {"stored": 0, "deduplicated": 0, "bytes_stored": 0, "bytes_deduplicated": 0, "streamed": 0}
+    
+    @property
+    def bucket(self) -> AsyncIOMotorGridFSBucket:
+        if self._bucket is None:
+            self._bucket = AsyncIOMotorGridFSBucket(db, bucket_name=self.bucket_name, chunk_size_bytes=self.chunk_size)
+        return self._bucket
+    
+    def _remember(self, digest: str):
+        self._known[digest] = True
+        self._known.move_to_end(digest)
+        while len(self._known) > ATTACHMENT_KNOWN_HASHES:
+            self._known.popitem(last=False)
+    
+    async def put(self, attachment: EmailAttachment) -> AttachmentRef:
+        """Store an attachment's bytes unless already present and return its reference"""
+        try:
+            data = base64.b64decode(attachment.content, validate=True)
+        except Exception:
+            raise AttachmentError(f"Attachment {attachment.filename!r} is not valid base64")
+        digest = hashlib.sha256(data).hexdigest()
+        ref = AttachmentRef(filename=attachment.filename, content_type=attachment.content_type, size=len(data), sha256=digest)
+        
+        if digest in self._known:
+            self._known.move_to_end(digest)
+            self.stats["deduplicated"] += 1
+            self.stats["bytes_deduplicated"] += len(data)
+            return ref
+        
+        lock = self._locks.setdefault(digest, asyncio.Lock())
+        try:
+            async with lock:
+                if digest in self._known:
+                    exists = True
+                else:
+                    exists = await db[f"{self.bucket_name}.files"].find_one({"filename": digest}, {"_id": 1}) is not None
+                    if not exists:
+                        await self.bucket.upload_from_stream(digest, data, metadata={"content_type": attachment.content_type})
+                    self._remember(digest)
+        finally:
+            if not lock.locked():
+                self._locks.pop(digest, None)
+        
+        if exists:
+            self.stats["deduplicated"] += 1
+            self.stats["bytes_deduplicated"] += len(data)
+        else:
+            self.stats["stored"] += 1
+            self.stats["bytes_stored"] += len(data)
+        return ref
+    
+    async def put_many(self, attachments: List[EmailAttachment]) -> List[AttachmentRef]:
+        return list(await asyncio.gather(*(self.put(attachment) for attachment in attachments)))
+    
+    async def stream(self, ref: AttachmentRef) -> AsyncIterator[bytes]:
+        """Yield an attachment's bytes chunk by chunk without loading the whole blob"""
+        if ref.sha256 is None:
+            yield base64.b64decode(ref.content or "")
+            return
+        self.stats["streamed"] += 1
+        grid_out = await self.bucket.open_download_stream_by_name(ref.sha256)
+        while True:
+            chunk = await grid_out.readchunk()
+            if not chunk:
+                break
+            yield chunk
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "known_hashes": len(self._known)}
+
+attachment_store = AttachmentStore()
+
+# SMTP Connection Pool
+SMTP_HOST = os.environ.get('SMTP_HOST')  # Unset: SMTP sends are simulated
+SMTP_PORT = int(os.environ.get('SMTP_PORT', '587'))
+SMTP_USERNAME = os.environ.get('SMTP_USERNAME')
+SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD')
+SMTP_USE_TLS = os.environ.get('SMTP_USE_TLS', 'false').lower() == 'true'  # Implicit TLS, usually port 465
+SMTP_START_TLS = {'true': True, 'false': False}.get(os.environ.get('SMTP_START_TLS', 'auto').lower())  # None: if offered
+SMTP_TIMEOUT_SECONDS = float(os.environ.get('SMTP_TIMEOUT_SECONDS', '30'))
+SMTP_POOL_SIZE = int(os.environ.get('SMTP_POOL_SIZE', '10'))
+SMTP_MAX_MESSAGES_PER_CONNECTION = int(os.environ.get('SMTP_MAX_MESSAGES_PER_CONNECTION', '100'))
+SMTP_HEALTH_CHECK_IDLE_SECONDS = float(os.environ.get('SMTP_HEALTH_CHECK_IDLE_SECONDS', '10'))
+SMTP_MAX_IDLE_SECONDS = float(os.environ.get('SMTP_MAX_IDLE_SECONDS', '120'))
+SMTP_DISPATCH_WINDOW_SECONDS = float(os.environ.get('SMTP_DISPATCH_WINDOW_SECONDS', '0.02'))
+SMTP_MAX_RECIPIENTS_PER_TRANSACTION = int(os.environ.get('SMTP_MAX_RECIPIENTS_PER_TRANSACTION', '100'))
+
+def parse_domain_relays(spec: str) -> Dict[str, tuple]:
+    """Parse SMTP_DOMAIN_RELAYS, e.g. ``example.com=mx.example.com:25,example.org=relay2:587``"""
+    relays = {}
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        domain, _, relay = entry.partition("=")
+        hostname, _, port = relay.strip().partition(":")
+        relays[domain.strip().lower()] = (hostname, int(port or SMTP_PORT))
+    return relays
+
+# Recipient domains delivered through a relay other than SMTP_HOST
+SMTP_DOMAIN_RELAYS = parse_domain_relays(os.environ.get('SMTP_DOMAIN_RELAYS', ''))
+
+def relay_for(address: str) -> tuple:
+    return SMTP_DOMAIN_RELAYS.get(address.rsplit("@", 1)[-1].lower(), (SMTP_HOST, SMTP_PORT))
+
+class TrackedSMTP(aiosmtplib.SMTP):
+    """aiosmtplib.SMTP that notes when a transaction reaches DATA, so a dropped
+    connection can tell whether the server may already have the message"""
+    
+    data_started = False
+    
+    async def data(self, *args, **kwargs):
+        self.data_started = True
+        return await super().data(*args, **kwargs)
+
+class PooledSmtpConnection:
+    __slots__ = ("smtp", "messages", "last_used")
+    
+    def __init__(self, smtp: TrackedSMTP):
+        self.smtp = smtp
+        self.messages = 0
+        self.last_used = time.monotonic()
+
+class SmtpConnectionPool:
+    """Persistent, authenticated connections to one SMTP relay.
+    
+    At most ``size`` connections are open at once. A connection goes back to
+    the pool after each message and is retired after
+    SMTP_MAX_MESSAGES_PER_CONNECTION messages, SMTP_MAX_IDLE_SECONDS idle or
+    any error. Connections idle longer than SMTP_HEALTH_CHECK_IDLE_SECONDS are
+    checked with NOOP before reuse, and a send that finds a pooled connection
+    dropped by the server before DATA is retried once on a fresh one (after
+    DATA the message may have been accepted, so it is never resent).
+    """
+    
+    def __init__(self, hostname: str, port: int, size: int = SMTP_POOL_SIZE,
+                 max_messages: int = SMTP_MAX_MESSAGES_PER_CONNECTION):
+        self.hostname = hostname
+        self.port = port
+        self.size = max(1, size)
+        self.max_messages = max(1, max_messages)
+        self._idle: deque = deque()
+        self._slots = asyncio.Semaphore(self.size)
+        self.stats = {"connections_opened": 0, "connections_closed": 0, "reused": 0,
+                      "messages": 0, "health_check_failures": 0, "reconnects": 0, "errors": 0}
+    
+    async def _connect(self) -> PooledSmtpConnection:
+        smtp = TrackedSMTP(
+            hostname=self.hostname,
+            port=self.port,
+            username=SMTP_USERNAME,
+            password=SMTP_PASSWORD,
+            use_tls=SMTP_USE_TLS,
+            start_tls=SMTP_START_TLS,
+            timeout=SMTP_TIMEOUT_SECONDS,
+        )
+        await smtp.connect()
+        self.stats["connections_opened"] += 1
+        return PooledSmtpConnection(smtp)
+    
+    async def _close(self, connection: PooledSmtpConnection):
+        self.stats["connections_closed"] += 1
+        try:
+            if connection.smtp.is_connected:
+                await asyncio.wait_for(connection.smtp.quit(), timeout=SMTP_TIMEOUT_SECONDS)
+        except Exception:
+            connection.smtp.close()
+    
+    async def _checkout(self) -> PooledSmtpConnection:
+        """An idle connection that still looks alive, or a new one"""
+        while self._idle:
+            connection = self._idle.pop()  # Most recently used first; the oldest age out
+            idle_for = time.monotonic() - connection.last_used
+            if not connection.smtp.is_connected or idle_for > SMTP_MAX_IDLE_SECONDS:
+                await self._close(connection)
+                continue
+            if idle_for > SMTP_HEALTH_CHECK_IDLE_SECONDS:
+                try:
+                    await connection.smtp.noop()
+                except Exception:
+                    self.stats["health_check_failures"] += 1
+                    await self._close(connection)
+                    continue
+            self.stats["reused"] += 1
+            return connection
+        return await self._connect()
+    
+    def _checkin(self, connection: PooledSmtpConnection) -> bool:
+        connection.last_used = time.monotonic()
+        if connection.messages < self.max_messages and connection.smtp.is_connected:
+            self._idle.append(connection)
+            return True
+        return False
+    
+    async def send(self, message: EmailMessage, sender: str, recipients: List[str]) -> Dict[str, Any]:
+        """Send one message; returns the replies to recipients the server refused (if only some were)"""
+        async with self._slots:
+            for attempt in range(2):
+                connection = await self._checkout()
+                reused = connection.messages > 0
+                connection.smtp.data_started = False
+                try:
+                    refused, _ = await connection.smtp.send_message(message, sender=sender, recipients=recipients)
+                except (aiosmtplib.SMTPServerDisconnected, ConnectionError) as e:
+                    await self._close(connection)
+                    if reused and attempt == 0 and not connection.smtp.data_started:
+                        # The server dropped a pooled connection; the message never went out
+                        self.stats["reconnects"] += 1
+                        continue
+                    self.stats["errors"] += 1
+                    raise e
+                except aiosmtplib.SMTPResponseException:
+                    # Rejected by the server: the connection itself is still good
+                    self.stats["errors"] += 1
+                    connection.messages += 1
+                    if not self._checkin(connection):
+                        await self._close(connection)
+                    raise
+                except Exception:
+                    self.stats["errors"] += 1
+                    await self._close(connection)
+                    raise
+                connection.messages += 1
+                self.stats["messages"] += 1
+                if not self._checkin(connection):
+                    await self._close(connection)
+                return {str(address): response for address, response in refused.items()}
+    
+    async def close(self):
+        while self._idle:
+            await self._close(self._idle.pop())
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "relay": f"{self.hostname}:{self.port}",
+            "idle": len(self._idle),
+            "in_use": self.size - self._slots._value,
+        }
+
+class SmtpPools:
+    """One SmtpConnectionPool per relay (host, port), created on first use"""
+    
+    def __init__(self):
+        self._pools: Dict[tuple, SmtpConnectionPool] = {}
+    
+    def get(self, hostname: str = None, port: int = None) -> SmtpConnectionPool:
+        key = (hostname or SMTP_HOST, port or SMTP_PORT)
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = self._pools[key] = SmtpConnectionPool(*key)
+        return pool
+    
+    async def close(self):
+        await asyncio.gather(*(pool.close() for pool in self._pools.values()), return_exceptions=True)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": SMTP_HOST is not None,
+            "relays": [pool.get_stats() for pool in self._pools.values()],
+            "dispatch": smtp_dispatcher.get_stats(),
+        }
+
+smtp_pools = SmtpPools()
+
+async def encode_attachment(attachment: AttachmentRef) -> str:
+    """Base64 body of an attachment, encoded chunk by chunk as it streams in
+    from storage so the raw bytes are never held in full"""
+    lines: List[str] = []
+    pending = b""
+    async for chunk in attachment_store.stream(attachment):
+        pending += chunk
+        whole = len(pending) - len(pending) % 57  # 57 bytes make one 76-character line
+        lines.append(base64.encodebytes(pending[:whole]).decode("ascii"))
+        pending = pending[whole:]
+    lines.append(base64.encodebytes(pending).decode("ascii"))
+    return "".join(lines)
+
+async def build_mime_message(email_log: EmailLog) -> EmailMessage:
+    """RFC 5322 message for an email log; bcc recipients are left out of the headers.
+    
+    aiosmtplib sends DATA in one piece, so the encoded message is held in
+    memory for the transaction (once per coalesced group); attachments are
+    encoded straight from the attachment store's chunk stream.
+    """
+    message = EmailMessage()
+    message["From"] = formataddr((email_log.from_name or "", email_log.from_email))
+    for header, kind in (("To", "to"), ("Cc", "cc")):
+        addresses = [formataddr((r.name or "", r.email)) for r in email_log.recipients if r.type == kind]
+        if addresses:
+            message[header] = ", ".join(addresses)
+    message["Subject"] = email_log.subject
+    message["Message-ID"] = make_msgid(domain=email_log.from_email.rsplit("@", 1)[-1])
+    
+    if email_log.text_content is not None:
+        message.set_content(email_log.text_content)
+        if email_log.html_content is not None:
+            message.add_alternative(email_log.html_content, subtype="html")
+    else:
+        message.set_content(email_log.html_content or "", subtype="html")
+    
+    for attachment in email_log.attachments:
+        part = EmailMessage()
+        part["Content-Type"] = attachment.content_type or "application/octet-stream"
+        part["Content-Transfer-Encoding"] = "base64"
+        part.add_header("Content-Disposition", "attachment", filename=attachment.filename)
+        part.set_payload(await encode_attachment(attachment))
+        if message.get_content_subtype() != "mixed":
+            message.make_mixed()
+        message.attach(part)
+    return message
+
+class SmtpDeliveryError(Exception):
+    """Recipients of a message were refused or could not be reached.
+    
+    ``codes`` maps each of those recipients to the relay's reply code, or to
+    None when its relay couldn't be reached. Only 5xx replies are permanent;
+    a 4xx (greylisting, a full mailbox) or an unreachable relay is worth
+    retrying.
+    """
+    
+    def __init__(self, message: str, codes: Dict[str, Optional[int]]):
+        super().__init__(message)
+        self.codes = codes
+    
+    @property
+    def permanent(self) -> bool:
+        return all(code is not None and code >= 500 for code in self.codes.values())
+
+class SmtpTransactionGroup:
+    __slots__ = ("email_logs", "futures", "recipients")
+    
+    def __init__(self):
+        self.email_logs: List[EmailLog] = []
+        self.futures: List[asyncio.Future] = []
+        self.recipients = 0
+
+class SmtpDispatcher:
+    """Coalesces identical messages into shared multi-RCPT SMTP transactions.
+    
+    Messages whose visible content and headers are identical (bcc recipients
+    may differ) that arrive within SMTP_DISPATCH_WINDOW_SECONDS of each other
+    are sent as one message. Their recipients are grouped by relay
+    (SMTP_DOMAIN_RELAYS, else SMTP_HOST), so each relay gets one transaction
+    with an RCPT TO per recipient over a pooled connection, split into
+    several once it passes SMTP_MAX_RECIPIENTS_PER_TRANSACTION.
+    
+    An email succeeds once every recipient is accepted or permanently (5xx)
+    refused. A 4xx reply or an unreachable relay for any of its recipients
+    fails it with a retryable SmtpDeliveryError, so the whole email is sent
+    again later.
+    
+    Every recipient gets the same bytes, so the To and Cc headers are part of
+    the content: only messages addressed identically coalesce (bcc fan-out,
+    or the same message sent to the same visible recipients more than once).
+    Bulk mail with a distinct To per message is sent one transaction each.
+    """
+    
+    def __init__(self, window: float = SMTP_DISPATCH_WINDOW_SECONDS,
+                 max_recipients: int = SMTP_MAX_RECIPIENTS_PER_TRANSACTION):
+        self.window = window
+        self.max_recipients = max(1, max_recipients)
+        self._open: Dict[str, SmtpTransactionGroup] = {}
+        self._dispatching: set = set()
+        self.stats = {"messages": 0, "transactions": 0, "recipients": 0, "coalesced": 0}
+    
+    @staticmethod
+    def content_key(email_log: EmailLog) -> str:
+        visible = [
+            email_log.from_email, email_log.from_name, email_log.subject,
+            [(r.email, r.name, r.type) for r in email_log.recipients if r.type != "bcc"],
+            email_log.html_content, email_log.text_content,
+            [(a.filename, a.content_type, a.sha256 or a.content) for a in email_log.attachments],
+        ]
+        return hashlib.sha256(json.dumps(visible, default=str).encode()).hexdigest()
+    
+    async def send(self, email_log: EmailLog) -> Dict[str, Any]:
+        """Send an email, possibly together with identical ones, and return its own outcome"""
+        key = self.content_key(email_log)
+        group = self._open.get(key)
+        count = len(email_log.recipients)
+        if group is None or group.recipients + count > self.max_recipients:
+            group = self._open[key] = SmtpTransactionGroup()
+            asyncio.get_running_loop().call_later(self.window, self._close, key, group)
+        future = asyncio.get_running_loop().create_future()
+        group.email_logs.append(email_log)
+        group.futures.append(future)
+        group.recipients += count
+        if group.recipients >= self.max_recipients:
+            self._close(key, group)
+        return await future
+    
+    def _close(self, key: str, group: SmtpTransactionGroup):
+        if self._open.get(key) is group:
+            del self._open[key]
+            task = asyncio.create_task(self._dispatch(group))
+            self._dispatching.add(task)
+            task.add_done_callback(self._dispatching.discard)
+    
+    async def stop(self):
+        """Send the groups still waiting out their window and wait for every dispatch"""
+        for key, group in list(self._open.items()):
+            self._close(key, group)
+        if self._dispatching:
+            await asyncio.gather(*self._dispatching, return_exceptions=True)
+    
+    async def _dispatch(self, group: SmtpTransactionGroup):
+        try:
+            message = await build_mime_message(group.email_logs[0])
+            by_relay: Dict[tuple, Dict[str, None]] = {}
+            for email_log in group.email_logs:
+                for recipient in email_log.recipients:
+                    by_relay.setdefault(relay_for(recipient.email), {})[recipient.email] = None
+            
+            transactions = []
+            for relay, addresses in by_relay.items():
+                addresses = list(addresses)
+                for start in range(0, len(addresses), self.max_recipients):
+                    transactions.append((relay, addresses[start:start + self.max_recipients]))
+            outcomes = await asyncio.gather(*(
+                smtp_pools.get(*relay).send(message, sender=group.email_logs[0].from_email, recipients=addresses)
+                for relay, addresses in transactions
+            ), return_exceptions=True)
+            
+            # Refusals are per recipient, with the reply code deciding whether
+            # they are final; anything else (transport errors, timeouts) leaves
+            # that transaction's recipients undelivered
+            refused: Dict[str, tuple] = {}
+            undelivered: Dict[str, Exception] = {}
+            for (relay, addresses), outcome in zip(transactions, outcomes):
+                if isinstance(outcome, aiosmtplib.SMTPRecipientsRefused):
+                    refused.update((error.recipient, (error.code, error.message)) for error in outcome.recipients)
+                elif isinstance(outcome, aiosmtplib.SMTPResponseException):
+                    refused.update((address, (outcome.code, outcome.message)) for address in addresses)
+                elif isinstance(outcome, BaseException):
+                    undelivered.update((address, outcome) for address in addresses)
+                else:
+                    refused.update((address, (response.code, response.message)) for address, response in outcome.items())
+            
+            self.stats["messages"] += len(group.email_logs)
+            self.stats["transactions"] += len(transactions)
+            self.stats["recipients"] += sum(len(addresses) for addresses in by_relay.values())
+            self.stats["coalesced"] += len(group.email_logs) - 1
+            for email_log, future in zip(group.email_logs, group.futures):
+                addresses = {recipient.email for recipient in email_log.recipients}
+                failures: Dict[str, tuple] = {}  # address -> (reply code or None, reason)
+                for address in addresses:
+                    if address in refused:
+                        failures[address] = refused[address]
+                    elif address in undelivered:
+                        failures[address] = (None, str(undelivered[address]))
+                codes = {address: code for address, (code, _) in failures.items()}
+                reasons = {address: reason for address, (_, reason) in failures.items()}
+                if all(address in undelivered for address in addresses):
+                    # Nothing went out: surface the transport error so it fails over
+                    future.set_exception(undelivered[next(iter(addresses))])
+                elif len(failures) == len(addresses):
+                    future.set_exception(SmtpDeliveryError(f"All recipients refused: {reasons}", codes))
+                elif any(code is None or code < 500 for code in codes.values()):
+                    future.set_exception(SmtpDeliveryError(f"Recipients not delivered: {reasons}", codes))
+                else:
+                    future.set_result({
+                        "message_id": message["Message-ID"],
+                        "provider": "smtp",
+                        "refused_recipients": reasons,
+                        "transaction_messages": len(group.email_logs),
+                    })
+        except Exception as e:
+            for future in group.futures:
+                if not future.done():
+                    future.set_exception(e)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "open_groups": len(self._open), "dispatching": len(self._dispatching)}
+
+smtp_dispatcher = SmtpDispatcher()
+
+# Provider Throttling
+PROVIDER_INITIAL_CONCURRENCY = float(os.environ.get('PROVIDER_INITIAL_CONCURRENCY', '8'))
+PROVIDER_MIN_CONCURRENCY = float(os.environ.get('PROVIDER_MIN_CONCURRENCY', '1'))
+PROVIDER_MAX_CONCURRENCY = float(os.environ.get('PROVIDER_MAX_CONCURRENCY', '64'))
+PROVIDER_LATENCY_TARGET_SECONDS = float(os.environ.get('PROVIDER_LATENCY_TARGET_SECONDS', '2'))
+PROVIDER_BACKOFF_FACTOR = float(os.environ.get('PROVIDER_BACKOFF_FACTOR', '0.5'))
+PROVIDER_BREAKER_FAILURES = int(os.environ.get('PROVIDER_BREAKER_FAILURES', '5'))
+PROVIDER_BREAKER_COOLDOWN_SECONDS = float(os.environ.get('PROVIDER_BREAKER_COOLDOWN_SECONDS', '30'))
+
+class ProviderUnavailableError(Exception):
+    """The provider's circuit breaker is open"""
+
+class BreakerState(str, Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+class ProviderGuard:
+    """Adaptive concurrency limit and circuit breaker for one provider.
+    
+    The concurrency window grows by about one slot per window's worth of fast
+    successful sends and is multiplied by PROVIDER_BACKOFF_FACTOR on an error
+    or a send slower than PROVIDER_LATENCY_TARGET_SECONDS (at most once per
+    target interval, so one burst of failures halves it once). After
+    PROVIDER_BREAKER_FAILURES consecutive errors the breaker opens and sends
+    fail fast; after the cooldown a single probe is let through and its
+    outcome closes or re-opens the breaker.
+    """
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.limit = PROVIDER_INITIAL_CONCURRENCY
+        self.in_flight = 0
+        self._slots = asyncio.Condition()
+        self._last_decrease = 0.0
+        self.state = BreakerState.CLOSED
+        self.consecutive_failures = 0
+        self._open_until = 0.0
+        self._probing = False
+        self.latency_ewma: Optional[float] = None
+        self.error_ewma = 0.0
+        self.stats = {"sent": 0, "failed": 0, "rejected": 0, "slow": 0, "breaker_trips": 0}
+    
+    def available(self) -> bool:
+        """Whether a send would currently get past the breaker"""
+        if self.state == BreakerState.OPEN:
+            return time.monotonic() >= self._open_until
+        return self.state == BreakerState.CLOSED or not self._probing
+    
+    def _admit_probe(self) -> bool:
+        """Raise unless the breaker lets a send through right now"""
+        if self.state == BreakerState.CLOSED:
+            return False
+        if self.state == BreakerState.OPEN and time.monotonic() >= self._open_until:
+            self.state = BreakerState.HALF_OPEN
+        if self.state == BreakerState.HALF_OPEN and not self._probing:
+            return True
+        self.stats["rejected"] += 1
+        raise ProviderUnavailableError(f"Provider {self.name} is unavailable (circuit {self.state.value})")
+    
+    async def acquire(self) -> bool:
+        """Take a concurrency slot; returns True if this send is the half-open probe"""
+        self._admit_probe()  # Fail fast instead of queueing behind an open breaker
+        async with self._slots:
+            await self._slots.wait_for(lambda: self.in_flight < max(1, int(self.limit)))
+            # The breaker may have opened while this send waited for a slot
+            probe = self._admit_probe()
+            self._probing = self._probing or probe
+            self.in_flight += 1
+        return probe
+    
+    async def release(self, latency: float, ok: bool, probe: bool):
+        """Return the slot and adapt the window and breaker to the outcome"""
+        now = time.monotonic()
+        self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+        self.error_ewma = 0.8 * self.error_ewma + 0.2 * (0.0 if ok else 1.0)
+        slow = latency > PROVIDER_LATENCY_TARGET_SECONDS
+        self.stats["slow"] += slow
+        if ok:
+            self.stats["sent"] += 1
+            self.consecutive_failures = 0
+            if probe or self.state == BreakerState.HALF_OPEN:
+                self.state = BreakerState.CLOSED
+        else:
+            self.stats["failed"] += 1
+            self.consecutive_failures += 1
+            if probe or self.consecutive_failures >= PROVIDER_BREAKER_FAILURES:
+                if self.state != BreakerState.OPEN:
+                    self.stats["breaker_trips"] += 1
+                self.state = BreakerState.OPEN
+                self._open_until = now + PROVIDER_BREAKER_COOLDOWN_SECONDS
+        if probe:
+            self._probing = False
+        
+        if ok and not slow:
+            self.limit = min(PROVIDER_MAX_CONCURRENCY, self.limit + 1 / max(1.0, self.limit))
+        elif now - self._last_decrease >= PROVIDER_LATENCY_TARGET_SECONDS:
+            self.limit = max(PROVIDER_MIN_CONCURRENCY, self.limit * PROVIDER_BACKOFF_FACTOR)
+            self._last_decrease = now
+        
+        async with self._slots:
+            self.in_flight -= 1
+            self._slots.notify_all()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "state": self.state.value,
+            "concurrency_limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "consecutive_failures": self.consecutive_failures,
+            "latency_ewma_ms": round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+            "error_ewma": round(self.error_ewma, 3),
+        }
+
+# Errors that reflect the message or its recipients rather than provider health;
+# whether they are final depends on the recipients' reply codes
+PROVIDER_MESSAGE_ERRORS = (SmtpDeliveryError, aiosmtplib.SMTPRecipientsRefused)
+
+def is_permanent_error(error: Exception) -> bool:
+    """Whether retrying the same message later can't succeed (only 5xx replies are final)"""
+    if isinstance(error, SmtpDeliveryError):
+        return error.permanent
+    if isinstance(error, aiosmtplib.SMTPRecipientsRefused):
+        return all(refusal.code >= 500 for refusal in error.recipients)
+    return isinstance(error, aiosmtplib.SMTPResponseException) and error.code >= 500
+
+# Provider Routing
+def parse_provider_weights(spec: str) -> Dict[EmailProvider, float]:
+    """Parse EMAIL_PROVIDERS, e.g. ``smtp=1,sendgrid=3``; listed providers are enabled"""
+    weights = {}
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, weight = entry.partition("=")
+        weights[EmailProvider(name.strip())] = float(weight or 1)
+    return weights
+
+EMAIL_PROVIDER_WEIGHTS = parse_provider_weights(os.environ.get('EMAIL_PROVIDERS', 'smtp=1'))
+EMAIL_ROUTE_MAX_ATTEMPTS = int(os.environ.get('EMAIL_ROUTE_MAX_ATTEMPTS', '3'))
+# Local stand-ins for load-testing routing offline, e.g.
+# "sendgrid:latency=0.05,error_rate=0.02;aws_ses:latency=0.2,jitter=0.1"
+FAKE_PROVIDERS = os.environ.get('FAKE_PROVIDERS', '')
+
+class FakeProviderError(Exception):
+    pass
+
+class FakeProvider:
+    """Offline provider with configurable latency, jitter and error rate"""
+    
+    def __init__(self, name: str, latency: float = 0.05, jitter: float = 0.0, error_rate: float = 0.0):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+    
+    @classmethod
+    def parse(cls, spec: str) -> Dict[EmailProvider, "FakeProvider"]:
+        fakes = {}
+        for entry in filter(None, (part.strip() for part in spec.split(";"))):
+            name, _, options = entry.partition(":")
+            settings = {key.strip(): float(value) for key, _, value in
+                        (option.partition("=") for option in options.split(",") if option.strip())}
+            fakes[EmailProvider(name.strip())] = cls(name.strip(), **settings)
+        return fakes
+    
+    async def send(self, email_log: EmailLog) -> Dict[str, Any]:
+        await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        if random.random() < self.error_rate:
+            raise FakeProviderError(f"Fake {self.name} failure")
+        return {"message_id": f"{self.name}_fake_{uuid.uuid4()}", "provider": self.name}
+
+class ProviderRouter:
+    """Orders the enabled providers to try for each email.
+    
+    The tenant's preferred_providers come first while they're healthy. The
+    rest are ordered by weighted random choice, each provider's configured
+    weight scaled by its live EWMA latency and error rate, so traffic leans
+    toward fast, reliable providers without abandoning the others (which is
+    how a recovered provider gets noticed). Providers whose breaker is open
+    go last.
+    """
+    
+    def __init__(self, weights: Dict[EmailProvider, float] = EMAIL_PROVIDER_WEIGHTS):
+        self.weights = weights
+        self.stats = {"routed": {}, "failovers": 0, "exhausted": 0}
+    
+    def score(self, provider: EmailProvider, guard: ProviderGuard, fallback_latency: float) -> float:
+        latency = guard.latency_ewma if guard.latency_ewma is not None else fallback_latency
+        return self.weights[provider] * (1.0 - guard.error_ewma) ** 2 / max(latency, 0.001) + 1e-6
+    
+    async def preferences(self, user_id: str) -> List[EmailProvider]:
+        preferred = provider_preference_cache.get(user_id)
+        if preferred is None:
+            user_doc = await db.users.find_one({"id": user_id}, {"_id": 0, "preferred_providers": 1})
+            preferred = [EmailProvider(provider) for provider in (user_doc or {}).get("preferred_providers", [])]
+            provider_preference_cache.set(user_id, preferred)
+        return preferred
+    
+    def route(self, guards: Dict[EmailProvider, ProviderGuard], preferred: List[EmailProvider]) -> List[EmailProvider]:
+        enabled = [provider for provider in self.weights if provider in guards]
+        healthy = [provider for provider in enabled if guards[provider].available()]
+        order = [provider for provider in dict.fromkeys(preferred) if provider in healthy]
+        
+        # Unmeasured providers are assumed as fast as the best measured one
+        measured = [guards[provider].latency_ewma for provider in healthy if guards[provider].latency_ewma is not None]
+        fallback_latency = min(measured) if measured else PROVIDER_LATENCY_TARGET_SECONDS / 2
+        remaining = {provider: self.score(provider, guards[provider], fallback_latency)
+                     for provider in healthy if provider not in order}
+        while remaining:
+            pick = random.uniform(0, sum(remaining.values()))
+            for provider, score in remaining.items():
+                pick -= score
+                if pick <= 0:
+                    break
+            order.append(provider)
+            del remaining[provider]
+        
+        order.extend(provider for provider in enabled if provider not in order)
+        return order[:max(1, EMAIL_ROUTE_MAX_ATTEMPTS)]
+    
+    def record(self, provider: EmailProvider, attempts: int):
+        """Count an email settled by ``provider`` on attempt number ``attempts``"""
+        self.stats["routed"][provider.value] = self.stats["routed"].get(provider.value, 0) + 1
+        self.stats["failovers"] += attempts - 1
+    
+    def record_exhausted(self, attempts: int):
+        self.stats["exhausted"] += 1
+        self.stats["failovers"] += max(0, attempts - 1)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "weights": {provider.value: weight for provider, weight in self.weights.items()},
+            "preference_cache": provider_preference_cache.get_stats(),
+        }
+
+# Email Service Integration
+class EmailService:
+    def __init__(self):
+        self.providers = {
+            EmailProvider.SMTP: self._send_via_smtp,
+            EmailProvider.SENDGRID: self._send_via_sendgrid,
+            EmailProvider.AWS_SES: self._send_via_aws_ses,
+        }
+        for provider, fake in FakeProvider.parse(FAKE_PROVIDERS).items():
+            self.providers[provider] = fake.send
+        self.guards = {provider: ProviderGuard(provider.value) for provider in self.providers}
+        self.router = ProviderRouter()
+    
+    def register(self, provider: EmailProvider, send: Any):
+        """Plug in a send coroutine function (e.g. a FakeProvider's) for a provider"""
+        self.providers[provider] = send
+        self.guards.setdefault(provider, ProviderGuard(provider.value))
+    
+    async def _send_with(self, provider: EmailProvider, email_log: EmailLog) -> Dict[str, Any]:
+        """Send through one provider, within its concurrency window"""
+        guard = self.guards[provider]
+        probe = await guard.acquire()
+        started = time.monotonic()
+        ok = False
+        try:
+            result = await self.providers[provider](email_log)
+            ok = True
+        except PROVIDER_MESSAGE_ERRORS:
+            ok = True  # The provider answered; the message itself was refused
+            raise
+        finally:
+            await guard.release(time.monotonic() - started, ok, probe)
+        return result
+    
+    async def send_email(self, email_log: EmailLog) -> Dict[str, Any]:
+        """Send email through the routed providers, failing over to the next on provider errors"""
+        try:
+            preferred = await self.router.preferences(email_log.user_id)
+        except Exception as e:
+            logging.error(f"Error loading provider preferences for user {email_log.user_id}: {e}")
+            return {"success": False, "provider": email_log.provider, "error": str(e), "retryable": True}
+        route = self.router.route(self.guards, preferred)
+        errors = []
+        for attempt, provider in enumerate(route, start=1):
+            try:
+                result = await self._send_with(provider, email_log)
+            except PROVIDER_MESSAGE_ERRORS as e:
+                # Another provider would be refused the same way; a temporary
+                # refusal (greylisting) is retried later instead
+                self.router.record(provider, attempt)
+                return {"success": False, "provider": provider, "error": str(e), "retryable": not is_permanent_error(e)}
+            except Exception as e:
+                errors.append(e)
+                continue
+            self.router.record(provider, attempt)
+            return {"success": True, "provider": provider, "provider_message_id": result.get("message_id"), "result": result}
+        self.router.record_exhausted(len(route))
+        return {
+            "success": False,
+            "provider": route[-1] if route else email_log.provider,
+            "error": "; ".join(f"{provider.value}: {e}" for provider, e in zip(route, errors)),
+            "retryable": not errors or not all(is_permanent_error(e) for e in errors),
+        }
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **{provider.value: guard.get_stats() for provider, guard in self.guards.items()},
+            "routing": self.router.get_stats(),
+        }
+    
+    async def _send_via_smtp(self, email_log: EmailLog) -> Dict[str, Any]:
+        """Send email via the pooled SMTP relay, or simulate it if SMTP_HOST is unset"""
+        if SMTP_HOST:
+            return await smtp_dispatcher.send(email_log)
+        
+        # Development: simulate email sending
+        for attachment in email_log.attachments:
+            async for _chunk in attachment_store.stream(attachment):
+                pass
+        await asyncio.sleep(0.1)  # Simulate network delay
+        message_id = f"smtp_{uuid.uuid4()}"
+        return {"message_id": message_id, "provider": "smtp"}
+    
+    async def _send_via_sendgrid(self, email_log: EmailLog) -> Dict[str, Any]:
+        """Send email via SendGrid"""
+        # Will be implemented when API key is provided
+        raise NotImplementedError("SendGrid integration requires API key")
+    
+    async def _send_via_aws_ses(self, email_log: EmailLog) -> Dict[str, Any]:
+        """Send email via AWS SES"""
+        # Will be implemented when credentials are provided
+        raise NotImplementedError("AWS SES integration requires credentials")
+
+email_service = EmailService()
+
+# Authentication Cache
+AUTH_CACHE_TTL_SECONDS = float(os.environ.get('AUTH_CACHE_TTL_SECONDS', '60'))
+AUTH_CACHE_MAX_ENTRIES = int(os.environ.get('AUTH_CACHE_MAX_ENTRIES', '10000'))
+
+class TTLCache:
+    """Bounded LRU cache whose entries expire ``ttl`` seconds after insertion"""
+    
+    def __init__(self, max_entries: int = AUTH_CACHE_MAX_ENTRIES, ttl: float = AUTH_CACHE_TTL_SECONDS):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def peek(self, key: str) -> Any:
+        """Return a live entry without touching LRU order or counters"""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+    
+    def get(self, key: str) -> Any:
+        value = self.peek(key)
+        if value is None:
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def set(self, key: str, value: Any):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def invalidate(self, key: str):
+        self._entries.pop(key, None)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0,
+        }
+
+# API keys are cached by key_hash, users by id. Entries are shared objects and
+# must be treated as read-only; other processes see changes within the TTL.
+api_key_cache = TTLCache()
+user_cache = TTLCache()
+# Provider routing looks up users' preferred_providers through its own cache
+# so it doesn't skew the auth cache's statistics
+provider_preference_cache = TTLCache()
+
+# API Key Usage Tracking
+API_KEY_LAST_USED_PRECISION = float(os.environ.get('API_KEY_LAST_USED_PRECISION', '60'))
+
+class LastUsedTracker:
+    """Write-behind aggregation of ApiKey.last_used.
+    
+    Requests only record the latest use time per key in memory. Every
+    ``precision`` seconds the dirty keys are written with one bulk_write using
+    ``$max``, so concurrent processes never move last_used backwards.
+    """
+    
+    def __init__(self, precision: float = API_KEY_LAST_USED_PRECISION):
+        self.precision = precision
+        self._latest: Dict[str, datetime] = {}
+        self._dirty: set = set()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"recorded": 0, "writes": 0, "flushes": 0}
+    
+    def record(self, key_id: str, used_at: Optional[datetime] = None):
+        self.stats["recorded"] += 1
+        self._latest[key_id] = used_at or datetime.utcnow()
+        self._dirty.add(key_id)
+    
+    def latest(self, key_id: str) -> Optional[datetime]:
+        """Most recent use seen by this process, flushed or not"""
+        return self._latest.get(key_id)
+    
+    async def flush(self):
+        dirty, self._dirty = self._dirty, set()
+        if not dirty:
+            return
+        try:
+            await db.api_keys.bulk_write([
+                UpdateOne({"id": key_id}, {"$max": {"last_used": self._latest[key_id]}}) for key_id in dirty
+            ], ordered=False)
+            self.stats["writes"] += len(dirty)
+            self.stats["flushes"] += 1
+        except Exception as e:
+            self._dirty |= dirty
+            logging.error(f"Error flushing API key last_used: {e}")
+        # Forget keys idle for a while; the database copy is authoritative for them
+        cutoff = datetime.utcnow() - timedelta(seconds=self.precision * 2)
+        for key_id in [k for k, used_at in self._latest.items() if used_at < cutoff and k not in self._dirty]:
+            del self._latest[key_id]
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.precision)
+            await self.flush()
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "pending": len(self._dirty), "precision_seconds": self.precision}
+
+last_used_tracker = LastUsedTracker()
+
+# Rate Limiting
+# Requests per second and burst size per plan; ApiKey fields override per key
+PLAN_RATE_LIMITS = {
+    "free": (5.0, 20),
+    "pro": (50.0, 200),
+    "enterprise": (200.0, 1000),
+}
+RATE_LIMIT_SHARED = os.environ.get('RATE_LIMIT_SHARED', 'false').lower() == 'true'
+RATE_LIMIT_SYNC_INTERVAL = float(os.environ.get('RATE_LIMIT_SYNC_INTERVAL', '1'))
+RATE_LIMIT_SHARED_WINDOW = int(os.environ.get('RATE_LIMIT_SHARED_WINDOW', '60'))
+
+class TokenBucket:
+    """Classic token bucket refilled lazily on access"""
+    __slots__ = ("rate", "capacity", "tokens", "updated", "unsynced", "window", "window_local", "others_seen")
+    
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        # Bookkeeping for cross-process sharing
+        self.unsynced = 0
+        self.window = 0
+        self.window_local = 0
+        self.others_seen = 0
+    
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def reset_after(self) -> float:
+        """Seconds until the next token is available"""
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+class RateLimiter:
+    """Per-API-key and per-user token buckets.
+    
+    ``check`` is O(1) and touches no database. When RATE_LIMIT_SHARED is set, a
+    background task adds each bucket's consumption to a per-window counter in
+    the ``rate_limits`` collection and drains the local bucket by what other
+    processes consumed, so the limits hold across processes.
+    """
+    
+    def __init__(self, shared: bool = RATE_LIMIT_SHARED, sync_interval: float = RATE_LIMIT_SYNC_INTERVAL):
+        self.shared = shared
+        self.sync_interval = sync_interval
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"allowed": 0, "limited": 0, "syncs": 0}
+    
+    def _bucket(self, key: str, rate: float, capacity: int) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None or bucket.rate != rate or bucket.capacity != capacity:
+            bucket = self._buckets[key] = TokenBucket(rate, capacity)
+        return bucket
+    
+    def check(self, api_key: ApiKey, user: User) -> tuple:
+        """Take one token from both buckets; returns (allowed, rate-limit headers)"""
+        plan_rate, plan_burst = PLAN_RATE_LIMITS.get(user.plan_type, PLAN_RATE_LIMITS["free"])
+        buckets = [
+            self._bucket(f"user:{user.id}", plan_rate, plan_burst),
+            self._bucket(
+                f"key:{api_key.id}",
+                api_key.rate_limit_per_second or plan_rate,
+                api_key.rate_limit_burst or plan_burst,
+            ),
+        ]
+        now = time.monotonic()
+        for bucket in buckets:
+            bucket.refill(now)
+        allowed = all(bucket.tokens >= 1 for bucket in buckets)
+        if allowed:
+            for bucket in buckets:
+                bucket.tokens -= 1
+                if self.shared:
+                    bucket.unsynced += 1
+            self.stats["allowed"] += 1
+        else:
+            self.stats["limited"] += 1
+        
+        # Report on whichever bucket is closest to empty
+        tightest = min(buckets, key=lambda bucket: bucket.tokens / bucket.capacity)
+        reset_after = tightest.reset_after()
+        headers = {
+            "X-RateLimit-Limit": str(tightest.capacity),
+            "X-RateLimit-Remaining": str(max(0, int(tightest.tokens))),
+            "X-RateLimit-Reset": str(int(time.time() + reset_after + 0.999)),
+        }
+        if not allowed:
+            headers["Retry-After"] = str(max(1, int(reset_after + 0.999)))
+        return allowed, headers
+    
+    async def sync(self):
+        """Exchange consumption with other processes through Mongo"""
+        window = int(time.time() // RATE_LIMIT_SHARED_WINDOW)
+        expires_at = datetime.utcnow() + timedelta(seconds=RATE_LIMIT_SHARED_WINDOW * 2)
+        for key, bucket in list(self._buckets.items()):
+            if bucket.window != window:
+                bucket.window, bucket.window_local, bucket.others_seen = window, 0, 0
+            if not bucket.unsynced:
+                continue
+            consumed, bucket.unsynced = bucket.unsynced, 0
+            bucket.window_local += consumed
+            doc = await db.rate_limits.find_one_and_update(
+                {"_id": f"{key}:{window}"},
+                {"$inc": {"count": consumed}, "$setOnInsert": {"expires_at": expires_at}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+            others = doc["count"] - bucket.window_local
+            bucket.tokens -= max(0, others - bucket.others_seen)
+            bucket.others_seen = others
+        self.stats["syncs"] += 1
+    
+    def prune(self):
+        """Drop buckets that have refilled completely and carry no state.
+        
+        In shared mode a bucket still holds the bookkeeping for the current
+        window (own hits already pushed, other processes' hits already
+        drained); dropping it would make the next sync count our own hits
+        as foreign traffic, so it is kept until the window rolls over.
+        """
+        now = time.monotonic()
+        window = int(time.time() // RATE_LIMIT_SHARED_WINDOW)
+        for key, bucket in list(self._buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens < bucket.capacity or bucket.unsynced:
+                continue
+            if self.shared and bucket.window == window and bucket.window_local:
+                continue
+            del self._buckets[key]
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                if self.shared:
+                    await self.sync()
+                self.prune()
+            except Exception as e:
+                logging.error(f"Error syncing rate limits: {e}")
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "shared": self.shared, "buckets": len(self._buckets)}
+
+rate_limiter = RateLimiter()
+
+# Authentication Helpers
+async def get_api_key(credentials: HTTPAuthorizationCredentials = Depends(security)) -> ApiKey:
+    """Validate API key from Authorization header"""
+    try:
+        token = credentials.credentials
+        if not token.startswith("ep_"):
+            raise HTTPException(status_code=401, detail="Invalid API key format")
+        
+        # Hash the token to compare with stored hash
+        key_hash = hashlib.sha256(token.encode()).hexdigest()
+        
+        api_key = api_key_cache.get(key_hash)
+        if api_key is None:
+            # Find API key in database
+            api_key_doc = await db.api_keys.find_one({"key_hash": key_hash, "is_active": True})
+            if not api_key_doc:
+                raise HTTPException(status_code=401, detail="Invalid or inactive API key")
+            api_key = ApiKey(**api_key_doc)
+            api_key_cache.set(key_hash, api_key)
+        
+        # Update last used timestamp (written behind in batches)
+        last_used_tracker.record(api_key.id)
+        
+        return api_key
+    except Exception as e:
+        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+
+async def get_user_from_api_key(response: Response, api_key: ApiKey = Depends(get_api_key)) -> User:
+    """Get user from API key, enforcing the key's and the user's rate limits"""
+    user = user_cache.get(api_key.user_id)
+    if user is None:
+        user_doc = await db.users.find_one({"id": api_key.user_id, "is_active": True})
+        if not user_doc:
+            raise HTTPException(status_code=404, detail="User not found")
+        user = User(**user_doc)
+        user_cache.set(user.id, user)
+    
+    allowed, headers = rate_limiter.check(api_key, user)
+    if not allowed:
+        raise HTTPException(status_code=429, detail="Rate limit exceeded", headers=headers)
+    response.headers.update(headers)
+    return user
+
+# Quota Management
+QUOTA_BLOCK_SIZE = int(os.environ.get('QUOTA_BLOCK_SIZE', '100'))
+QUOTA_BLOCK_IDLE_SECONDS = float(os.environ.get('QUOTA_BLOCK_IDLE_SECONDS', '300'))
+QUOTA_BLOCK_FRACTION = float(os.environ.get('QUOTA_BLOCK_FRACTION', '0.1'))
+
+class QuotaManager:
+    """Race-free monthly quota reservation.
+    
+    Quota is taken from ``users.emails_sent_this_month`` with a conditional
+    ``$inc`` that only matches while the result stays within ``email_quota``.
+    With ``block_size`` > 0 each process reserves quota in blocks and hands it
+    out locally, so most sends cost no write at all. A block is never more
+    than ``block_fraction`` of the quota the user had left at the previous
+    reservation, so one process can't starve the others near the limit.
+    Unused block quota is returned when a block sits idle and on shutdown.
+    """
+    
+    def __init__(self, block_size: int = QUOTA_BLOCK_SIZE, idle_seconds: float = QUOTA_BLOCK_IDLE_SECONDS,
+                 block_fraction: float = QUOTA_BLOCK_FRACTION):
+        self.block_size = max(0, block_size)
+        self.idle_seconds = idle_seconds
+        self.block_fraction = block_fraction
+        self._local: Dict[str, int] = {}  # user id -> reserved but unused quota
+        self._remaining: Dict[str, int] = {}  # user id -> quota left after our last reservation
+        self._last_used: Dict[str, float] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._lock_users: Dict[str, int] = {}  # user id -> tasks holding or waiting on its lock
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"local_grants": 0, "db_reservations": 0, "rejected": 0, "returned": 0}
+    
+    async def _reserve_from_db(self, user_id: str, count: int, partial: bool) -> int:
+        """Atomically add up to ``count`` to the user's counter, returning how much was reserved"""
+        while count > 0:
+            user_doc = await db.users.find_one_and_update(
+                {
+                    "id": user_id,
+                    "$expr": {"$lte": [{"$add": ["$emails_sent_this_month", count]}, "$email_quota"]},
+                },
+                {"$inc": {"emails_sent_this_month": count}},
+                projection={"_id": 0, "emails_sent_this_month": 1, "email_quota": 1},
+            )
+            if user_doc is not None:
+                self.stats["db_reservations"] += 1
+                self._remaining[user_id] = user_doc["email_quota"] - user_doc["emails_sent_this_month"] - count
+                return count
+            if not partial:
+                return 0
+            # Not enough left for everything; retry with whatever is left now
+            user_doc = await db.users.find_one(
+                {"id": user_id}, {"_id": 0, "emails_sent_this_month": 1, "email_quota": 1}
+            )
+            if user_doc is None:
+                return 0
+            available = user_doc["email_quota"] - user_doc["emails_sent_this_month"]
+            self._remaining[user_id] = max(0, available)
+            count = min(count - 1, available)
+        return 0
+    
+    @contextlib.asynccontextmanager
+    async def _user_lock(self, user_id: str):
+        """Serialize work on one user's block; the lock is dropped once nobody
+        holds or waits on it and the user has no block left"""
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        self._lock_users[user_id] = self._lock_users.get(user_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._lock_users[user_id] -= 1
+            if not self._lock_users[user_id]:
+                del self._lock_users[user_id]
+                if user_id not in self._local:
+                    self._locks.pop(user_id, None)
+    
+    async def reserve(self, user_id: str, count: int = 1, partial: bool = False) -> int:
+        """Reserve quota for ``count`` emails.
+        
+        Returns the number reserved: ``count`` or 0, or anything in between
+        when ``partial`` is true.
+        """
+        async with self._user_lock(user_id):
+            self._last_used[user_id] = time.monotonic()
+            local = self._local.get(user_id, 0)
+            if local >= count:
+                self._local[user_id] = local - count
+                self.stats["local_grants"] += 1
+                return count
+            
+            needed = count - local
+            if self.block_size:
+                # Top up the local block while we're paying for a write anyway,
+                # taking whatever still fits when the quota is nearly used up
+                block = min(self.block_size, int(self._remaining.get(user_id, 0) * self.block_fraction))
+                reserved = await self._reserve_from_db(user_id, max(needed, block), partial=True)
+            else:
+                reserved = await self._reserve_from_db(user_id, needed, partial=partial)
+            
+            available = local + reserved
+            granted = count if available >= count else (available if partial else 0)
+            self._local[user_id] = available - granted
+            if granted < count:
+                self.stats["rejected"] += 1
+            return granted
+    
+    async def release(self, user_id: str, count: int):
+        """Give back quota reserved for emails that were never accepted"""
+        if count <= 0:
+            return
+        if self.block_size:
+            self._local[user_id] = self._local.get(user_id, 0) + count
+        else:
+            await self._return_to_db(user_id, count)
+    
+    async def _return_to_db(self, user_id: str, count: int):
+        await db.users.update_one({"id": user_id}, {"$inc": {"emails_sent_this_month": -count}})
+        self.stats["returned"] += count
+    
+    async def release_idle(self, idle_seconds: Optional[float] = None):
+        """Return unused block quota for users that haven't sent recently"""
+        cutoff = time.monotonic() - (self.idle_seconds if idle_seconds is None else idle_seconds)
+        for user_id in [u for u, last in self._last_used.items() if last <= cutoff]:
+            async with self._user_lock(user_id):
+                if self._last_used.get(user_id, cutoff + 1) > cutoff:
+                    continue  # used again while we waited for the lock
+                unused = self._local.pop(user_id, 0)
+                self._last_used.pop(user_id, None)
+                self._remaining.pop(user_id, None)
+                if unused:
+                    await self._return_to_db(user_id, unused)
+    
+    def unused(self, user_id: str) -> int:
+        """Quota this process has reserved for a user but not handed out yet"""
+        return self._local.get(user_id, 0)
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.idle_seconds / 2)
+            try:
+                await self.release_idle()
+            except Exception as e:
+                logging.error(f"Error returning idle quota blocks: {e}")
+    
+    def start(self):
+        if self._task is None and self.block_size:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.release_idle(idle_seconds=-1)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "block_size": self.block_size,
+            "users_with_blocks": len(self._local),
+            "locally_held": sum(self._local.values()),
+        }
+
+quota_manager = QuotaManager()
+
+# Template Rendering
+TEMPLATE_CACHE_SIZE = int(os.environ.get('TEMPLATE_CACHE_SIZE', '1000'))
+TEMPLATE_CACHE_TTL_SECONDS = float(os.environ.get('TEMPLATE_CACHE_TTL_SECONDS', '30'))
+TEMPLATE_PLACEHOLDER = re.compile(r"\{\{\s*([A-Za-z_][\w.-]*)\s*\}\}")
+
+class TemplateRenderError(ValueError):
+    pass
+
+class CompiledTemplate:
+    """A template string parsed once into a ``str.format`` pattern.
+    
+    ``{{name}}`` placeholders become positional fields and literal braces are
+    escaped, so rendering is a single C-level ``format`` call. Values are
+    inserted as-is (no HTML escaping), matching how templates embed markup.
+    """
+    __slots__ = ("pattern", "names")
+    
+    def __init__(self, source: Optional[str]):
+        self.names: List[str] = []
+        if source is None:
+            self.pattern = None
+            return
+        positions: Dict[str, int] = {}
+        pieces = []
+        last = 0
+        for match in TEMPLATE_PLACEHOLDER.finditer(source):
+            pieces.append(source[last:match.start()].replace("{", "{{").replace("}", "}}"))
+            name = match.group(1)
+            if name not in positions:
+                positions[name] = len(self.names)
+                self.names.append(name)
+            pieces.append(f"{{{positions[name]}}}")
+            last = match.end()
+        pieces.append(source[last:].replace("{", "{{").replace("}", "}}"))
+        self.pattern = "".join(pieces)
+    
+    def render(self, variables: Dict[str, Any]) -> Optional[str]:
+        if self.pattern is None:
+            return None
+        return self.pattern.format(*[variables[name] for name in self.names])
+
+class CompiledEmailTemplate:
+    """Compiled subject, HTML and text parts of an EmailTemplate"""
+    
+    def __init__(self, template: EmailTemplate):
+        self.id = template.id
+        self.updated_at = template.updated_at
+        self.html_source = template.html_content
+        self.text_source = template.text_content
+        self.subject = CompiledTemplate(template.subject)
+        self.html_content = CompiledTemplate(template.html_content)
+        self.text_content = CompiledTemplate(template.text_content)
+        placeholders = self.subject.names + self.html_content.names + self.text_content.names
+        # Declared variables are required too, even if a part doesn't use them
+        self.required = set(placeholders) | set(template.variables)
+    
+    def render(self, variables: Dict[str, Any]) -> Dict[str, Optional[str]]:
+        """Render all parts, raising TemplateRenderError for missing variables"""
+        missing = self.required.difference(variables)
+        if missing:
+            raise TemplateRenderError(f"Missing template variables: {', '.join(sorted(missing))}")
+        values = {name: "" if value is None else str(value) for name, value in variables.items()}
+        return {
+            "subject": self.subject.render(values),
+            "html_content": self.html_content.render(values),
+            "text_content": self.text_content.render(values),
+        }
+    
+    def render_many(self, variable_sets: List[Dict[str, Any]]) -> List[Any]:
+        """Render once per variable set; failed items are returned as TemplateRenderError"""
+        results: List[Any] = []
+        for variables in variable_sets:
+            try:
+                results.append(self.render(variables))
+            except TemplateRenderError as e:
+                results.append(e)
+        return results
+
+class TemplateEngine:
+    """Loads templates through a short-lived cache and compiles each
+    (template id, updated_at) version exactly once; changes to a template
+    are picked up within TEMPLATE_CACHE_TTL_SECONDS"""
+    
+    def __init__(self, cache_size: int = TEMPLATE_CACHE_SIZE, ttl: float = TEMPLATE_CACHE_TTL_SECONDS):
+        self.cache_size = max(1, cache_size)
+        self._templates = TTLCache(max_entries=self.cache_size, ttl=ttl)
+        self._compiled: "OrderedDict[tuple, CompiledEmailTemplate]" = OrderedDict()
+        self.compilations = 0
+    
+    def compile(self, template: EmailTemplate) -> CompiledEmailTemplate:
+        key = (template.id, template.updated_at)
+        compiled = self._compiled.get(key)
+        if compiled is None:
+            compiled = self._compiled[key] = CompiledEmailTemplate(template)
+            self.compilations += 1
+            while len(self._compiled) > self.cache_size:
+                self._compiled.popitem(last=False)
+        else:
+            self._compiled.move_to_end(key)
+        return compiled
+    
+    async def get(self, user_id: str, template_id: str) -> Optional[CompiledEmailTemplate]:
+        """The user's active template, compiled, or None if there isn't one"""
+        cache_key = f"{user_id}:{template_id}"
+        template = self._templates.get(cache_key)
+        if template is None:
+            template_doc = await db.email_templates.find_one({"id": template_id, "user_id": user_id, "is_active": True})
+            if not template_doc:
+                return None
+            template = EmailTemplate(**template_doc)
+            self._templates.set(cache_key, template)
+        return self.compile(template)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "templates": self._templates.get_stats(),
+            "compiled": len(self._compiled),
+            "compilations": self.compilations,
+        }
+
+template_engine = TemplateEngine()
+
+# Shared Body Storage
+BODY_STORE_MIN_BYTES = int(os.environ.get('BODY_STORE_MIN_BYTES', '1024'))
+BODY_CACHE_SIZE = int(os.environ.get('BODY_CACHE_SIZE', '1000'))
+
+class BodyVariables(dict):
+    """Render values where a variable missing from an old email renders as empty"""
+    def __missing__(self, key):
+        return ""
+
+class BodyStore:
+    """Stores each distinct email body once in email_bodies, keyed by hash.
+    
+    Bodies of at least BODY_STORE_MIN_BYTES are moved out of email_logs. For
+    templated sends the unrendered template parts are stored and each email
+    keeps only the variables its body uses, so a campaign to 100k recipients
+    writes one body plus small per-message overrides. Other sends store the
+    final HTML/text, shared by every email with identical content. Bodies are
+    immutable, so they are cached (compiled) without expiry.
+    """
+    
+    def __init__(self, min_bytes: int = BODY_STORE_MIN_BYTES, cache_size: int = BODY_CACHE_SIZE):
+        self.min_bytes = min_bytes
+        self.cache_size = max(1, cache_size)
+        self._cache: "OrderedDict[str, tuple]" = OrderedDict()
+        self.stats = {"bodies_written": 0, "emails_shared": 0, "bytes_shared": 0, "cache_hits": 0, "cache_misses": 0}
+    
+    @staticmethod
+    def body_hash(html_content: Optional[str], text_content: Optional[str]) -> str:
+        return hashlib.sha256(json.dumps([html_content, text_content]).encode()).hexdigest()
+    
+    def _cache_body(self, body_id: str, html_content: Optional[str], text_content: Optional[str]) -> tuple:
+        body = (CompiledTemplate(html_content), CompiledTemplate(text_content), html_content, text_content)
+        self._cache[body_id] = body
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return body
+    
+    async def share(self, entries: List[tuple]):
+        """Move large bodies out of (EmailLog, CompiledEmailTemplate or None, variables) entries.
+        
+        A template is given only when the email's HTML and text both come from
+        it; its unrendered parts are then stored and ``variables`` rendered in.
+        Must run before the email logs are inserted.
+        """
+        new_bodies: Dict[str, tuple] = {}
+        for email_log, compiled, variables in entries:
+            if email_log.body_id is not None:
+                continue
+            if compiled is not None:
+                html_content, text_content = compiled.html_source, compiled.text_source
+            else:
+                html_content, text_content = email_log.html_content, email_log.text_content
+            size = len(html_content or "") + len(text_content or "")
+            if size < self.min_bytes:
+                continue
+            
+            body_id = self.body_hash(html_content, text_content)
+            if body_id in self._cache:
+                self._cache.move_to_end(body_id)
+            else:
+                new_bodies[body_id] = (html_content, text_content)
+            if compiled is not None:
+                values = {name: "" if variables.get(name) is None else str(variables[name])
+                          for name in compiled.html_content.names + compiled.text_content.names}
+                email_log.body_variables = values
+            email_log.body_id = body_id
+            email_log.html_content = None
+            email_log.text_content = None
+            self.stats["emails_shared"] += 1
+            self.stats["bytes_shared"] += size
+        
+        if new_bodies:
+            now = datetime.utcnow()
+            await db.email_bodies.bulk_write([
+                UpdateOne(
+                    {"_id": body_id},
+                    {"$setOnInsert": {"html_content": html_content, "text_content": text_content, "created_at": now}},
+                    upsert=True
+                )
+                for body_id, (html_content, text_content) in new_bodies.items()
+            ], ordered=False)
+            for body_id, (html_content, text_content) in new_bodies.items():
+                self._cache_body(body_id, html_content, text_content)
+            self.stats["bodies_written"] += len(new_bodies)
+    
+    async def _load(self, body_ids: set) -> Dict[str, tuple]:
+        bodies = {}
+        missing = []
+        for body_id in body_ids:
+            body = self._cache.get(body_id)
+            if body is None:
+                missing.append(body_id)
+            else:
+                self._cache.move_to_end(body_id)
+                bodies[body_id] = body
+        self.stats["cache_hits"] += len(bodies)
+        self.stats["cache_misses"] += len(missing)
+        if missing:
+            async for body_doc in db.email_bodies.find({"_id": {"$in": missing}}):
+                bodies[body_doc["_id"]] = self._cache_body(body_doc["_id"], body_doc.get("html_content"), body_doc.get("text_content"))
+        return bodies
+    
+    @staticmethod
+    def _render(body: tuple, variables: Optional[Dict[str, str]]) -> tuple:
+        compiled_html, compiled_text, html_content, text_content = body
+        if variables is None:
+            return html_content, text_content
+        values = BodyVariables(variables)
+        return compiled_html.render(values), compiled_text.render(values)
+    
+    async def hydrate_docs(self, email_docs: List[Dict[str, Any]]):
+        """Fill html_content/text_content in raw email_logs documents that reference a body"""
+        body_ids = {email_doc["body_id"] for email_doc in email_docs if email_doc.get("body_id")}
+        if not body_ids:
+            return
+        bodies = await self._load(body_ids)
+        for email_doc in email_docs:
+            body = bodies.get(email_doc.get("body_id"))
+            if body is not None:
+                email_doc["html_content"], email_doc["text_content"] = self._render(body, email_doc.get("body_variables"))
+    
+    async def hydrate(self, email_log: EmailLog):
+        if email_log.body_id is None or email_log.html_content is not None or email_log.text_content is not None:
+            return
+        body = (await self._load({email_log.body_id})).get(email_log.body_id)
+        if body is not None:
+            email_log.html_content, email_log.text_content = self._render(body, email_log.body_variables)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "cached_bodies": len(self._cache), "min_bytes": self.min_bytes}
+
+body_store = BodyStore()
+
+# Retries and Dead Letters
+RETRY_MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', '5'))
+RETRY_BASE_DELAY_SECONDS = float(os.environ.get('RETRY_BASE_DELAY_SECONDS', '30'))
+RETRY_MAX_DELAY_SECONDS = float(os.environ.get('RETRY_MAX_DELAY_SECONDS', '3600'))
+
+def retry_delay(attempts: int) -> float:
+    """Exponential backoff with jitter: between half and all of base * 2^(attempts-1), capped"""
+    ceiling = min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** (attempts - 1))
+    return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+# Fields that reset a dead-lettered email for another round of attempts
+REDRIVE_FIELDS = {
+    "status": EmailStatus.QUEUED,
+    "attempts": 0,
+    "next_attempt_at": None,
+    "failed_at": None,
+}
+
+class DeadLetterQueue:
+    """Emails that will not be retried again, kept in dead_letters for inspection and re-drive.
+    
+    Retries themselves need no separate store: a failed attempt releases the
+    email's queue job with ``visible_at`` set to the next attempt time, so the
+    queue doubles as a durable delay queue and no worker sits waiting.
+    """
+    
+    def __init__(self):
+        self.stats = {"retries_scheduled": 0, "dead_lettered": 0, "redriven": 0}
+    
+    async def add(self, email_log: EmailLog, reason: str, error: Optional[str], attempts: int,
+                  provider: Optional[EmailProvider] = None):
+        dead_letter = DeadLetter(
+            id=email_log.id,
+            user_id=email_log.user_id,
+            campaign_id=email_log.campaign_id,
+            reason=reason,
+            error=error,
+            attempts=attempts,
+            provider=provider,
+        )
+        await db.dead_letters.replace_one({"id": dead_letter.id}, dead_letter.dict(), upsert=True)
+        self.stats["dead_lettered"] += 1
+    
+    async def give_up(self, email_id: str, job: Dict[str, Any], error: str):
+        """Fail and dead-letter an email whose processing itself keeps erroring"""
+        # Only emails still waiting to be sent are failed; the status they
+        # had is what the rollups move them from
+        email_doc = await db.email_logs.find_one_and_update(
+            {"id": email_id, "status": {"$in": [EmailStatus.QUEUED, EmailStatus.PROCESSING]}},
+            {"$set": {
+                "status": EmailStatus.FAILED,
+                "failed_at": datetime.utcnow(),
+                "next_attempt_at": None,
+                "redrive_token": None,
+                "error_message": error
+            }},
+            projection={"_id": 0, "body_id": 0, "body_variables": 0, "html_content": 0, "text_content": 0},
+        )
+        if email_doc is None:
+            await email_queue.ack(job)
+            return
+        email_log = EmailLog(**email_doc)
+        rollup_writer.record_transition(email_log, email_log.status, EmailStatus.FAILED)
+        await self.add(email_log, "processing_error", error, email_log.attempts + 1)
+        if email_log.campaign_id:
+            campaign_engine.record_outcome(email_log.campaign_id, sent=False)
+        await email_queue.ack(job)
+    
+    async def redrive(self, user_id: str, email_ids: Optional[List[str]] = None, limit: int = 1000) -> List[str]:
+        """Queue a user's dead-lettered emails again with a fresh retry budget.
+        
+        The emails are marked with a redrive token and enqueued before they
+        are flipped from FAILED to QUEUED, so a crash in between can't leave
+        a QUEUED email without a queue job; a worker that gets to the job
+        first makes the flip itself, as it does for scheduled emails.
+        """
+        query: Dict[str, Any] = {"user_id": user_id}
+        if email_ids is not None:
+            query["id"] = {"$in": email_ids}
+        dead_letters = await db.dead_letters.find(query, {"_id": 0, "id": 1}).sort("dead_at", 1).limit(limit).to_list(limit)
+        ids = [dead_letter["id"] for dead_letter in dead_letters]
+        if not ids:
+            return []
+        
+        token = uuid.uuid4().hex
+        await db.email_logs.update_many(
+            {"id": {"$in": ids}, "user_id": user_id, "status": EmailStatus.FAILED},
+            {"$set": {"redrive_token": token}}
+        )
+        marked = await db.email_logs.find(
+            {"id": {"$in": ids}, "redrive_token": token, "status": EmailStatus.FAILED},
+            {"_id": 0, "id": 1},
+        ).to_list(len(ids))
+        redriven_ids = [email_doc["id"] for email_doc in marked]
+        if not redriven_ids:
+            return []
+        await email_queue.enqueue_many(redriven_ids)
+        await db.email_logs.update_many(
+            {"id": {"$in": redriven_ids}, "redrive_token": token, "status": EmailStatus.FAILED},
+            {"$set": {**REDRIVE_FIELDS, "queued_at": datetime.utcnow(), "release_token": token}}
+        )
+        flipped = await db.email_logs.find(
+            {"id": {"$in": redriven_ids}, "release_token": token},
+            {"_id": 0, "id": 1, "user_id": 1, "created_at": 1, "campaign_id": 1},
+        ).to_list(len(redriven_ids))
+        for email_doc in flipped:
+            rollup_writer.record_status_move(email_doc["user_id"], email_doc["created_at"], EmailStatus.FAILED, EmailStatus.QUEUED)
+            if email_doc.get("campaign_id"):
+                campaign_engine.record_redriven(email_doc["campaign_id"])
+        # Only the dead letters of emails that are going out again are cleared
+        await db.dead_letters.delete_many({"id": {"$in": redriven_ids}})
+        self.stats["redriven"] += len(redriven_ids)
+        return redriven_ids
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return dict(self.stats)
+
+dead_letter_queue = DeadLetterQueue()
+
+# Background Email Processing
+async def process_email(email_id: str, email_log: Optional[EmailLog] = None, job: Optional[Dict[str, Any]] = None) -> Optional[bool]:
+    """Send a single queued email and record the outcome.
+    
+    ``email_log`` is the payload carried through the queue on the local fast
+    path; without it the email is loaded from the database. The queue ``job``
+    is acknowledged by the status writer once the final status is persisted.
+    Emails that are no longer QUEUED (or PROCESSING after a crash) are skipped.
+    """
+    if email_log is None:
+        email_doc = await db.email_logs.find_one({"id": email_id}, {"_id": 0})
+        if not email_doc:
+            return None
+        email_log = EmailLog(**email_doc)
+        if email_log.status == EmailStatus.SCHEDULED:
+            # The scheduler enqueues before flipping to QUEUED; take the flip
+            # over so the move is counted once, by whoever makes it
+            flipped = await db.email_logs.update_one(
+                {"id": email_id, "status": EmailStatus.SCHEDULED},
+                {"$set": {"status": EmailStatus.QUEUED, "queued_at": datetime.utcnow()}}
+            )
+            if flipped.modified_count:
+                rollup_writer.record_transition(email_log, EmailStatus.SCHEDULED, EmailStatus.QUEUED)
+            email_log.status = EmailStatus.QUEUED
+        elif email_log.status == EmailStatus.FAILED and email_doc.get("redrive_token"):
+            # Likewise for a re-drive that hasn't flipped the email back yet;
+            # failed emails without the token are stale jobs and are skipped
+            flipped = await db.email_logs.update_one(
+                {"id": email_id, "status": EmailStatus.FAILED, "redrive_token": email_doc["redrive_token"]},
+                {"$set": {**REDRIVE_FIELDS, "queued_at": datetime.utcnow()}}
+            )
+            if flipped.modified_count:
+                rollup_writer.record_transition(email_log, EmailStatus.FAILED, EmailStatus.QUEUED)
+                if email_log.campaign_id:
+                    campaign_engine.record_redriven(email_log.campaign_id)
+            email_log.status = EmailStatus.QUEUED
+            email_log.attempts = 0
+        if email_log.status not in (EmailStatus.QUEUED, EmailStatus.PROCESSING):
+            return None
+    await body_store.hydrate(email_log)
+    
+    # Update status to processing
+    previous_status = email_log.status
+    status_writer.update(
+        email_id, {"status": EmailStatus.PROCESSING, "queued_at": datetime.utcnow()},
+        expected=[EmailStatus.QUEUED, EmailStatus.PROCESSING]
+    )
+    rollup_writer.record_transition(email_log, previous_status, EmailStatus.PROCESSING)
+    previous_status = EmailStatus.PROCESSING
+    
+    # Send email
+    result = await email_service.send_email(email_log)
+    
+    if result["success"]:
+        # Update status to sent
+        status_writer.update(email_id, {
+            "status": EmailStatus.SENT,
+            "sent_at": datetime.utcnow(),
+            "provider": result["provider"],
+            "provider_message_id": result.get("provider_message_id")
+        }, job=job, expected=[EmailStatus.PROCESSING])
+        rollup_writer.record_transition(email_log, previous_status, EmailStatus.SENT)
+        if email_log.campaign_id:
+            campaign_engine.record_outcome(email_log.campaign_id, sent=True)
+    else:
+        attempts = email_log.attempts + 1
+        if result.get("retryable") and attempts < RETRY_MAX_ATTEMPTS and job is not None:
+            # Back on the queue, invisible until the next attempt; no worker waits for it
+            next_attempt_at = datetime.utcnow() + timedelta(seconds=retry_delay(attempts))
+            status_writer.update(email_id, {
+                "status": EmailStatus.QUEUED,
+                "attempts": attempts,
+                "next_attempt_at": next_attempt_at,
+                "provider": result["provider"],
+                "error_message": result.get("error")
+            }, job=job, retry_at=next_attempt_at, expected=[EmailStatus.PROCESSING])
+            rollup_writer.record_transition(email_log, previous_status, EmailStatus.QUEUED)
+            dead_letter_queue.stats["retries_scheduled"] += 1
+            return False
+        
+        # Update status to failed
+        status_writer.update(email_id, {
+            "status": EmailStatus.FAILED,
+            "failed_at": datetime.utcnow(),
+            "attempts": attempts,
+            "next_attempt_at": None,
+            "redrive_token": None,
+            "provider": result["provider"],
+            "error_message": result.get("error")
+        }, job=job, expected=[EmailStatus.PROCESSING])
+        rollup_writer.record_transition(email_log, previous_status, EmailStatus.FAILED)
+        await dead_letter_queue.add(
+            email_log,
+            "retries_exhausted" if result.get("retryable") else "permanent_error",
+            result.get("error"),
+            attempts,
+            result["provider"],
+        )
+        if email_log.campaign_id:
+            campaign_engine.record_outcome(email_log.campaign_id, sent=False)
+    return result["success"]
+
+# Status Writer
+STATUS_WRITER_BATCH_SIZE = int(os.environ.get('STATUS_WRITER_BATCH_SIZE', '500'))
+STATUS_WRITER_FLUSH_INTERVAL = float(os.environ.get('STATUS_WRITER_FLUSH_INTERVAL', '0.25'))
+
+class StatusWriter:
+    """Buffers email_logs status transitions and flushes them with bulk_write.
+    
+    Updates for the same email that are still pending are merged into one
+    ``$set`` (so PROCESSING followed by SENT costs a single write). Each
+    update names the statuses it expects to move the email from; a merged
+    write keeps the earliest expectation, and a write whose email has moved
+    on meanwhile is skipped rather than clobbering it. A flush runs when the
+    buffer reaches ``batch_size`` or every ``flush_interval`` seconds. Queue jobs handed in with the final update are acknowledged only
+    after their status is persisted, so a crash before the flush leaves the
+    job to be reclaimed instead of losing the outcome. Jobs handed in with a
+    ``retry_at`` are likewise put back on the queue, invisible until then,
+    only once the retry state is written.
+    """
+    
+    def __init__(self, batch_size: int = STATUS_WRITER_BATCH_SIZE, flush_interval: float = STATUS_WRITER_FLUSH_INTERVAL):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._expected: Dict[str, List[EmailStatus]] = {}
+        self._jobs: List[Dict[str, Any]] = []
+        self._releases: List[tuple] = []
+        self._lock = asyncio.Lock()
+        self._flush_needed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"updates": 0, "coalesced": 0, "writes": 0, "flushes": 0, "errors": 0}
+    
+    def update(self, email_id: str, fields: Dict[str, Any], job: Optional[Dict[str, Any]] = None,
+               retry_at: Optional[datetime] = None, expected: Optional[List[EmailStatus]] = None):
+        """Queue a ``$set`` for an email, merging with any pending one.
+        
+        ``job`` is acknowledged after the write, or released until
+        ``retry_at`` if one is given. ``expected`` limits the write to emails
+        still in one of those statuses.
+        """
+        self.stats["updates"] += 1
+        pending = self._pending.get(email_id)
+        if pending is None:
+            self._pending[email_id] = dict(fields)
+            if expected:
+                self._expected[email_id] = list(expected)
+        else:
+            pending.update(fields)
+            self.stats["coalesced"] += 1
+        if job is not None and retry_at is not None:
+            self._releases.append((job, retry_at))
+        elif job is not None:
+            self._jobs.append(job)
+        if len(self._pending) >= self.batch_size:
+            self._flush_needed.set()
+    
+    async def flush(self):
+        """Write out everything buffered so far"""
+        async with self._lock:
+            pending, self._pending = self._pending, {}
+            expected, self._expected = self._expected, {}
+            jobs, self._jobs = self._jobs, []
+            releases, self._releases = self._releases, []
+            if not pending and not jobs and not releases:
+                return
+            try:
+                if pending:
+                    operations = []
+                    for email_id, fields in pending.items():
+                        query: Dict[str, Any] = {"id": email_id}
+                        if email_id in expected:
+                            query["status"] = {"$in": expected[email_id]}
+                        operations.append(UpdateOne(query, {"$set": fields}))
+                    await db.email_logs.bulk_write(operations, ordered=False)
+                    self.stats["writes"] += len(pending)
+                self.stats["flushes"] += 1
+            except Exception as e:
+                # Put the batch back underneath anything newer and retry next round
+                self.stats["errors"] += 1
+                logging.error(f"Error flushing email status updates: {e}")
+                for email_id, fields in pending.items():
+                    self._pending[email_id] = {**fields, **self._pending.get(email_id, {})}
+                    if email_id in expected:
+                        self._expected[email_id] = expected[email_id]
+                    else:
+                        self._expected.pop(email_id, None)
+                self._jobs = jobs + self._jobs
+                self._releases = releases + self._releases
+                return
+            # Statuses are persisted; a job whose ack/release fails goes back
+            # in the buffer so the next flush retries it
+            try:
+                await email_queue.ack_many(jobs)
+            except Exception as e:
+                self.stats["errors"] += 1
+                logging.error(f"Error acknowledging email queue jobs: {e}")
+                self._jobs = jobs + self._jobs
+            try:
+                await email_queue.release_many(releases)
+            except Exception as e:
+                self.stats["errors"] += 1
+                logging.error(f"Error releasing email queue jobs: {e}")
+                self._releases = releases + self._releases
+    
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Error in status writer: {e}")
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "pending": len(self._pending)}
+
+status_writer = StatusWriter()
+
+# Analytics Rollups
+ROLLUP_FLUSH_INTERVAL = float(os.environ.get('ROLLUP_FLUSH_INTERVAL', '1'))
+ROLLUP_GRANULARITIES = ("hour", "day")
+
+def naive_utc(moment: Optional[datetime]) -> Optional[datetime]:
+    """Convert a client-supplied datetime to the naive UTC form stored in Mongo"""
+    if moment is not None and moment.tzinfo is not None:
+        return moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+def bucket_start(moment: datetime, granularity: str) -> datetime:
+    """Start of the minute/hour/day bucket containing ``moment``"""
+    if granularity == "minute":
+        return moment.replace(second=0, microsecond=0)
+    if granularity == "hour":
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def bucket_expression(granularity: str) -> Dict[str, Any]:
+    """Aggregation expression truncating ``created_at`` to a minute/hour/day bucket"""
+    parts = {
+        "year": {"$year": "$created_at"},
+        "month": {"$month": "$created_at"},
+        "day": {"$dayOfMonth": "$created_at"},
+    }
+    if granularity in ("hour", "minute"):
+        parts["hour"] = {"$hour": "$created_at"}
+    if granularity == "minute":
+        parts["minute"] = {"$minute": "$created_at"}
+    return {"$dateFromParts": parts}
+
+def rollup_id(user_id: str, granularity: str, bucket: Optional[datetime]) -> str:
+    return f"{user_id}:{granularity}:{bucket.isoformat() if bucket else 'all'}"
+
+class RollupWriter:
+    """Incrementally maintained per-user analytics counters.
+    
+    ``analytics_rollups`` holds one document per user per hour and per day,
+    plus a ``total`` document, each counting emails by *current* status
+    (bucketed by the email's ``created_at``) along with opens and clicks.
+    Changes are accumulated as ``$inc`` deltas in memory and flushed with one
+    bulk_write every ROLLUP_FLUSH_INTERVAL seconds. Deltas not yet flushed
+    when a process dies are lost; ``rebuild_rollups`` recomputes from
+    ``email_logs``.
+    """
+    
+    def __init__(self, flush_interval: float = ROLLUP_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._deltas: Dict[str, Dict[str, int]] = {}
+        self._keys: Dict[str, tuple] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"events": 0, "writes": 0, "flushes": 0}
+    
+    def _add(self, user_id: str, created_at: datetime, deltas: Dict[str, int]):
+        self.stats["events"] += 1
+        buckets = [("total", None)] + [(g, bucket_start(created_at, g)) for g in ROLLUP_GRANULARITIES]
+        for granularity, bucket in buckets:
+            doc_id = rollup_id(user_id, granularity, bucket)
+            pending = self._deltas.setdefault(doc_id, {})
+            self._keys[doc_id] = (user_id, granularity, bucket)
+            for field, delta in deltas.items():
+                pending[field] = pending.get(field, 0) + delta
+    
+    def record_created(self, email_log: "EmailLog"):
+        self._add(email_log.user_id, email_log.created_at, {"total": 1, f"counts.{email_log.status.value}": 1})
+    
+    def record_transition(self, email_log: "EmailLog", old_status: EmailStatus, new_status: EmailStatus):
+        self.record_status_move(email_log.user_id, email_log.created_at, old_status, new_status)
+    
+    def record_status_move(self, user_id: str, created_at: datetime, old_status: EmailStatus, new_status: EmailStatus):
+        if old_status == new_status:
+            return
+        self._add(user_id, created_at, {
+            f"counts.{old_status.value}": -1,
+            f"counts.{new_status.value}": 1,
+        })
+    
+    async def flush(self):
+        deltas, self._deltas = self._deltas, {}
+        keys, self._keys = self._keys, {}
+        if not deltas:
+            return
+        operations = []
+        for doc_id, increments in deltas.items():
+            user_id, granularity, bucket = keys[doc_id]
+            operations.append(UpdateOne(
+                {"_id": doc_id},
+                {
+                    "$inc": {field: delta for field, delta in increments.items() if delta},
+                    "$setOnInsert": {"user_id": user_id, "granularity": granularity, "bucket": bucket},
+                },
+                upsert=True,
+            ))
+        try:
+            await db.analytics_rollups.bulk_write(operations, ordered=False)
+            self.stats["writes"] += len(operations)
+            self.stats["flushes"] += 1
+        except Exception as e:
+            logging.error(f"Error flushing analytics rollups: {e}")
+            # Merge back only the ops that weren't applied so no $inc counts
+            # twice; other errors are taken to mean nothing was written
+            doc_ids = list(deltas)
+            if isinstance(e, BulkWriteError):
+                failed = [doc_ids[error["index"]] for error in e.details.get("writeErrors", [])]
+                self.stats["writes"] += len(operations) - len(failed)
+            else:
+                failed = doc_ids
+            for doc_id in failed:
+                increments = deltas[doc_id]
+                pending = self._deltas.setdefault(doc_id, {})
+                self._keys[doc_id] = keys[doc_id]
+                for field, delta in increments.items():
+                    pending[field] = pending.get(field, 0) + delta
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "pending": len(self._deltas)}
+
+rollup_writer = RollupWriter()
 
-class StatusCheckCreate(BaseModel):
-    client_name: str
+async def rebuild_rollups(user_id: Optional[str] = None) -> int:
+    """Recompute analytics_rollups from email_logs for one user or everyone.
+    
+    Intended for backfills and repairs; events recorded while it runs may be
+    counted twice, so run it when traffic for the affected users is quiet.
+    """
+    match = {"user_id": user_id} if user_id else {}
+    granularity_buckets = {g: bucket_expression(g) for g in ROLLUP_GRANULARITIES}
+    granularity_buckets["total"] = None
+    docs: Dict[str, Dict[str, Any]] = {}
+    for granularity, bucket_expr in granularity_buckets.items():
+        pipeline = [
+            {"$match": match},
+            {"$group": {
+                "_id": {"user_id": "$user_id", "bucket": bucket_expr, "status": "$status"},
+                "count": {"$sum": 1},
+                "opens": {"$sum": "$open_count"},
+                "clicks": {"$sum": "$click_count"},
+            }},
+        ]
+        async for row in db.email_logs.aggregate(pipeline, allowDiskUse=True):
+            key = row["_id"]
+            doc_id = rollup_id(key["user_id"], granularity, key["bucket"])
+            doc = docs.setdefault(doc_id, {
+                "_id": doc_id,
+                "user_id": key["user_id"],
+                "granularity": granularity,
+                "bucket": key["bucket"],
+                "total": 0,
+                "counts": {email_status.value: 0 for email_status in EmailStatus},
+                "opens": 0,
+                "clicks": 0,
+            })
+            doc["total"] += row["count"]
+            doc["counts"][key["status"]] = doc["counts"].get(key["status"], 0) + row["count"]
+            doc["opens"] += row["opens"]
+            doc["clicks"] += row["clicks"]
+    
+    await db.analytics_rollups.delete_many(match)
+    if docs:
+        await db.analytics_rollups.insert_many(list(docs.values()), ordered=False)
+    return len(docs)
 
-# Email Queue System (Simple in-memory queue for now, can be replaced with Redis later)
-email_queue = asyncio.Queue()
-processing_emails = {}
+async def rollup_status_counts(
+    user_id: str,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None
+) -> Optional[Dict[str, int]]:
+    """Status counts from rollups, or None when the range isn't bucket-aligned"""
+    if start_date is None and end_date is None:
+        query: Dict[str, Any] = {"_id": rollup_id(user_id, "total", None)}
+    else:
+        granularity = next((
+            g for g in reversed(ROLLUP_GRANULARITIES)
+            if all(d is None or bucket_start(d, g) == d for d in (start_date, end_date))
+        ), None)
+        if granularity is None:
+            return None
+        query = {"user_id": user_id, "granularity": granularity, "bucket": {}}
+        if start_date:
+            query["bucket"]["$gte"] = start_date
+        if end_date:
+            query["bucket"]["$lt"] = end_date
+    counts = {email_status.value: 0 for email_status in EmailStatus}
+    async for doc in db.analytics_rollups.find(query, {"counts": 1}):
+        for status_value, count in doc.get("counts", {}).items():
+            counts[status_value] = counts.get(status_value, 0) + count
+    return counts
 
-# Email Service Integration
-class EmailService:
-    def __init__(self):
-        self.providers = {
-            EmailProvider.SMTP: self._send_via_smtp,
-            EmailProvider.SENDGRID: self._send_via_sendgrid,
-            EmailProvider.AWS_SES: self._send_via_aws_ses,
+# Email Worker Pool
+EMAIL_WORKER_COUNT = int(os.environ.get('EMAIL_WORKER_COUNT', '8'))
+EMAIL_DRAIN_TIMEOUT = float(os.environ.get('EMAIL_DRAIN_TIMEOUT', '30'))
+
+class EmailWorkerPool:
+    """Pool of workers draining the email queue concurrently.
+    
+    Each worker leases and handles one email at a time, so the worker count
+    (EMAIL_WORKER_COUNT) is the bound on emails off the queue but unfinished.
+    """
+    
+    def __init__(self, worker_count: int = EMAIL_WORKER_COUNT):
+        self.worker_count = max(1, worker_count)
+        self._workers: List[asyncio.Task] = []
+        self._stopping = False
+        self._in_flight = 0
+        self.worker_stats: Dict[int, Dict[str, Any]] = {}
+    
+    async def start(self):
+        """Spawn the worker tasks"""
+        self._stopping = False
+        for worker_id in range(self.worker_count):
+            self.worker_stats[worker_id] = {
+                "worker_id": worker_id,
+                "busy": False,
+                "current_email_id": None,
+                "processed": 0,
+                "sent": 0,
+                "failed": 0,
+                "errors": 0,
+                "total_send_seconds": 0.0,
+                "last_activity": None,
+            }
+            self._workers.append(asyncio.create_task(self._run_worker(worker_id)))
+        logging.info(f"Started email worker pool with {self.worker_count} workers")
+    
+    async def stop(self, timeout: float = EMAIL_DRAIN_TIMEOUT):
+        """Stop taking new emails and wait for in-flight ones to finish"""
+        self._stopping = True
+        if not self._workers:
+            return
+        done, pending = await asyncio.wait(self._workers, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logging.warning(f"Email worker pool drain timed out, cancelled {len(pending)} workers")
+            await asyncio.gather(*pending, return_exceptions=True)
+        self._workers = []
+    
+    async def _run_worker(self, worker_id: int):
+        stats = self.worker_stats[worker_id]
+        while not self._stopping:
+            # Lease the next job; idle workers wait for a local wakeup or the poll interval
+            try:
+                job = await email_queue.claim()
+            except Exception as e:
+                logging.error(f"Worker {worker_id} failed to claim from email queue: {e}")
+                job = None
+            if job is None:
+                await email_queue.wait_for_work()
+                continue
+            
+            email_id = job["email_id"]
+            self._in_flight += 1
+            stats["busy"] = True
+            stats["current_email_id"] = email_id
+            started = datetime.utcnow()
+            try:
+                sent = await process_email(email_id, job.get("payload"), job)
+                if sent is None:
+                    await email_queue.ack(job)
+                else:
+                    stats["processed"] += 1
+                    stats["sent" if sent else "failed"] += 1
+            except Exception as e:
+                stats["errors"] += 1
+                logging.error(f"Worker {worker_id} error processing email {email_id}: {e}")
+                try:
+                    if job["deliveries"] >= EMAIL_QUEUE_MAX_DELIVERIES:
+                        logging.error(f"Giving up on email {email_id} after {job['deliveries']} deliveries")
+                        await dead_letter_queue.give_up(email_id, job, str(e))
+                    else:
+                        await email_queue.release(job, delay=EMAIL_QUEUE_POLL_INTERVAL * job["deliveries"])
+                except Exception as e:
+                    # Mongo is likely unavailable; the lease expires and the
+                    # job is reclaimed, so back off instead of dying
+                    logging.error(f"Worker {worker_id} failed to hand back email {email_id}: {e}")
+                    await asyncio.sleep(EMAIL_QUEUE_POLL_INTERVAL)
+            finally:
+                self._in_flight -= 1
+                stats["busy"] = False
+                stats["current_email_id"] = None
+                stats["last_activity"] = datetime.utcnow()
+                stats["total_send_seconds"] += (stats["last_activity"] - started).total_seconds()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Pool-wide and per-worker statistics"""
+        workers = []
+        for stats in self.worker_stats.values():
+            worker = dict(stats)
+            handled = stats["processed"] + stats["errors"]
+            worker["avg_seconds_per_email"] = round(stats["total_send_seconds"] / handled, 4) if handled else 0
+            del worker["total_send_seconds"]
+            workers.append(worker)
+        return {
+            "worker_count": self.worker_count,
+            "in_flight": self._in_flight,
+            "stopping": self._stopping,
+            "workers": workers,
         }
+
+email_worker_pool = EmailWorkerPool()
+
+# Campaign Engine
+CAMPAIGN_CHUNK_SIZE = int(os.environ.get('CAMPAIGN_CHUNK_SIZE', '500'))
+CAMPAIGN_LEASE_SECONDS = float(os.environ.get('CAMPAIGN_LEASE_SECONDS', '60'))
+CAMPAIGN_MAINTENANCE_INTERVAL = float(os.environ.get('CAMPAIGN_MAINTENANCE_INTERVAL', '1'))
+
+class CampaignEngine:
+    """Fans EmailCampaigns out to their recipients.
     
-    async def send_email(self, email_log: EmailLog) -> Dict[str, Any]:
-        """Send email using the specified provider"""
+    Recipients live in ``campaign_recipients`` with a per-campaign ``seq``.
+    A running campaign is owned by one node (``runner`` plus a heartbeat in
+    ``runner_seen_at``) which streams recipients in CAMPAIGN_CHUNK_SIZE
+    chunks after ``cursor_seq``: each chunk is rendered with one render_many
+    call, quota is reserved once, emails are written with one insert_many and
+    enqueued together, and the cursor and counters move with one update.
+    Email ids are derived from (campaign, seq), so re-running a chunk after a
+    crash never creates or sends duplicates. Send outcomes are aggregated in
+    memory and added to the campaign counters once per maintenance tick.
+    """
+    
+    def __init__(self, chunk_size: int = CAMPAIGN_CHUNK_SIZE, lease_seconds: float = CAMPAIGN_LEASE_SECONDS):
+        self.chunk_size = max(1, chunk_size)
+        self.lease_seconds = lease_seconds
+        self._running: Dict[str, asyncio.Task] = {}
+        self._counters: Dict[str, Dict[str, int]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"chunks": 0, "queued": 0, "render_failures": 0, "recovered": 0}
+    
+    def record_outcome(self, campaign_id: str, sent: bool):
+        counters = self._counters.setdefault(campaign_id, {})
+        field = "emails_sent" if sent else "emails_failed"
+        counters[field] = counters.get(field, 0) + 1
+    
+    def record_redriven(self, campaign_id: str):
+        """A failed campaign email was queued again; its outcome will be recorded anew"""
+        counters = self._counters.setdefault(campaign_id, {})
+        counters["emails_failed"] = counters.get("emails_failed", 0) - 1
+    
+    async def flush_counters(self):
+        counters, self._counters = self._counters, {}
+        if not counters:
+            return
         try:
-            provider = email_log.provider
-            if provider not in self.providers:
-                raise ValueError(f"Unsupported email provider: {provider}")
-            
-            result = await self.providers[provider](email_log)
-            return {"success": True, "provider_message_id": result.get("message_id"), "result": result}
+            await db.email_campaigns.bulk_write([
+                UpdateOne({"id": campaign_id}, {"$inc": increments}) for campaign_id, increments in counters.items()
+            ], ordered=False)
         except Exception as e:
-            return {"success": False, "error": str(e)}
+            logging.error(f"Error flushing campaign counters: {e}")
+            for campaign_id, increments in counters.items():
+                pending = self._counters.setdefault(campaign_id, {})
+                for field, delta in increments.items():
+                    pending[field] = pending.get(field, 0) + delta
     
-    async def _send_via_smtp(self, email_log: EmailLog) -> Dict[str, Any]:
-        """Send email via SMTP (for development/testing)"""
-        # For now, simulate email sending
-        await asyncio.sleep(0.1)  # Simulate network delay
-        message_id = f"smtp_{uuid.uuid4()}"
-        return {"message_id": message_id, "provider": "smtp"}
+    async def launch(self, campaign_id: str) -> bool:
+        """Take ownership of a sending campaign that has no live runner and start fanning out"""
+        now = datetime.utcnow()
+        campaign_doc = await db.email_campaigns.find_one_and_update(
+            {
+                "id": campaign_id,
+                "status": "sending",
+                "$or": [
+                    {"runner": None},
+                    {"runner_seen_at": {"$lt": now - timedelta(seconds=self.lease_seconds)}},
+                ],
+            },
+            {"$set": {"runner": NODE_ID, "runner_seen_at": now}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if campaign_doc is None or campaign_id in self._running:
+            return False
+        self._running[campaign_id] = asyncio.create_task(self._run(campaign_id))
+        return True
     
-    async def _send_via_sendgrid(self, email_log: EmailLog) -> Dict[str, Any]:
-        """Send email via SendGrid"""
-        # Will be implemented when API key is provided
-        raise NotImplementedError("SendGrid integration requires API key")
+    async def _run(self, campaign_id: str):
+        try:
+            while True:
+                campaign_doc = await db.email_campaigns.find_one({"id": campaign_id})
+                if not campaign_doc or campaign_doc["status"] != "sending" or campaign_doc.get("runner") != NODE_ID:
+                    return  # paused, finished or taken over elsewhere
+                campaign = EmailCampaign(**campaign_doc)
+                
+                compiled = await template_engine.get(campaign.user_id, campaign.template_id) if campaign.template_id else None
+                if compiled is None:
+                    await self._stop_running(campaign_id, "paused", "Template not found")
+                    return
+                
+                recipients = await db.campaign_recipients.find(
+                    {"campaign_id": campaign_id, "seq": {"$gt": campaign.cursor_seq}}
+                ).sort("seq", 1).limit(self.chunk_size).to_list(self.chunk_size)
+                if not recipients:
+                    await self._stop_running(campaign_id, "sent")
+                    return
+                
+                if not await self._send_chunk(campaign, compiled, recipients):
+                    await self._stop_running(campaign_id, "paused", "Email quota exceeded")
+                    return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Error running campaign {campaign_id}: {e}")
+            await db.email_campaigns.update_one({"id": campaign_id, "runner": NODE_ID}, {"$set": {"runner": None}})
+        finally:
+            self._running.pop(campaign_id, None)
     
-    async def _send_via_aws_ses(self, email_log: EmailLog) -> Dict[str, Any]:
-        """Send email via AWS SES"""
-        # Will be implemented when credentials are provided
-        raise NotImplementedError("AWS SES integration requires credentials")
-
-email_service = EmailService()
-
-# Authentication Helpers
-async def get_api_key(credentials: HTTPAuthorizationCredentials = Depends(security)) -> ApiKey:
-    """Validate API key from Authorization header"""
-    try:
-        token = credentials.credentials
-        if not token.startswith("ep_"):
-            raise HTTPException(status_code=401, detail="Invalid API key format")
+    async def _send_chunk(self, campaign: EmailCampaign, compiled: CompiledEmailTemplate, recipients: List[Dict[str, Any]]) -> bool:
+        """Queue one chunk; returns False if quota ran out part way"""
+        variable_sets = [
+            {"email": recipient["email"], "name": recipient.get("name") or "", **recipient.get("variables", {})}
+            for recipient in recipients
+        ]
+        outputs = compiled.render_many(variable_sets)
+        subject_override = CompiledTemplate(campaign.subject) if campaign.subject else None
         
-        # Hash the token to compare with stored hash
-        key_hash = hashlib.sha256(token.encode()).hexdigest()
+        renderable = sum(1 for output in outputs if not isinstance(output, TemplateRenderError))
+        granted = await quota_manager.reserve(campaign.user_id, renderable, partial=True) if renderable else 0
+        
+        email_logs: List[EmailLog] = []
+        rendered_variables: List[Dict[str, Any]] = []
+        render_failures = 0
+        last_seq = campaign.cursor_seq
+        for recipient, variables, output in zip(recipients, variable_sets, outputs):
+            if isinstance(output, TemplateRenderError):
+                render_failures += 1
+                last_seq = recipient["seq"]
+                continue
+            if len(email_logs) >= granted:
+                break
+            if subject_override is not None:
+                try:
+                    output["subject"] = subject_override.render(variables)
+                except KeyError:
+                    pass  # keep the template subject if the override uses unknown variables
+            email_logs.append(EmailLog(
+                id=str(uuid.uuid5(uuid.NAMESPACE_URL, f"campaign:{campaign.id}:{recipient['seq']}")),
+                user_id=campaign.user_id,
+                campaign_id=campaign.id,
+                template_id=campaign.template_id,
+                from_email=campaign.from_email,
+                from_name=campaign.from_name,
+                recipients=[EmailRecipient(email=recipient["email"], name=recipient.get("name"))],
+                subject=output["subject"] or "",
+                html_content=output["html_content"],
+                text_content=output["text_content"],
+                tags=campaign.tags,
+            ))
+            rendered_variables.append(variables)
+            last_seq = recipient["seq"]
         
-        # Find API key in database
-        api_key_doc = await db.api_keys.find_one({"key_hash": key_hash, "is_active": True})
-        if not api_key_doc:
-            raise HTTPException(status_code=401, detail="Invalid or inactive API key")
+        inserted = email_logs
+        recovered: List[str] = []
+        if email_logs:
+            await body_store.share([
+                (email_log, compiled, variables) for email_log, variables in zip(email_logs, rendered_variables)
+            ])
+            try:
+                await db.email_logs.insert_many([email_log.dict() for email_log in email_logs], ordered=False)
+            except BulkWriteError as e:
+                # Emails from a chunk that was already written before a crash
+                write_errors = e.details.get("writeErrors", [])
+                if any(err.get("code") != 11000 for err in write_errors):
+                    await quota_manager.release(campaign.user_id, granted)
+                    raise
+                duplicates = {err["index"] for err in write_errors}
+                inserted = [email_log for index, email_log in enumerate(email_logs) if index not in duplicates]
+                # A crash may have come before they were enqueued; enqueueing is
+                # idempotent, so queue every one of them still waiting to send
+                still_queued = await db.email_logs.find(
+                    {"id": {"$in": [email_logs[index].id for index in duplicates]}, "status": EmailStatus.QUEUED},
+                    {"_id": 0, "id": 1},
+                ).to_list(len(duplicates))
+                recovered = [email_doc["id"] for email_doc in still_queued]
+            await email_queue.enqueue_many([email_log.id for email_log in inserted], payloads=inserted)
+            await email_queue.enqueue_many(recovered)
+            for email_log in inserted:
+                rollup_writer.record_created(email_log)
+        await quota_manager.release(campaign.user_id, granted - len(inserted))
         
-        # Update last used timestamp
-        await db.api_keys.update_one(
-            {"id": api_key_doc["id"]}, 
-            {"$set": {"last_used": datetime.utcnow()}}
+        now = datetime.utcnow()
+        await db.email_campaigns.update_one(
+            {"id": campaign.id, "runner": NODE_ID},
+            {
+                "$set": {"cursor_seq": last_seq, "runner_seen_at": now, "updated_at": now},
+                "$inc": {"emails_queued": len(inserted) + len(recovered), "emails_failed": render_failures},
+            }
         )
+        self.stats["chunks"] += 1
+        self.stats["queued"] += len(inserted)
+        self.stats["render_failures"] += render_failures
+        return granted >= renderable
+    
+    async def _stop_running(self, campaign_id: str, status: str, reason: Optional[str] = None):
+        now = datetime.utcnow()
+        fields = {"status": status, "status_reason": reason, "runner": None, "updated_at": now}
+        if status == "sent":
+            fields["completed_at"] = now
+        await db.email_campaigns.update_one({"id": campaign_id, "runner": NODE_ID}, {"$set": fields})
+    
+    async def recover(self):
+        """Pick up sending campaigns whose runner stopped heartbeating"""
+        stale = datetime.utcnow() - timedelta(seconds=self.lease_seconds)
+        orphans = db.email_campaigns.find(
+            {"status": "sending", "$or": [{"runner": None}, {"runner_seen_at": {"$lt": stale}}]},
+            {"id": 1}
+        )
+        async for campaign_doc in orphans:
+            if await self.launch(campaign_doc["id"]):
+                self.stats["recovered"] += 1
+                logging.info(f"Resumed orphaned campaign {campaign_doc['id']}")
+    
+    async def _maintain(self):
+        ticks = 0
+        while True:
+            await asyncio.sleep(CAMPAIGN_MAINTENANCE_INTERVAL)
+            ticks += 1
+            try:
+                await self.flush_counters()
+                if self._running:
+                    await db.email_campaigns.update_many(
+                        {"id": {"$in": list(self._running)}, "runner": NODE_ID},
+                        {"$set": {"runner_seen_at": datetime.utcnow()}}
+                    )
+                if ticks * CAMPAIGN_MAINTENANCE_INTERVAL >= self.lease_seconds / 2:
+                    ticks = 0
+                    await self.recover()
+            except Exception as e:
+                logging.error(f"Error in campaign maintenance: {e}")
+    
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._maintain())
+        await self.recover()
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        running = list(self._running.items())
+        for _, task in running:
+            task.cancel()
+        await asyncio.gather(*[task for _, task in running], return_exceptions=True)
+        if running:
+            # Hand the campaigns back so another node resumes them right away
+            await db.email_campaigns.update_many(
+                {"id": {"$in": [campaign_id for campaign_id, _ in running]}, "runner": NODE_ID},
+                {"$set": {"runner": None}}
+            )
+        await self.flush_counters()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "running": list(self._running)}
+
+campaign_engine = CampaignEngine()
+
+# Email Scheduler
+SCHEDULER_WINDOW_SECONDS = float(os.environ.get('SCHEDULER_WINDOW_SECONDS', '60'))
+SCHEDULER_MAX_WINDOW_ITEMS = int(os.environ.get('SCHEDULER_MAX_WINDOW_ITEMS', '10000'))
+SCHEDULER_BATCH_SIZE = int(os.environ.get('SCHEDULER_BATCH_SIZE', '500'))
+
+class EmailScheduler:
+    """Releases SCHEDULED emails to the send queue when they fall due.
+    
+    Only the near-term window (the next SCHEDULER_WINDOW_SECONDS) is held in
+    an in-memory heap, loaded with an indexed range query on
+    (status, scheduled_at) and refreshed every half window, so the state is
+    simply reloaded from Mongo after a restart. The loop sleeps until the
+    earliest due time, then releases due emails in batches. Several nodes may
+    hold the same window: enqueueing is idempotent per email id, and each
+    release flips SCHEDULED to QUEUED under a unique token so only the node
+    whose token stuck counts the move.
+    """
+    
+    def __init__(self, window_seconds: float = SCHEDULER_WINDOW_SECONDS, batch_size: int = SCHEDULER_BATCH_SIZE):
+        self.window_seconds = window_seconds
+        self.batch_size = max(1, batch_size)
+        self._heap: List[tuple] = []
+        self._in_heap: set = set()
+        self._horizon = datetime.min
+        self._next_load = 0.0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"loaded": 0, "released": 0, "lost_races": 0}
+    
+    def add(self, email_id: str, due: datetime):
+        """Track a newly scheduled email if it falls inside the loaded window"""
+        if due <= self._horizon and email_id not in self._in_heap:
+            heapq.heappush(self._heap, (due, email_id))
+            self._in_heap.add(email_id)
+            self._wakeup.set()
+    
+    async def load_window(self):
+        """Pull scheduled emails due before the end of the next window into the heap"""
+        horizon = datetime.utcnow() + timedelta(seconds=self.window_seconds)
+        cursor = db.email_logs.find(
+            {"status": EmailStatus.SCHEDULED, "scheduled_at": {"$lte": horizon}},
+            {"_id": 0, "id": 1, "scheduled_at": 1},
+        ).sort("scheduled_at", 1).limit(SCHEDULER_MAX_WINDOW_ITEMS)
+        loaded = 0
+        async for email_doc in cursor:
+            loaded += 1
+            if email_doc["id"] not in self._in_heap:
+                heapq.heappush(self._heap, (email_doc["scheduled_at"], email_doc["id"]))
+                self._in_heap.add(email_doc["id"])
+            last_due = email_doc["scheduled_at"]
+        self.stats["loaded"] += loaded
+        if loaded >= SCHEDULER_MAX_WINDOW_ITEMS:
+            # Window truncated: only trust it up to the last item and come back soon
+            self._horizon = last_due
+            self._next_load = time.monotonic() + 1
+        else:
+            self._horizon = horizon
+            self._next_load = time.monotonic() + self.window_seconds / 2
+    
+    async def release(self, email_ids: List[str]):
+        """Enqueue due emails, then move them to QUEUED.
         
-        return ApiKey(**api_key_doc)
-    except Exception as e:
-        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+        Enqueueing first (idempotent per email id) means a crash in between
+        can't leave a QUEUED email without a queue job; a worker that gets to
+        the job before the flip makes the flip itself.
+        """
+        token = uuid.uuid4().hex
+        now = datetime.utcnow()
+        await email_queue.enqueue_many(email_ids)
+        await db.email_logs.update_many(
+            {"id": {"$in": email_ids}, "status": EmailStatus.SCHEDULED},
+            {"$set": {"status": EmailStatus.QUEUED, "release_token": token, "queued_at": now}}
+        )
+        released = await db.email_logs.find(
+            {"id": {"$in": email_ids}, "release_token": token},
+            {"_id": 0, "id": 1, "user_id": 1, "created_at": 1},
+        ).to_list(len(email_ids))
+        for email_doc in released:
+            rollup_writer.record_status_move(
+                email_doc["user_id"], email_doc["created_at"], EmailStatus.SCHEDULED, EmailStatus.QUEUED
+            )
+        self.stats["released"] += len(released)
+        self.stats["lost_races"] += len(email_ids) - len(released)
+    
+    async def _run(self):
+        while True:
+            try:
+                if time.monotonic() >= self._next_load:
+                    await self.load_window()
+                
+                now = datetime.utcnow()
+                due = []
+                while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+                    _, email_id = heapq.heappop(self._heap)
+                    self._in_heap.discard(email_id)
+                    due.append(email_id)
+                if due:
+                    await self.release(due)
+                    continue
+                
+                # Sleep until the next due email, the next window load, or a new schedule
+                timeout = self._next_load - time.monotonic()
+                if self._heap:
+                    timeout = min(timeout, (self._heap[0][0] - now).total_seconds())
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, timeout))
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Error in email scheduler: {e}")
+                await asyncio.sleep(1)
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "in_window": len(self._heap),
+            "next_due": self._heap[0][0] if self._heap else None,
+        }
 
-async def get_user_from_api_key(api_key: ApiKey = Depends(get_api_key)) -> User:
-    """Get user from API key"""
-    user_doc = await db.users.find_one({"id": api_key.user_id, "is_active": True})
-    if not user_doc:
-        raise HTTPException(status_code=404, detail="User not found")
-    return User(**user_doc)
+email_scheduler = EmailScheduler()
 
-# Background Email Processing
-async def process_email_queue():
-    """Background task to process queued emails"""
-    while True:
-        try:
-            # Get email from queue (with timeout to prevent blocking)
+# Index Management
+INDEX_AUTO_CREATE = os.environ.get('INDEX_AUTO_CREATE', 'true').lower() == 'true'
+
+# (collection, keys, options) for every index a hot query relies on
+REQUIRED_INDEXES = [
+    ("api_keys", [("key_hash", 1), ("is_active", 1)], {"name": "key_hash_active"}),
+    ("api_keys", [("id", 1)], {"name": "id_unique", "unique": True}),
+    ("api_keys", [("user_id", 1), ("is_active", 1)], {"name": "user_active"}),
+    ("users", [("id", 1)], {"name": "id_unique", "unique": True}),
+    ("email_logs", [("id", 1)], {"name": "id_unique", "unique": True}),
+    ("email_logs", [("user_id", 1), ("status", 1), ("created_at", -1), ("id", -1)], {"name": "user_status_created_id"}),
+    # status is a trailing key so analytics status counts are covered by the index
+    ("email_logs", [("user_id", 1), ("created_at", -1), ("id", -1), ("status", 1)], {"name": "user_created_id_status"}),
+    ("email_logs", [("user_id", 1), ("tags", 1), ("created_at", -1)], {"name": "user_tags_created"}),
+    ("email_logs", [("status", 1), ("scheduled_at", 1)], {"name": "status_scheduled_at"}),
+    ("email_templates", [("user_id", 1), ("is_active", 1)], {"name": "user_active"}),
+    ("email_queue", [("visible_at", 1)], {"name": "visible_at"}),
+    ("rate_limits", [("expires_at", 1)], {"name": "expires_at_ttl", "expireAfterSeconds": 0}),
+    ("analytics_rollups", [("user_id", 1), ("granularity", 1), ("bucket", 1)], {"name": "user_granularity_bucket"}),
+    ("email_campaigns", [("id", 1)], {"name": "id_unique", "unique": True}),
+    ("email_campaigns", [("user_id", 1), ("created_at", -1)], {"name": "user_created"}),
+    ("email_campaigns", [("status", 1), ("runner_seen_at", 1)], {"name": "status_runner_seen"}),
+    ("campaign_recipients", [("campaign_id", 1), ("seq", 1)], {"name": "campaign_seq_unique", "unique": True}),
+    ("dead_letters", [("id", 1)], {"name": "id_unique", "unique": True}),
+    ("dead_letters", [("user_id", 1), ("dead_at", 1)], {"name": "user_dead_at"}),
+    # The standard GridFS indexes, named as the drivers name them
+    (f"{ATTACHMENT_BUCKET}.files", [("filename", 1), ("uploadDate", 1)], {"name": "filename_1_uploadDate_1"}),
+    (f"{ATTACHMENT_BUCKET}.chunks", [("files_id", 1), ("n", 1)], {"name": "files_id_1_n_1", "unique": True}),
+]
+
+class IndexManager:
+    """Creates and verifies the indexes in REQUIRED_INDEXES at startup.
+    
+    Missing indexes are created (unless INDEX_AUTO_CREATE is off) and anything
+    still missing afterwards is logged, as are extra indexes that
+    ``$indexStats`` reports as never used since the server started.
+    """
+    
+    def __init__(self, required: List[tuple] = REQUIRED_INDEXES, auto_create: bool = INDEX_AUTO_CREATE):
+        self.required = required
+        self.auto_create = auto_create
+        self.state: Dict[str, Any] = {"verified_at": None, "created": [], "missing": [], "unused": [], "errors": []}
+    
+    async def ensure(self):
+        """Create missing indexes, then verify"""
+        created, errors = [], []
+        if self.auto_create:
+            for collection, keys, options in self.required:
+                try:
+                    existing = await self._key_specs(collection)
+                    if tuple(keys) not in existing:
+                        await db[collection].create_index(keys, **options)
+                        created.append(f"{collection}.{options['name']}")
+                except Exception as e:
+                    errors.append(f"{collection}.{options['name']}: {e}")
+                    logging.error(f"Failed to create index {collection}.{options['name']}: {e}")
+        await self.verify()
+        self.state["created"] = created
+        self.state["errors"] = errors
+        if created:
+            logging.info(f"Created indexes: {', '.join(created)}")
+        return self.state
+    
+    async def verify(self):
+        """Record which required indexes are missing and which extra ones are unused"""
+        missing, unused = [], []
+        required_by_collection: Dict[str, set] = {}
+        for collection, keys, options in self.required:
+            required_by_collection.setdefault(collection, set()).add(tuple(keys))
+        
+        for collection, required_keys in required_by_collection.items():
+            existing = await self._key_specs(collection)
+            for collection_name, keys, options in self.required:
+                if collection_name == collection and tuple(keys) not in existing:
+                    missing.append(f"{collection}.{options['name']}")
             try:
-                email_id = await asyncio.wait_for(email_queue.get(), timeout=1.0)
-            except asyncio.TimeoutError:
-                continue
-            
-            # Get email from database
-            email_doc = await db.email_logs.find_one({"id": email_id})
-            if not email_doc:
-                continue
-            
-            email_log = EmailLog(**email_doc)
-            
-            # Update status to processing
-            await db.email_logs.update_one(
-                {"id": email_id},
-                {"$set": {"status": EmailStatus.PROCESSING, "queued_at": datetime.utcnow()}}
-            )
-            
-            # Send email
-            result = await email_service.send_email(email_log)
-            
-            if result["success"]:
-                # Update status to sent
-                await db.email_logs.update_one(
-                    {"id": email_id},
-                    {"$set": {
-                        "status": EmailStatus.SENT,
-                        "sent_at": datetime.utcnow(),
-                        "provider_message_id": result.get("provider_message_id")
-                    }}
-                )
-            else:
-                # Update status to failed
-                await db.email_logs.update_one(
-                    {"id": email_id},
-                    {"$set": {
-                        "status": EmailStatus.FAILED,
-                        "failed_at": datetime.utcnow(),
-                        "error_message": result.get("error")
-                    }}
-                )
-            
-        except Exception as e:
-            logging.error(f"Error processing email queue: {e}")
-            await asyncio.sleep(1)
+                async for stat in db[collection].aggregate([{"$indexStats": {}}]):
+                    name = stat["name"]
+                    keys = tuple(stat.get("key", {}).items())
+                    if name != "_id_" and keys not in required_keys and stat.get("accesses", {}).get("ops", 0) == 0:
+                        unused.append(f"{collection}.{name}")
+            except Exception as e:
+                # $indexStats isn't available everywhere (e.g. some managed tiers)
+                logging.debug(f"Could not read index stats for {collection}: {e}")
+        
+        for name in missing:
+            logging.warning(f"Missing required index {name}")
+        for name in unused:
+            logging.info(f"Index {name} is not required and has not been used")
+        self.state.update({"verified_at": datetime.utcnow(), "missing": missing, "unused": unused})
+        return self.state
+    
+    async def _key_specs(self, collection: str) -> set:
+        info = await db[collection].index_information()
+        return {tuple((field, direction) for field, direction in index["key"]) for index in info.values()}
+
+index_manager = IndexManager()
 
 # Start background task
 @app.on_event("startup")
 async def startup_event():
-    # Start email processing task
-    asyncio.create_task(process_email_queue())
+    # Make sure hot queries are backed by indexes before taking traffic
+    try:
+        await index_manager.ensure()
+    except Exception as e:
+        logging.error(f"Index bootstrap failed: {e}")
+    
+    # Start email processing workers
+    email_queue.start()
+    status_writer.start()
+    rollup_writer.start()
+    last_used_tracker.start()
+    quota_manager.start()
+    rate_limiter.start()
+    await email_worker_pool.start()
+    await campaign_engine.start()
+    email_scheduler.start()
 
 # API Routes
 # API Routes
 
+async def get_compiled_template(user_id: str, template_id: str) -> CompiledEmailTemplate:
+    compiled = await template_engine.get(user_id, template_id)
+    if compiled is None:
+        raise HTTPException(status_code=404, detail="Template not found")
+    return compiled
+
+def build_email_log(
+    request: SendEmailRequest,
+    user: User,
+    api_key: ApiKey,
+    rendered: Optional[Dict[str, Optional[str]]] = None,
+    attachments: Optional[List[AttachmentRef]] = None
+) -> EmailLog:
+    """Create the EmailLog for a send request, using ``rendered`` template parts if given.
+    
+    ``attachments`` are the stored references for the request's attachments.
+    """
+    # Combine all recipients, typed by the list they came in
+    all_recipients = [
+        recipient.model_copy(update={"type": kind})
+        for kind, recipients in (("to", request.to), ("cc", request.cc), ("bcc", request.bcc))
+        for recipient in recipients
+    ]
+    
+    # Explicit request content wins over the template's
+    rendered = rendered or {}
+    return EmailLog(
+        user_id=user.id,
+        api_key_id=api_key.id,
+        from_email=request.from_email,
+        from_name=request.from_name,
+        recipients=all_recipients,
+        subject=request.subject or rendered.get("subject"),
+        html_content=request.html_content or rendered.get("html_content"),
+        text_content=request.text_content or rendered.get("text_content"),
+        attachments=attachments or [],
+        tags=request.tags,
+        metadata=request.metadata,
+        template_id=request.template_id,
+        **schedule_fields(request.scheduled_at)
+    )
+
+def body_template(request: SendEmailRequest, compiled: Optional[CompiledEmailTemplate]) -> Optional[CompiledEmailTemplate]:
+    """The template an email's body can be stored as, unless the request overrides its content"""
+    if compiled is None or request.html_content or request.text_content:
+        return None
+    return compiled
+
+def schedule_fields(scheduled_at: Optional[datetime]) -> Dict[str, Any]:
+    """EmailLog fields for a requested send time; past times send right away
+    
+    Whatever ``send_immediately`` says, an email that isn't scheduled for later
+    is queued, so past-due sends go out at once rather than sitting in QUEUED.
+    """
+    if scheduled_at is None:
+        return {}
+    scheduled_at = naive_utc(scheduled_at)
+    if scheduled_at <= datetime.utcnow():
+        return {}
+    return {"status": EmailStatus.SCHEDULED, "scheduled_at": scheduled_at}
+
 @api_router.post("/v1/emails", response_model=SendEmailResponse)
 async def send_email(
     request: SendEmailRequest,
@@ -345,75 +3382,253 @@ async def send_email(
 ):
     """Send an email"""
     try:
-        # Check user quota
-        if user.emails_sent_this_month >= user.email_quota:
+        rendered = None
+        compiled = None
+        if request.template_id:
+            compiled = await get_compiled_template(user.id, request.template_id)
+            try:
+                rendered = compiled.render(request.template_variables)
+            except TemplateRenderError as e:
+                raise HTTPException(status_code=422, detail=str(e))
+        
+        # Store attachment bodies up front; they are content-addressed, so a
+        # later rejection leaves nothing that a retry wouldn't reuse
+        try:
+            attachments = await attachment_store.put_many(request.attachments)
+        except AttachmentError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        
+        # Reserve quota for this email
+        if not await quota_manager.reserve(user.id, 1):
             raise HTTPException(
                 status_code=429, 
                 detail=f"Email quota exceeded. Current limit: {user.email_quota}"
             )
         
-        # Combine all recipients
-        all_recipients = request.to + request.cc + request.bcc
-        
-        # Create email log
-        email_log = EmailLog(
-            user_id=user.id,
-            api_key_id=api_key.id,
-            from_email=request.from_email,
-            from_name=request.from_name,
-            recipients=all_recipients,
-            subject=request.subject,
-            html_content=request.html_content,
-            text_content=request.text_content,
-            attachments=request.attachments,
-            tags=request.tags,
-            metadata=request.metadata,
-            template_id=request.template_id
-        )
+        email_log = build_email_log(request, user, api_key, rendered, attachments)
         
         # Insert into database
-        await db.email_logs.insert_one(email_log.dict())
-        
-        # Add to queue for processing
-        if request.send_immediately:
-            await email_queue.put(email_log.id)
-            email_log.status = EmailStatus.QUEUED
+        try:
+            await body_store.share([(email_log, body_template(request, compiled), request.template_variables)])
+            await db.email_logs.insert_one(email_log.dict())
+        except Exception:
+            await quota_manager.release(user.id, 1)
+            raise
+        rollup_writer.record_created(email_log)
         
-        # Update user's email count
-        await db.users.update_one(
-            {"id": user.id},
-            {"$inc": {"emails_sent_this_month": 1}}
-        )
+        # Add to queue for processing, or hand future sends to the scheduler
+        message = "Email queued for sending"
+        if email_log.status == EmailStatus.SCHEDULED:
+            email_scheduler.add(email_log.id, email_log.scheduled_at)
+            message = f"Email scheduled for {email_log.scheduled_at.isoformat()}"
+        else:
+            await email_queue.enqueue(email_log.id, payload=email_log)
         
         return SendEmailResponse(
             id=email_log.id,
             status=email_log.status,
-            message="Email queued for sending",
+            message=message,
             created_at=email_log.created_at
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error sending email: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@api_router.get("/v1/emails", response_model=List[EmailLog])
+@api_router.post("/v1/emails/batch", response_model=BatchSendEmailResponse)
+async def send_email_batch(
+    request: BatchSendEmailRequest,
+    api_key: ApiKey = Depends(get_api_key),
+    user: User = Depends(get_user_from_api_key)
+):
+    """Send up to EMAIL_BATCH_MAX_SIZE emails in one request"""
+    if not request.emails:
+        raise HTTPException(status_code=400, detail="Batch must contain at least one email")
+    if len(request.emails) > EMAIL_BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch too large. Maximum batch size: {EMAIL_BATCH_MAX_SIZE}"
+        )
+    
+    try:
+        results = [BatchSendEmailResult(index=index) for index in range(len(request.emails))]
+        valid = []
+        
+        # Validate every item first
+        for result, item in zip(results, request.emails):
+            try:
+                valid.append((result, SendEmailRequest(**item)))
+            except ValidationError as e:
+                result.error = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+        
+        # Render templated items, each distinct template in one render_many call
+        rendered: Dict[int, Dict[str, Optional[str]]] = {}
+        templates: Dict[str, CompiledEmailTemplate] = {}
+        by_template: Dict[str, List[tuple]] = {}
+        for result, item_request in valid:
+            if item_request.template_id:
+                by_template.setdefault(item_request.template_id, []).append((result, item_request))
+        for template_id, items in by_template.items():
+            compiled = await template_engine.get(user.id, template_id)
+            if compiled is None:
+                for result, _ in items:
+                    result.error = "Template not found"
+                continue
+            templates[template_id] = compiled
+            outputs = compiled.render_many([item_request.template_variables for _, item_request in items])
+            for (result, _), output in zip(items, outputs):
+                if isinstance(output, TemplateRenderError):
+                    result.error = str(output)
+                else:
+                    rendered[result.index] = output
+        valid = [(result, item_request) for result, item_request in valid if result.error is None]
+        
+        # Store attachments; repeats across the batch are uploaded once
+        stored = await asyncio.gather(
+            *(attachment_store.put_many(item_request.attachments) for _, item_request in valid),
+            return_exceptions=True
+        )
+        attachments: Dict[int, List[AttachmentRef]] = {}
+        for (result, _), refs in zip(valid, stored):
+            if isinstance(refs, AttachmentError):
+                result.error = str(refs)
+            elif isinstance(refs, Exception):
+                raise refs
+            else:
+                attachments[result.index] = refs
+        valid = [(result, item_request) for result, item_request in valid if result.error is None]
+        
+        # Reserve quota once for the whole batch; items past what's left are rejected
+        granted = await quota_manager.reserve(user.id, len(valid), partial=True) if valid else 0
+        for result, _ in valid[granted:]:
+            result.error = f"Email quota exceeded. Current limit: {user.email_quota}"
+        
+        email_logs: List[EmailLog] = []
+        bodies: List[tuple] = []
+        send_now: List[EmailLog] = []
+        scheduled: List[EmailLog] = []
+        for result, item_request in valid[:granted]:
+            email_log = build_email_log(item_request, user, api_key, rendered.get(result.index), attachments.get(result.index))
+            email_logs.append(email_log)
+            compiled = templates.get(item_request.template_id) if item_request.template_id else None
+            bodies.append((email_log, body_template(item_request, compiled), item_request.template_variables))
+            if email_log.status == EmailStatus.SCHEDULED:
+                scheduled.append(email_log)
+            else:
+                send_now.append(email_log)
+            result.id = email_log.id
+            result.status = email_log.status
+        
+        if email_logs:
+            try:
+                await body_store.share(bodies)
+                await db.email_logs.insert_many([email_log.dict() for email_log in email_logs], ordered=False)
+            except Exception:
+                await quota_manager.release(user.id, len(email_logs))
+                raise
+            for email_log in email_logs:
+                rollup_writer.record_created(email_log)
+            await email_queue.enqueue_many([email_log.id for email_log in send_now], payloads=send_now)
+            for email_log in scheduled:
+                email_scheduler.add(email_log.id, email_log.scheduled_at)
+        
+        return BatchSendEmailResponse(
+            accepted=len(email_logs),
+            rejected=len(results) - len(email_logs),
+            results=results,
+            created_at=datetime.utcnow()
+        )
+        
+    except Exception as e:
+        logging.error(f"Error sending email batch: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def encode_email_cursor(email_doc: Dict[str, Any]) -> str:
+    """Opaque keyset cursor pointing just past ``email_doc`` in (created_at, id) order"""
+    position = {"created_at": email_doc["created_at"].isoformat(), "id": email_doc["id"]}
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+def decode_email_cursor(cursor: str) -> Dict[str, Any]:
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return {"created_at": datetime.fromisoformat(position["created_at"]), "id": str(position["id"])}
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+class EmailListView(str, Enum):
+    FULL = "full"
+    SUMMARY = "summary"
+
+@api_router.get("/v1/emails", response_model=Union[List[EmailLog], List[EmailLogSummary]])
 async def get_emails(
+    response: Response,
     limit: int = 100,
     offset: int = 0,
+    cursor: Optional[str] = None,
     status: Optional[EmailStatus] = None,
+    view: EmailListView = EmailListView.FULL,
+    fields: Optional[str] = None,
     user: User = Depends(get_user_from_api_key)
 ):
-    """Get email logs for the authenticated user"""
+    """Get email logs for the authenticated user, newest first.
+    
+    Pass the ``X-Next-Cursor`` response header back as ``cursor`` to fetch the
+    next page; unlike ``offset`` every cursor page costs the same.
+    
+    ``view=summary`` returns EmailLogSummary items and ``fields=a,b,c`` returns
+    only the listed EmailLog fields (plus ``id`` and ``created_at``); both
+    are projected in Mongo so bodies and attachments are never loaded.
+    """
+    projection: Optional[Dict[str, int]] = None
+    if fields:
+        requested = {field.strip() for field in fields.split(",") if field.strip()}
+        unknown = requested - set(EmailLog.model_fields)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+        projection = {field: 1 for field in requested | {"id", "created_at"}}
+        if requested & {"html_content", "text_content"}:
+            projection.update(body_id=1, body_variables=1)
+    elif view == EmailListView.SUMMARY:
+        projection = {field: 1 for field in EmailLogSummary.model_fields}
+    if projection is not None:
+        projection["_id"] = 0
+    
+    # Build query
+    query: Dict[str, Any] = {"user_id": user.id}
+    if status:
+        query["status"] = status
+    if cursor:
+        position = decode_email_cursor(cursor)
+        query["$or"] = [
+            {"created_at": {"$lt": position["created_at"]}},
+            {"created_at": position["created_at"], "id": {"$lt": position["id"]}},
+        ]
+        offset = 0
+    
     try:
-        # Build query
-        query = {"user_id": user.id}
-        if status:
-            query["status"] = status
-        
         # Get emails from database
-        cursor = db.email_logs.find(query).sort("created_at", -1).skip(offset).limit(limit)
-        emails = await cursor.to_list(length=limit)
+        db_cursor = db.email_logs.find(query, projection).sort([("created_at", -1), ("id", -1)]).skip(offset).limit(limit)
+        emails = await db_cursor.to_list(length=limit)
+        
+        if limit > 0 and len(emails) == limit:
+            response.headers["X-Next-Cursor"] = encode_email_cursor(emails[-1])
         
+        # Slim views skip full EmailLog validation and response re-validation
+        if fields:
+            if "body_id" in projection:
+                await body_store.hydrate_docs(emails)
+                for email in emails:
+                    for field in ("body_id", "body_variables"):
+                        if field not in requested:
+                            email.pop(field, None)
+            return JSONResponse(content=jsonable_encoder(emails), headers=dict(response.headers))
+        if view == EmailListView.SUMMARY:
+            summaries = [EmailLogSummary(**email) for email in emails]
+            return JSONResponse(content=jsonable_encoder(summaries), headers=dict(response.headers))
+        
+        await body_store.hydrate_docs(emails)
         return [EmailLog(**email) for email in emails]
         
     except Exception as e:
@@ -431,6 +3646,7 @@ async def get_email_by_id(
         if not email_doc:
             raise HTTPException(status_code=404, detail="Email not found")
         
+        await body_store.hydrate_docs([email_doc])
         return EmailLog(**email_doc)
         
     except Exception as e:
@@ -465,6 +3681,137 @@ async def get_templates(
         logging.error(f"Error getting templates: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+async def get_user_campaign(campaign_id: str, user: User) -> EmailCampaign:
+    campaign_doc = await db.email_campaigns.find_one({"id": campaign_id, "user_id": user.id})
+    if not campaign_doc:
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    return EmailCampaign(**campaign_doc)
+
+async def transition_campaign(campaign_id: str, user: User, from_statuses: List[str], fields: Dict[str, Any]) -> EmailCampaign:
+    """Move a campaign to a new status if it's currently in one of ``from_statuses``"""
+    campaign_doc = await db.email_campaigns.find_one_and_update(
+        {"id": campaign_id, "user_id": user.id, "status": {"$in": from_statuses}},
+        {"$set": {**fields, "updated_at": datetime.utcnow()}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if campaign_doc is None:
+        campaign = await get_user_campaign(campaign_id, user)
+        raise HTTPException(status_code=409, detail=f"Campaign is {campaign.status}")
+    return EmailCampaign(**campaign_doc)
+
+@api_router.post("/v1/campaigns", response_model=EmailCampaign)
+async def create_campaign(
+    request: CreateCampaignRequest,
+    user: User = Depends(get_user_from_api_key)
+):
+    """Create a draft campaign"""
+    await get_compiled_template(user.id, request.template_id)
+    try:
+        campaign = EmailCampaign(user_id=user.id, **request.dict())
+        await db.email_campaigns.insert_one(campaign.dict())
+        return campaign
+        
+    except Exception as e:
+        logging.error(f"Error creating campaign: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/v1/campaigns", response_model=List[EmailCampaign])
+async def get_campaigns(
+    user: User = Depends(get_user_from_api_key)
+):
+    """Get campaigns for the authenticated user"""
+    try:
+        campaigns = await db.email_campaigns.find({"user_id": user.id}).sort("created_at", -1).to_list(100)
+        return [EmailCampaign(**campaign) for campaign in campaigns]
+        
+    except Exception as e:
+        logging.error(f"Error getting campaigns: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/v1/campaigns/{campaign_id}", response_model=EmailCampaign)
+async def get_campaign(
+    campaign_id: str,
+    user: User = Depends(get_user_from_api_key)
+):
+    """Get a specific campaign by ID"""
+    return await get_user_campaign(campaign_id, user)
+
+@api_router.post("/v1/campaigns/{campaign_id}/recipients")
+async def add_campaign_recipients(
+    campaign_id: str,
+    request: AddCampaignRecipientsRequest,
+    user: User = Depends(get_user_from_api_key)
+):
+    """Append recipients to a campaign; call repeatedly to upload large lists.
+    
+    Uploads are refused while the campaign is sending: the runner could move
+    past sequence numbers that are reserved but not yet inserted. Pause it
+    first, then resume once the upload is done.
+    """
+    count = len(request.recipients)
+    if not count:
+        raise HTTPException(status_code=400, detail="No recipients given")
+    if count > CAMPAIGN_RECIPIENTS_MAX_PER_REQUEST:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Too many recipients. Maximum per request: {CAMPAIGN_RECIPIENTS_MAX_PER_REQUEST}"
+        )
+    
+    # Reserve a contiguous range of sequence numbers for this upload
+    campaign_doc = await db.email_campaigns.find_one_and_update(
+        {"id": campaign_id, "user_id": user.id, "status": {"$in": ["draft", "paused"]}},
+        {"$inc": {"total_recipients": count}, "$set": {"updated_at": datetime.utcnow()}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if campaign_doc is None:
+        campaign = await get_user_campaign(campaign_id, user)
+        raise HTTPException(status_code=409, detail=f"Cannot add recipients to a {campaign.status} campaign")
+    
+    try:
+        first_seq = campaign_doc["total_recipients"] - count + 1
+        await db.campaign_recipients.insert_many([
+            {"campaign_id": campaign_id, "seq": first_seq + offset, **recipient.dict()}
+            for offset, recipient in enumerate(request.recipients)
+        ], ordered=False)
+        return {"added": count, "total_recipients": campaign_doc["total_recipients"]}
+        
+    except Exception as e:
+        logging.error(f"Error adding campaign recipients: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/v1/campaigns/{campaign_id}/start", response_model=EmailCampaign)
+async def start_campaign(
+    campaign_id: str,
+    user: User = Depends(get_user_from_api_key)
+):
+    """Start sending a draft campaign"""
+    now = datetime.utcnow()
+    campaign = await transition_campaign(
+        campaign_id, user, ["draft"], {"status": "sending", "started_at": now, "runner": None}
+    )
+    await campaign_engine.launch(campaign_id)
+    return campaign
+
+@api_router.post("/v1/campaigns/{campaign_id}/pause", response_model=EmailCampaign)
+async def pause_campaign(
+    campaign_id: str,
+    user: User = Depends(get_user_from_api_key)
+):
+    """Pause a sending campaign after the chunk in progress"""
+    return await transition_campaign(campaign_id, user, ["sending"], {"status": "paused", "status_reason": None})
+
+@api_router.post("/v1/campaigns/{campaign_id}/resume", response_model=EmailCampaign)
+async def resume_campaign(
+    campaign_id: str,
+    user: User = Depends(get_user_from_api_key)
+):
+    """Resume a paused campaign from where it stopped"""
+    campaign = await transition_campaign(
+        campaign_id, user, ["paused"], {"status": "sending", "status_reason": None, "runner": None}
+    )
+    await campaign_engine.launch(campaign_id)
+    return campaign
+
 @api_router.post("/v1/api-keys", response_model=Dict[str, Any])
 async def create_api_key(
     name: str,
@@ -510,7 +3857,7 @@ async def get_api_keys(
                 "id": key["id"],
                 "name": key["name"],
                 "created_at": key["created_at"],
-                "last_used": key.get("last_used"),
+                "last_used": max(filter(None, [key.get("last_used"), last_used_tracker.latest(key["id"])]), default=None),
                 "permissions": key["permissions"]
             })
         
@@ -527,52 +3874,255 @@ async def delete_api_key(
 ):
     """Delete an API key"""
     try:
-        result = await db.api_keys.update_one(
+        key_doc = await db.api_keys.find_one_and_update(
             {"id": key_id, "user_id": user.id},
             {"$set": {"is_active": False}}
         )
         
-        if result.matched_count == 0:
+        if key_doc is None:
             raise HTTPException(status_code=404, detail="API key not found")
         
+        # Revoke immediately rather than waiting for the cache TTL
+        api_key_cache.invalidate(key_doc["key_hash"])
+        
         return {"message": "API key deleted successfully"}
         
     except Exception as e:
         logging.error(f"Error deleting API key: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@api_router.get("/v1/dead-letters", response_model=List[DeadLetter])
+async def get_dead_letters(
+    limit: int = 100,
+    offset: int = 0,
+    user: User = Depends(get_user_from_api_key)
+):
+    """Emails that failed permanently or ran out of retries, oldest first"""
+    try:
+        dead_letters = await db.dead_letters.find({"user_id": user.id}, {"_id": 0}).sort("dead_at", 1).skip(offset).limit(limit).to_list(limit)
+        return [DeadLetter(**dead_letter) for dead_letter in dead_letters]
+        
+    except Exception as e:
+        logging.error(f"Error getting dead letters: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/v1/dead-letters/redrive", response_model=RedriveDeadLettersResponse)
+async def redrive_dead_letters(
+    request: RedriveDeadLettersRequest,
+    user: User = Depends(get_user_from_api_key)
+):
+    """Queue dead-lettered emails for delivery again"""
+    try:
+        email_ids = await dead_letter_queue.redrive(user.id, request.email_ids, request.limit)
+        return RedriveDeadLettersResponse(redriven=len(email_ids), email_ids=email_ids)
+        
+    except Exception as e:
+        logging.error(f"Error re-driving dead letters: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def parse_tags(tags: Optional[str]) -> List[str]:
+    """Split a comma-separated ``tags`` query parameter"""
+    return [tag.strip() for tag in (tags or "").split(",") if tag.strip()]
+
+def analytics_match(
+    user_id: str,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    tags: Optional[List[str]] = None
+) -> Dict[str, Any]:
+    """$match stage for analytics over a user's emails"""
+    match: Dict[str, Any] = {"user_id": user_id}
+    if start_date or end_date:
+        match["created_at"] = {}
+        if start_date:
+            match["created_at"]["$gte"] = start_date
+        if end_date:
+            match["created_at"]["$lt"] = end_date
+    if tags:
+        match["tags"] = {"$all": tags}
+    return match
+
+async def email_status_counts(
+    user_id: str,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    tags: Optional[List[str]] = None
+) -> Dict[str, int]:
+    """Count a user's emails by status in one aggregation round trip"""
+    counts = {email_status.value: 0 for email_status in EmailStatus}
+    pipeline = [
+        {"$match": analytics_match(user_id, start_date, end_date, tags)},
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}},
+    ]
+    async for row in db.email_logs.aggregate(pipeline):
+        counts[row["_id"]] = row["count"]
+    return counts
+
 @api_router.get("/v1/analytics/overview")
 async def get_analytics_overview(
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    tags: Optional[str] = None,
     user: User = Depends(get_user_from_api_key)
 ):
-    """Get email analytics overview"""
+    """Get email analytics overview, optionally for a created_at range and comma-separated tags.
+    
+    Served from the rollups when there's no tag filter and the range is
+    aligned to hours or days; otherwise aggregated from email_logs.
+    """
+    start_date, end_date = naive_utc(start_date), naive_utc(end_date)
     try:
         # Get email statistics
-        total_emails = await db.email_logs.count_documents({"user_id": user.id})
-        sent_emails = await db.email_logs.count_documents({"user_id": user.id, "status": EmailStatus.SENT})
-        delivered_emails = await db.email_logs.count_documents({"user_id": user.id, "status": EmailStatus.DELIVERED})
-        bounced_emails = await db.email_logs.count_documents({"user_id": user.id, "status": EmailStatus.BOUNCED})
+        tag_list = parse_tags(tags)
+        status_counts = None if tag_list else await rollup_status_counts(user.id, start_date, end_date)
+        if status_counts is None:
+            status_counts = await email_status_counts(user.id, start_date, end_date, tag_list)
+        total_emails = sum(status_counts.values())
+        sent_emails = status_counts[EmailStatus.SENT.value]
+        delivered_emails = status_counts[EmailStatus.DELIVERED.value]
+        bounced_emails = status_counts[EmailStatus.BOUNCED.value]
         
         # Calculate rates
         delivery_rate = (delivered_emails / total_emails * 100) if total_emails > 0 else 0
         bounce_rate = (bounced_emails / total_emails * 100) if total_emails > 0 else 0
         
+        # The counter includes quota reserved in blocks but not sent yet; take
+        # off what this process still holds
+        quota_doc = await db.users.find_one(
+            {"id": user.id}, {"_id": 0, "emails_sent_this_month": 1, "email_quota": 1}
+        ) or user.dict()
+        quota_limit = quota_doc["email_quota"]
+        quota_used = max(0, quota_doc["emails_sent_this_month"] - quota_manager.unused(user.id))
+        
         return {
             "total_emails": total_emails,
             "sent_emails": sent_emails,
             "delivered_emails": delivered_emails,
             "bounced_emails": bounced_emails,
+            "status_counts": status_counts,
             "delivery_rate": round(delivery_rate, 2),
             "bounce_rate": round(bounce_rate, 2),
-            "quota_used": user.emails_sent_this_month,
-            "quota_limit": user.email_quota,
-            "quota_percentage": round((user.emails_sent_this_month / user.email_quota * 100), 2)
+            "quota_used": quota_used,
+            "quota_limit": quota_limit,
+            "quota_percentage": round((quota_used / quota_limit * 100), 2) if quota_limit else 0
         }
         
     except Exception as e:
         logging.error(f"Error getting analytics: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+class TimeseriesGranularity(str, Enum):
+    MINUTE = "minute"
+    HOUR = "hour"
+    DAY = "day"
+
+TIMESERIES_MAX_POINTS = int(os.environ.get('TIMESERIES_MAX_POINTS', '1000'))
+TIMESERIES_DEFAULT_RANGE = {
+    TimeseriesGranularity.MINUTE: timedelta(hours=1),
+    TimeseriesGranularity.HOUR: timedelta(hours=48),
+    TimeseriesGranularity.DAY: timedelta(days=30),
+}
+TIMESERIES_STEP = {
+    TimeseriesGranularity.MINUTE: timedelta(minutes=1),
+    TimeseriesGranularity.HOUR: timedelta(hours=1),
+    TimeseriesGranularity.DAY: timedelta(days=1),
+}
+
+async def aggregate_timeseries(
+    user_id: str,
+    granularity: str,
+    start: datetime,
+    end: datetime,
+    tags: List[str]
+) -> Dict[datetime, Dict[str, Any]]:
+    """Bucketed status counts computed from email_logs in one aggregation"""
+    pipeline = [
+        {"$match": analytics_match(user_id, start, end, tags)},
+        {"$group": {
+            "_id": {"bucket": bucket_expression(granularity), "status": "$status"},
+            "count": {"$sum": 1},
+            "opens": {"$sum": "$open_count"},
+            "clicks": {"$sum": "$click_count"},
+        }},
+    ]
+    rows: Dict[datetime, Dict[str, Any]] = {}
+    async for row in db.email_logs.aggregate(pipeline):
+        doc = rows.setdefault(row["_id"]["bucket"], {"total": 0, "counts": {}, "opens": 0, "clicks": 0})
+        doc["total"] += row["count"]
+        doc["counts"][row["_id"]["status"]] = row["count"]
+        doc["opens"] += row["opens"]
+        doc["clicks"] += row["clicks"]
+    return rows
+
+@api_router.get("/v1/analytics/timeseries")
+async def get_analytics_timeseries(
+    granularity: TimeseriesGranularity = TimeseriesGranularity.DAY,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    tags: Optional[str] = None,
+    user: User = Depends(get_user_from_api_key)
+):
+    """Email counts by status per minute, hour or day.
+    
+    Hourly and daily series without a tag filter are read from the rollups;
+    minute series and tag-filtered series are grouped server-side from
+    email_logs. At most TIMESERIES_MAX_POINTS buckets are returned.
+    """
+    step = TIMESERIES_STEP[granularity]
+    start_date, end_date = naive_utc(start_date), naive_utc(end_date)
+    end = bucket_start(end_date or datetime.utcnow(), granularity.value) + step
+    start = bucket_start(start_date or end - TIMESERIES_DEFAULT_RANGE[granularity], granularity.value)
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start_date must be before end_date")
+    if (end - start) / step > TIMESERIES_MAX_POINTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Range too large for {granularity.value} granularity. Maximum points: {TIMESERIES_MAX_POINTS}"
+        )
+    
+    try:
+        tag_list = parse_tags(tags)
+        if tag_list or granularity.value not in ROLLUP_GRANULARITIES:
+            source = "email_logs"
+            rows = await aggregate_timeseries(user.id, granularity.value, start, end, tag_list)
+        else:
+            source = "rollups"
+            rows = {}
+            async for doc in db.analytics_rollups.find({
+                "user_id": user.id,
+                "granularity": granularity.value,
+                "bucket": {"$gte": start, "$lt": end},
+            }):
+                rows[doc["bucket"]] = doc
+        
+        # Emit every bucket in the range, zero-filled
+        points = []
+        bucket = start
+        while bucket < end:
+            doc = rows.get(bucket, {})
+            counts = {email_status.value: 0 for email_status in EmailStatus}
+            counts.update(doc.get("counts", {}))
+            points.append({
+                "bucket": bucket,
+                "total": doc.get("total", 0),
+                "counts": counts,
+                "opens": doc.get("opens", 0),
+                "clicks": doc.get("clicks", 0),
+            })
+            bucket += step
+        
+        return {
+            "granularity": granularity,
+            "start_date": start,
+            "end_date": end,
+            "source": source,
+            "points": points,
+        }
+        
+    except Exception as e:
+        logging.error(f"Error getting analytics timeseries: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 # Original routes (keeping for compatibility)
 # Original routes (keeping for compatibility)
 
@@ -601,13 +4151,30 @@ async def health_check():
         await db.list_collection_names()
         
         # Check queue status
-        queue_size = email_queue.qsize()
+        queue_stats = await email_queue.get_stats()
         
         return {
             "status": "healthy",
             "timestamp": datetime.utcnow(),
             "database": "connected",
-            "queue_size": queue_size,
+            "queue_size": queue_stats["pending"],
+            "queue": queue_stats,
+            "workers": email_worker_pool.get_stats(),
+            "status_writer": status_writer.get_stats(),
+            "rollups": rollup_writer.get_stats(),
+            "auth_cache": {"api_keys": api_key_cache.get_stats(), "users": user_cache.get_stats()},
+            "api_key_last_used": last_used_tracker.get_stats(),
+            "quota": quota_manager.get_stats(),
+            "templates": template_engine.get_stats(),
+            "campaigns": campaign_engine.get_stats(),
+            "attachments": attachment_store.get_stats(),
+            "bodies": body_store.get_stats(),
+            "smtp": smtp_pools.get_stats(),
+            "providers": email_service.get_stats(),
+            "dead_letters": dead_letter_queue.get_stats(),
+            "scheduler": email_scheduler.get_stats(),
+            "rate_limits": rate_limiter.get_stats(),
+            "indexes": index_manager.state,
             "version": "1.0.0"
         }
     except Exception as e:
@@ -622,6 +4189,7 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # Configure logging
@@ -633,4 +4201,16 @@ logger = logging.getLogger(__name__)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    # Let in-flight emails finish before the connection goes away
+    await email_scheduler.stop()
+    await campaign_engine.stop()
+    await email_worker_pool.stop()
+    await smtp_dispatcher.stop()
+    await smtp_pools.close()
+    await status_writer.stop()
+    await rollup_writer.stop()
+    await email_queue.stop()
+    await last_used_tracker.stop()
+    await quota_manager.stop()
+    await rate_limiter.stop()
     client.close()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Local SMTP stand-in for developing and testing the SMTP provider.
+
+Run it and start the backend with SMTP_HOST=localhost SMTP_PORT=1025
+SMTP_START_TLS=false; every message the platform sends is accepted and
+summarised here instead of being delivered.
+"""
+import argparse
+import asyncio
+from email import message_from_bytes
+
+from aiosmtpd.controller import Controller
+
+class SinkHandler:
+    """Accepts every message and prints a one-line summary"""
+    
+    def __init__(self, reject: set):
+        self.reject = reject
+        self.messages = 0
+        self.sessions = set()
+    
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address in self.reject:
+            return "550 5.1.1 Mailbox unavailable"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+    
+    async def handle_DATA(self, server, session, envelope):
+        self.messages += 1
+        self.sessions.add(id(session))
+        message = message_from_bytes(envelope.content)
+        print(
+            f"📨 #{self.messages} (connection {len(self.sessions)}) "
+            f"{envelope.mail_from} -> {', '.join(envelope.rcpt_tos)} | {message['Subject']} "
+            f"| {len(envelope.content)} bytes"
+        )
+        return "250 Message accepted for delivery"
+
+async def run_sink(host: str, port: int, reject: set):
+    handler = SinkHandler(reject)
+    controller = Controller(handler, hostname=host, port=port)
+    controller.start()
+    print(f"✅ SMTP sink listening on {host}:{port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        controller.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local SMTP sink for the email platform")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1025)
+    parser.add_argument("--reject", action="append", default=[], help="Recipient address to refuse (repeatable)")
+    args = parser.parse_args()
+    try:
+        asyncio.run(run_sink(args.host, args.port, set(args.reject)))
+    except KeyboardInterrupt:
+        print("\n👋 SMTP sink stopped")
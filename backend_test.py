@@ -8,7 +8,7 @@ import requests
 import json
 import time
 import sys
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Dict, Any, List
 
 # Configuration
@@ -178,6 +178,106 @@ class EmailPlatformTester:
             self.log_test("Email Sending", False, f"Email sending error: {str(e)}")
             return False
     
+    def test_send_email_batch(self):
+        """Test bulk email sending endpoint"""
+        try:
+            email_data = {
+                "from_email": "noreply@emailplatform.com",
+                "to": [{"email": "jane.doe@example.com", "name": "Jane Doe"}],
+                "subject": "Batch Test Email from Email Platform",
+                "text_content": "This email was sent through the batch endpoint.",
+                "tags": ["test", "batch"]
+            }
+            batch = {"emails": [email_data, email_data, {"subject": "Missing sender and recipients"}]}
+            
+            response = requests.post(
+                f"{self.base_url}/v1/emails/batch", 
+                headers=self.headers, 
+                json=batch,
+                timeout=15
+            )
+            
+            if response.status_code == 200:
+                data = response.json()
+                results = data.get("results", [])
+                if data.get("accepted") == 2 and data.get("rejected") == 1 and results[2].get("error"):
+                    self.log_test(
+                        "Batch Email Sending", 
+                        True, 
+                        f"Batch accepted {data.get('accepted')} emails and rejected {data.get('rejected')} invalid item"
+                    )
+                    return True
+                self.log_test(
+                    "Batch Email Sending", 
+                    False, 
+                    "Unexpected per-item results",
+                    {"response": data}
+                )
+                return False
+            else:
+                self.log_test(
+                    "Batch Email Sending", 
+                    False, 
+                    f"Batch sending failed with status {response.status_code}",
+                    {"response": response.text}
+                )
+                return False
+                
+        except Exception as e:
+            self.log_test("Batch Email Sending", False, f"Batch sending error: {str(e)}")
+            return False
+    
+    def test_send_scheduled_email(self):
+        """Test that a scheduled email is held and then released when due"""
+        try:
+            email_data = {
+                "from_email": "noreply@emailplatform.com",
+                "to": [{"email": "jane.doe@example.com", "name": "Jane Doe"}],
+                "subject": "Scheduled Test Email from Email Platform",
+                "text_content": "This email was scheduled a few seconds ahead.",
+                "scheduled_at": (datetime.utcnow() + timedelta(seconds=3)).isoformat(),
+                "tags": ["test", "scheduled"]
+            }
+            
+            response = requests.post(
+                f"{self.base_url}/v1/emails", 
+                headers=self.headers, 
+                json=email_data,
+                timeout=10
+            )
+            
+            if response.status_code != 200 or response.json().get("status") != "scheduled":
+                self.log_test(
+                    "Scheduled Email Sending", 
+                    False, 
+                    f"Scheduling failed with status {response.status_code}",
+                    {"response": response.text}
+                )
+                return False
+            
+            email_id = response.json()["id"]
+            time.sleep(6)
+            response = requests.get(f"{self.base_url}/v1/emails/{email_id}", headers=self.headers, timeout=10)
+            status = response.json().get("status") if response.status_code == 200 else None
+            if status in ["queued", "processing", "sent", "delivered"]:
+                self.log_test(
+                    "Scheduled Email Sending", 
+                    True, 
+                    f"Scheduled email released by the scheduler, now {status}"
+                )
+                return True
+            self.log_test(
+                "Scheduled Email Sending", 
+                False, 
+                f"Scheduled email not released, status {status}",
+                {"response": response.text}
+            )
+            return False
+                
+        except Exception as e:
+            self.log_test("Scheduled Email Sending", False, f"Scheduled sending error: {str(e)}")
+            return False
+    
     def test_get_emails_list(self):
         """Test getting list of emails"""
         try:
@@ -204,6 +304,59 @@ class EmailPlatformTester:
             self.log_test("Email List Retrieval", False, f"Email list error: {str(e)}")
             return False
     
+    def test_get_emails_cursor_pagination(self):
+        """Test keyset pagination of the email list"""
+        try:
+            first = requests.get(
+                f"{self.base_url}/v1/emails", 
+                headers={**self.headers, "Origin": "http://localhost:3000"}, 
+                params={"limit": 1}, 
+                timeout=10
+            )
+            next_cursor = first.headers.get("X-Next-Cursor")
+            if "x-next-cursor" not in first.headers.get("Access-Control-Expose-Headers", "").lower():
+                self.log_test(
+                    "Email List Cursor Pagination", 
+                    False, 
+                    "X-Next-Cursor is not exposed to browsers via CORS",
+                    {"headers": dict(first.headers)}
+                )
+                return False
+            if first.status_code != 200 or not next_cursor:
+                self.log_test(
+                    "Email List Cursor Pagination", 
+                    False, 
+                    f"First page failed with status {first.status_code} or returned no cursor",
+                    {"response": first.text}
+                )
+                return False
+            
+            second = requests.get(
+                f"{self.base_url}/v1/emails", 
+                headers=self.headers, 
+                params={"limit": 1, "cursor": next_cursor}, 
+                timeout=10
+            )
+            if second.status_code == 200 and second.json() and second.json()[0]["id"] != first.json()[0]["id"]:
+                self.log_test(
+                    "Email List Cursor Pagination", 
+                    True, 
+                    "Cursor returned the next page without repeating emails"
+                )
+                return True
+            else:
+                self.log_test(
+                    "Email List Cursor Pagination", 
+                    False, 
+                    f"Second page failed with status {second.status_code}",
+                    {"response": second.text}
+                )
+                return False
+                
+        except Exception as e:
+            self.log_test("Email List Cursor Pagination", False, f"Cursor pagination error: {str(e)}")
+            return False
+    
     def test_get_email_by_id(self):
         """Test getting specific email by ID"""
         if not self.sent_email_id:
@@ -340,6 +493,59 @@ class EmailPlatformTester:
             self.log_test("Templates Retrieval", False, f"Templates error: {str(e)}")
             return False
     
+    def test_campaign_lifecycle(self):
+        """Test campaign creation, recipient upload and fan-out"""
+        try:
+            campaign_data = {
+                "name": "Backend Test Campaign",
+                "template_id": "welcome-template-001",
+                "from_email": "noreply@emailplatform.com",
+                "from_name": "Email Platform",
+                "tags": ["test", "campaign"]
+            }
+            response = requests.post(f"{self.base_url}/v1/campaigns", headers=self.headers, json=campaign_data, timeout=10)
+            if response.status_code != 200:
+                self.log_test(
+                    "Campaign Lifecycle", 
+                    False, 
+                    f"Campaign creation failed with status {response.status_code}",
+                    {"response": response.text}
+                )
+                return False
+            campaign_id = response.json()["id"]
+            
+            recipients = {"recipients": [
+                {"email": f"campaign.user{i}@example.com", "variables": {"first_name": f"User {i}", "company_name": "Email Platform"}}
+                for i in range(3)
+            ]}
+            requests.post(f"{self.base_url}/v1/campaigns/{campaign_id}/recipients", headers=self.headers, json=recipients, timeout=10)
+            requests.post(f"{self.base_url}/v1/campaigns/{campaign_id}/start", headers=self.headers, timeout=10)
+            
+            print("   Waiting for campaign fan-out...")
+            time.sleep(3)
+            response = requests.get(f"{self.base_url}/v1/campaigns/{campaign_id}", headers=self.headers, timeout=10)
+            data = response.json()
+            
+            if response.status_code == 200 and data.get("status") == "sent" and data.get("emails_queued") == 3:
+                self.log_test(
+                    "Campaign Lifecycle", 
+                    True, 
+                    f"Campaign fanned out to {data.get('emails_queued')} recipients, {data.get('emails_sent')} sent"
+                )
+                return True
+            else:
+                self.log_test(
+                    "Campaign Lifecycle", 
+                    False, 
+                    f"Unexpected campaign state: {data.get('status')}",
+                    {"campaign": data}
+                )
+                return False
+                
+        except Exception as e:
+            self.log_test("Campaign Lifecycle", False, f"Campaign error: {str(e)}")
+            return False
+    
     def test_analytics_overview(self):
         """Test analytics overview endpoint"""
         try:
@@ -366,6 +572,113 @@ class EmailPlatformTester:
             self.log_test("Analytics Overview", False, f"Analytics error: {str(e)}")
             return False
     
+    def test_analytics_timeseries(self):
+        """Test bucketed analytics timeseries endpoint"""
+        try:
+            response = requests.get(
+                f"{self.base_url}/v1/analytics/timeseries", 
+                headers=self.headers, 
+                params={"granularity": "hour"}, 
+                timeout=10
+            )
+            
+            if response.status_code == 200:
+                data = response.json()
+                points = data.get("points", [])
+                self.log_test(
+                    "Analytics Timeseries", 
+                    True, 
+                    f"Timeseries retrieved from {data.get('source')} - {len(points)} hourly points, latest total: {points[-1]['total'] if points else 0}"
+                )
+                return True
+            else:
+                self.log_test(
+                    "Analytics Timeseries", 
+                    False, 
+                    f"Timeseries retrieval failed with status {response.status_code}",
+                    {"response": response.text}
+                )
+                return False
+                
+        except Exception as e:
+            self.log_test("Analytics Timeseries", False, f"Timeseries error: {str(e)}")
+            return False
+    
+    def test_analytics_timeseries_with_offset(self):
+        """Test that timeseries accepts a start_date with a UTC offset"""
+        try:
+            start_date = (datetime.utcnow() - timedelta(hours=6)).strftime("%Y-%m-%dT%H:%M:%S") + "+02:00"
+            response = requests.get(
+                f"{self.base_url}/v1/analytics/timeseries", 
+                headers=self.headers, 
+                params={"granularity": "hour", "start_date": start_date}, 
+                timeout=10
+            )
+            
+            if response.status_code == 200:
+                data = response.json()
+                points = data.get("points", [])
+                total = sum(point["total"] for point in points)
+                self.log_test(
+                    "Analytics Timeseries With Offset", 
+                    True, 
+                    f"Offset start_date accepted - {len(points)} hourly points, {total} emails"
+                )
+                return True
+            else:
+                self.log_test(
+                    "Analytics Timeseries With Offset", 
+                    False, 
+                    f"Timeseries with offset start_date failed with status {response.status_code}",
+                    {"response": response.text}
+                )
+                return False
+                
+        except Exception as e:
+            self.log_test("Analytics Timeseries With Offset", False, f"Timeseries with offset error: {str(e)}")
+            return False
+    
+    def test_dead_letters(self):
+        """Test dead letter listing and re-drive endpoints"""
+        try:
+            response = requests.get(f"{self.base_url}/v1/dead-letters", headers=self.headers, timeout=10)
+            if response.status_code != 200:
+                self.log_test(
+                    "Dead Letters", 
+                    False, 
+                    f"Dead letter listing failed with status {response.status_code}",
+                    {"response": response.text}
+                )
+                return False
+            dead_letters = response.json()
+            
+            response = requests.post(
+                f"{self.base_url}/v1/dead-letters/redrive", 
+                headers=self.headers, 
+                json={"email_ids": [dead_letter["id"] for dead_letter in dead_letters[:5]]},
+                timeout=10
+            )
+            if response.status_code == 200:
+                data = response.json()
+                self.log_test(
+                    "Dead Letters", 
+                    True, 
+                    f"Found {len(dead_letters)} dead letters, re-drove {data.get('redriven')}"
+                )
+                return True
+            else:
+                self.log_test(
+                    "Dead Letters", 
+                    False, 
+                    f"Dead letter re-drive failed with status {response.status_code}",
+                    {"response": response.text}
+                )
+                return False
+                
+        except Exception as e:
+            self.log_test("Dead Letters", False, f"Dead letters error: {str(e)}")
+            return False
+    
     def test_api_keys_management(self):
         """Test API keys management endpoints"""
         try:
@@ -404,11 +717,18 @@ class EmailPlatformTester:
             self.test_api_authentication_valid,
             self.test_api_authentication_invalid,
             self.test_send_email,
+            self.test_send_email_batch,
+            self.test_send_scheduled_email,
             self.test_get_emails_list,
+            self.test_get_emails_cursor_pagination,
             self.test_get_email_by_id,
             self.test_queue_processing,
             self.test_templates_endpoint,
+            self.test_campaign_lifecycle,
             self.test_analytics_overview,
+            self.test_analytics_timeseries,
+            self.test_analytics_timeseries_with_offset,
+            self.test_dead_letters,
             self.test_api_keys_management
         ]
         
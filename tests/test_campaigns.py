@@ -0,0 +1,27 @@
+import asyncio
+
+import server
+
+
+def test_rerun_chunk_enqueues_emails_stranded_by_a_crash(db, monkeypatch):
+    monkeypatch.setattr(server, "quota_manager", server.QuotaManager(block_size=0))
+    template = server.EmailTemplate(user_id="u1", name="t", subject="Hi {{name}}", html_content="<p>{{email}}</p>")
+    campaign = server.EmailCampaign(user_id="u1", name="c", from_email="a@example.com", status="sending")
+    recipients = [{"seq": seq, "email": f"r{seq}@example.com"} for seq in range(1, 4)]
+
+    async def scenario():
+        await db.email_logs.create_index("id", unique=True)
+        await db.users.insert_one({"id": "u1", "email_quota": 100, "emails_sent_this_month": 0})
+        compiled = server.CompiledEmailTemplate(template)
+        await server.campaign_engine._send_chunk(campaign, compiled, recipients)
+        # Crash between insert_many and enqueue_many: the emails exist, their jobs don't
+        await db.email_queue.delete_many({})
+        await db.email_logs.update_one({"recipients.email": "r1@example.com"}, {"$set": {"status": "sent"}})
+        await server.campaign_engine._send_chunk(campaign, compiled, recipients)
+        return sorted(job["_id"] for job in await db.email_queue.find().to_list(None))
+
+    queued = asyncio.run(scenario())
+    expected = sorted(
+        str(server.uuid.uuid5(server.uuid.NAMESPACE_URL, f"campaign:{campaign.id}:{seq}")) for seq in (2, 3)
+    )
+    assert queued == expected
@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+def failed_email(**fields):
+    return server.EmailLog(
+        user_id="u1", from_email="a@example.com", recipients=[{"email": "b@example.com"}],
+        subject="hi", text_content="hi", status=server.EmailStatus.FAILED, attempts=3, **fields,
+    )
+
+
+def test_redrive_enqueues_before_flipping_status(db, monkeypatch):
+    monkeypatch.setattr(server, "rollup_writer", server.RollupWriter())
+    monkeypatch.setattr(server, "status_writer", server.StatusWriter())
+
+    async def send_email(email_log):
+        return {"success": True, "provider": server.EmailProvider.SMTP, "provider_message_id": "m1"}
+
+    monkeypatch.setattr(server.email_service, "send_email", send_email)
+    email_log = failed_email()
+    update_many = type(db.email_logs).update_many
+    calls = {"n": 0}
+
+    async def crashing_update_many(collection, *args, **kwargs):
+        calls["n"] += 1
+        if calls["n"] == 2:
+            raise ConnectionError("crashed before the status flip")
+        return await update_many(collection, *args, **kwargs)
+
+    async def scenario():
+        await db.email_logs.insert_one(email_log.dict())
+        await server.dead_letter_queue.add(email_log, "permanent_error", "boom", 3)
+        with monkeypatch.context() as patch:
+            patch.setattr(type(db.email_logs), "update_many", crashing_update_many)
+            with pytest.raises(ConnectionError):
+                await server.DeadLetterQueue().redrive("u1")
+        job = await server.email_queue.claim()
+        sent = await server.process_email(job["email_id"], job=job)
+        await server.status_writer.flush()
+        return job, sent, await db.email_logs.find_one({"id": email_log.id})
+
+    job, sent, email_doc = asyncio.run(scenario())
+    assert job["email_id"] == email_log.id
+    assert sent is True
+    assert email_doc["status"] == server.EmailStatus.SENT
+    assert email_doc["attempts"] == 0
+    for increments in server.rollup_writer._deltas.values():
+        moved = {field: delta for field, delta in increments.items() if delta}
+        assert moved == {"counts.failed": -1, "counts.sent": 1}
+
+
+def test_stale_job_of_failed_email_is_skipped(db):
+    email_log = failed_email()
+
+    async def scenario():
+        await db.email_logs.insert_one(email_log.dict())
+        await server.email_queue.enqueue(email_log.id)
+        job = await server.email_queue.claim()
+        return await server.process_email(job["email_id"], job=job)
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_redrive_clears_only_redriven_dead_letters(db, monkeypatch):
+    monkeypatch.setattr(server, "rollup_writer", server.RollupWriter())
+    failed = failed_email()
+    sent = failed_email()
+    sent.status = server.EmailStatus.SENT
+
+    async def scenario():
+        await db.email_logs.insert_many([failed.dict(), sent.dict()])
+        for email_log in (failed, sent):
+            await server.dead_letter_queue.add(email_log, "permanent_error", "boom", 3)
+        redriven = await server.DeadLetterQueue().redrive("u1")
+        remaining = await db.dead_letters.find({}, {"_id": 0, "id": 1}).to_list(10)
+        return redriven, remaining, await db.email_logs.find_one({"id": failed.id})
+
+    redriven, remaining, email_doc = asyncio.run(scenario())
+    assert redriven == [failed.id]
+    assert remaining == [{"id": sent.id}]
+    assert email_doc["status"] == server.EmailStatus.QUEUED
@@ -0,0 +1,93 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import server
+
+
+def test_enqueue_is_idempotent_per_email(db):
+    async def scenario():
+        queue = server.MongoEmailQueue()
+        await queue.enqueue("email-1")
+        await queue.enqueue_many(["email-1", "email-2"])
+        return await queue.size()
+
+    assert asyncio.run(scenario()) == 2
+
+
+def test_claimed_job_is_invisible_until_acked(db):
+    async def scenario():
+        queue = server.MongoEmailQueue()
+        await queue.enqueue("email-1")
+        job = await queue.claim()
+        second = await queue.claim()
+        await queue.ack(job)
+        return job, second, await db.email_queue.count_documents({}), queue._held
+
+    job, second, remaining, held = asyncio.run(scenario())
+    assert job["email_id"] == "email-1" and job["deliveries"] == 1
+    assert second is None
+    assert remaining == 0 and held == {}
+
+
+def test_release_delays_visibility(db):
+    async def scenario():
+        queue = server.MongoEmailQueue()
+        await queue.enqueue("email-1")
+        await queue.release(await queue.claim(), delay=60)
+        return await queue.claim(), queue.reclaimed
+
+    assert asyncio.run(scenario()) == (None, 0)
+
+
+def test_expired_lease_is_reclaimed_and_stale_ack_is_ignored(db):
+    async def scenario():
+        crashed = server.MongoEmailQueue()
+        survivor = server.MongoEmailQueue()
+        await crashed.enqueue("email-1")
+        stale = await crashed.claim()
+        # The owner stops heartbeating and its lease runs out
+        await db.email_queue.update_one({"_id": "email-1"}, {"$set": {"visible_at": datetime.utcnow() - timedelta(seconds=1)}})
+        job = await survivor.claim()
+        await crashed.ack(stale)
+        still_queued = await db.email_queue.count_documents({})
+        await survivor.ack(job)
+        return job, survivor.reclaimed, still_queued, await db.email_queue.count_documents({})
+
+    job, reclaimed, still_queued, remaining = asyncio.run(scenario())
+    assert job["deliveries"] == 2 and reclaimed == 1
+    assert still_queued == 1 and remaining == 0
+
+
+def test_heartbeat_extends_held_leases(db):
+    async def scenario():
+        queue = server.MongoEmailQueue(lease_seconds=60)
+        await queue.enqueue("email-1")
+        job = await queue.claim()
+        await db.email_queue.update_one({"_id": "email-1"}, {"$set": {"visible_at": datetime.utcnow() + timedelta(seconds=1)}})
+        await queue.heartbeat()
+        return job, (await db.email_queue.find_one({"_id": "email-1"}))["visible_at"]
+
+    job, visible_at = asyncio.run(scenario())
+    assert visible_at > datetime.utcnow() + timedelta(seconds=30)
+
+
+def test_sweep_requeues_only_stranded_emails(db):
+    old = datetime.utcnow() - timedelta(hours=1)
+    emails = [
+        {"id": "stranded", "status": server.EmailStatus.QUEUED, "created_at": old},
+        {"id": "has-job", "status": server.EmailStatus.QUEUED, "created_at": old},
+        {"id": "just-inserted", "status": server.EmailStatus.QUEUED, "created_at": datetime.utcnow()},
+        {"id": "sent", "status": server.EmailStatus.SENT, "created_at": old},
+    ]
+
+    async def scenario():
+        queue = server.MongoEmailQueue()
+        await db.email_logs.insert_many(emails)
+        await queue.enqueue("has-job")
+        requeued = await queue.requeue_stranded()
+        jobs = await db.email_queue.find({}, {"_id": 1}).to_list(10)
+        return requeued, sorted(job["_id"] for job in jobs)
+
+    requeued, jobs = asyncio.run(scenario())
+    assert requeued == 1
+    assert jobs == ["has-job", "stranded"]
@@ -0,0 +1,70 @@
+import asyncio
+
+import server
+
+
+def make_email():
+    return server.EmailLog(
+        user_id="u1", from_email="a@example.com", recipients=[{"email": "b@example.com"}],
+        subject="hi", text_content="hi",
+    )
+
+
+def test_local_payload_is_handed_to_first_delivery_only(db):
+    email_log = make_email()
+
+    async def scenario():
+        queue = server.MongoEmailQueue()
+        await queue.enqueue(email_log.id, payload=email_log)
+        first = await queue.claim()
+        await queue.release(first)
+        return first, await queue.claim()
+
+    first, second = asyncio.run(scenario())
+    assert first["payload"] is email_log
+    assert second.get("payload") is None and second["deliveries"] == 2
+
+
+def test_job_from_another_node_has_no_payload(db):
+    email_log = make_email()
+
+    async def scenario():
+        queue = server.MongoEmailQueue()
+        await queue.enqueue(email_log.id, payload=email_log)
+        await db.email_queue.update_one({"_id": email_log.id}, {"$set": {"enqueued_by": "other-node"}})
+        return await queue.claim()
+
+    assert asyncio.run(scenario()).get("payload") is None
+
+
+def test_payload_is_sent_without_reading_the_email_back(db, monkeypatch):
+    monkeypatch.setattr(server, "rollup_writer", server.RollupWriter())
+    monkeypatch.setattr(server, "status_writer", server.StatusWriter())
+    sent = []
+
+    async def send_email(email_log):
+        sent.append(email_log)
+        return {"success": True, "provider": server.EmailProvider.SMTP, "provider_message_id": "m1"}
+
+    async def no_reads(collection, *args, **kwargs):
+        raise AssertionError("email_logs was read on the local fast path")
+
+    monkeypatch.setattr(server.email_service, "send_email", send_email)
+    email_log = make_email()
+
+    async def scenario():
+        await db.email_logs.insert_one(email_log.dict())
+        await server.email_queue.enqueue(email_log.id, payload=email_log)
+        job = await server.email_queue.claim()
+        with monkeypatch.context() as patch:
+            patch.setattr(type(db.email_logs), "find_one", no_reads)
+            patch.setattr(type(db.email_logs), "find_one_and_update", no_reads)
+            result = await server.process_email(job["email_id"], job["payload"], job)
+        await server.status_writer.flush()
+        return result, await db.email_logs.find_one({"id": email_log.id})
+
+    result, email_doc = asyncio.run(scenario())
+    assert result is True
+    assert sent == [email_log]
+    assert email_doc["status"] == server.EmailStatus.SENT
+    assert server.status_writer.stats["writes"] == 1
@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def guard(monkeypatch):
+    monkeypatch.setattr(server, "PROVIDER_INITIAL_CONCURRENCY", 4.0)
+    monkeypatch.setattr(server, "PROVIDER_MIN_CONCURRENCY", 1.0)
+    monkeypatch.setattr(server, "PROVIDER_MAX_CONCURRENCY", 8.0)
+    monkeypatch.setattr(server, "PROVIDER_LATENCY_TARGET_SECONDS", 60.0)
+    monkeypatch.setattr(server, "PROVIDER_BACKOFF_FACTOR", 0.5)
+    monkeypatch.setattr(server, "PROVIDER_BREAKER_FAILURES", 3)
+    monkeypatch.setattr(server, "PROVIDER_BREAKER_COOLDOWN_SECONDS", 60.0)
+    return server.ProviderGuard("test")
+
+
+async def send(guard, ok=True, latency=0.01):
+    probe = await guard.acquire()
+    await guard.release(latency, ok, probe)
+    return probe
+
+
+def test_window_grows_additively_and_halves_once_per_interval(guard):
+    async def scenario():
+        for _ in range(4):
+            await send(guard)
+        grown = guard.limit
+        for _ in range(2):
+            await send(guard, ok=False)
+        return grown, guard.limit
+
+    grown, backed_off = asyncio.run(scenario())
+    assert grown == pytest.approx(5.0, abs=0.1)
+    # Both errors land within one target interval, so the window halves once
+    assert backed_off == pytest.approx(grown / 2)
+
+
+def test_slow_sends_shrink_the_window(guard):
+    asyncio.run(send(guard, latency=120))
+    assert guard.limit == 2.0
+    assert guard.stats["slow"] == 1
+
+
+def test_window_caps_concurrent_sends(guard, monkeypatch):
+    monkeypatch.setattr(guard, "limit", 2.0)
+
+    async def scenario():
+        await guard.acquire()
+        await guard.acquire()
+        third = asyncio.create_task(guard.acquire())
+        await asyncio.sleep(0.01)
+        waited = not third.done()
+        await guard.release(0.01, True, False)
+        await asyncio.wait_for(third, timeout=1)
+        return waited
+
+    assert asyncio.run(scenario()) is True
+
+
+def test_breaker_trips_and_fails_fast(guard):
+    async def scenario():
+        for _ in range(3):
+            await send(guard, ok=False)
+        with pytest.raises(server.ProviderUnavailableError):
+            await guard.acquire()
+
+    asyncio.run(scenario())
+    assert guard.state == server.BreakerState.OPEN
+    assert not guard.available()
+    assert guard.stats["breaker_trips"] == 1 and guard.stats["rejected"] == 1
+    assert guard.in_flight == 0
+
+
+def test_half_open_lets_one_probe_through_and_recovers(guard):
+    async def scenario():
+        for _ in range(3):
+            await send(guard, ok=False)
+        guard._open_until = 0  # Cooldown over
+        assert guard.available()
+        probe = await guard.acquire()
+        assert probe is True and guard.state == server.BreakerState.HALF_OPEN
+        # Only the probe gets through until it reports back
+        assert not guard.available()
+        with pytest.raises(server.ProviderUnavailableError):
+            await guard.acquire()
+        await guard.release(0.01, True, probe)
+
+    asyncio.run(scenario())
+    assert guard.state == server.BreakerState.CLOSED
+    assert guard.consecutive_failures == 0
+    assert guard.available()
+
+
+def test_failed_probe_reopens_the_breaker(guard):
+    async def scenario():
+        for _ in range(3):
+            await send(guard, ok=False)
+        guard._open_until = 0
+        return await send(guard, ok=False)
+
+    assert asyncio.run(scenario()) is True
+    assert guard.state == server.BreakerState.OPEN
+    assert not guard.available()
+    assert guard.stats["breaker_trips"] == 2
@@ -0,0 +1,67 @@
+import asyncio
+
+import server
+
+
+async def seed_user(db, quota=1000, used=0):
+    await db.users.insert_one({"id": "u1", "email_quota": quota, "emails_sent_this_month": used})
+
+
+async def used(db):
+    return (await db.users.find_one({"id": "u1"}))["emails_sent_this_month"]
+
+
+def test_concurrent_reservations_never_exceed_quota(db):
+    async def scenario():
+        await seed_user(db, quota=100)
+        quota = server.QuotaManager(block_size=30)
+        grants = await asyncio.gather(*[quota.reserve("u1") for _ in range(150)])
+        await quota.stop()
+        return sum(grants), await used(db)
+
+    assert asyncio.run(scenario()) == (100, 100)
+
+
+def test_block_is_capped_at_a_fraction_of_remaining_quota(db):
+    async def scenario():
+        await seed_user(db, quota=1000)
+        quota = server.QuotaManager(block_size=500, block_fraction=0.1)
+        await quota.reserve("u1")  # learns how much is left
+        await quota.reserve("u1")  # tops up with a capped block
+        return await used(db), quota.unused("u1")
+
+    assert asyncio.run(scenario()) == (1 + 99, 98)
+
+
+def test_release_idle_returns_unused_block(db):
+    async def scenario():
+        await seed_user(db, quota=1000)
+        quota = server.QuotaManager(block_size=50, block_fraction=1)
+        await quota.reserve("u1")
+        await quota.reserve("u1")
+        await quota.release_idle(idle_seconds=-1)
+        return await used(db), quota.unused("u1"), quota._locks
+
+    assert asyncio.run(scenario()) == (2, 0, {})
+
+
+def test_release_idle_keeps_lock_while_reservation_waits(db):
+    async def scenario():
+        await seed_user(db, quota=1000)
+        quota = server.QuotaManager(block_size=50, block_fraction=1)
+        await quota.reserve("u1")
+        lock = quota._locks["u1"]
+        async with quota._user_lock("u1"):
+            # Idle blocks get returned while a reservation queues up behind them
+            releaser = asyncio.create_task(quota.release_idle(idle_seconds=-1))
+            await asyncio.sleep(0)
+            waiter = asyncio.create_task(quota.reserve("u1"))
+            await asyncio.sleep(0)
+        await releaser
+        # The waiter still relies on the lock, so nobody may get a fresh one
+        current = quota._locks.get("u1")
+        await waiter
+        return lock, current
+
+    lock, current = asyncio.run(scenario())
+    assert current is lock
@@ -0,0 +1,89 @@
+import asyncio
+
+import server
+
+
+def make_principals(plan="free", rate=None, burst=None):
+    user = server.User(id="u1", email="a@example.com", name="n", password_hash="x", plan_type=plan)
+    api_key = server.ApiKey(id="k1", user_id="u1", name="k", key_hash="h",
+                            rate_limit_per_second=rate, rate_limit_burst=burst)
+    return api_key, user
+
+
+def test_burst_then_limited_with_retry_after():
+    limiter = server.RateLimiter(shared=False)
+    api_key, user = make_principals()
+    rate, burst = server.PLAN_RATE_LIMITS["free"]
+    results = [limiter.check(api_key, user) for _ in range(burst + 1)]
+    assert all(allowed for allowed, _ in results[:burst])
+    allowed, headers = results[-1]
+    assert not allowed
+    assert headers["X-RateLimit-Limit"] == str(burst)
+    assert headers["X-RateLimit-Remaining"] == "0"
+    assert int(headers["Retry-After"]) >= 1
+
+
+def test_tokens_refill_over_time():
+    limiter = server.RateLimiter(shared=False)
+    api_key, user = make_principals()
+    for _ in range(server.PLAN_RATE_LIMITS["free"][1]):
+        limiter.check(api_key, user)
+    for bucket in limiter._buckets.values():
+        bucket.updated -= 1  # a second passes
+    assert limiter.check(api_key, user)[0]
+
+
+def test_api_key_limit_applies_below_plan_limit():
+    limiter = server.RateLimiter(shared=False)
+    api_key, user = make_principals(plan="pro", rate=1, burst=2)
+    assert [limiter.check(api_key, user)[0] for _ in range(3)] == [True, True, False]
+
+
+def test_prune_drops_only_idle_full_buckets():
+    limiter = server.RateLimiter(shared=False)
+    api_key, user = make_principals()
+    limiter.check(api_key, user)
+    limiter.prune()
+    assert len(limiter._buckets) == 2
+    for bucket in limiter._buckets.values():
+        bucket.updated -= 100
+    limiter.prune()
+    assert limiter._buckets == {}
+
+
+def test_shared_sync_drains_other_processes_hits(db):
+    api_key, user = make_principals()
+
+    async def scenario():
+        mine, other = server.RateLimiter(shared=True), server.RateLimiter(shared=True)
+        for _ in range(5):
+            other.check(api_key, user)
+        await other.sync()
+        mine.check(api_key, user)
+        await mine.sync()
+        return mine._buckets["user:u1"]
+
+    bucket = asyncio.run(scenario())
+    burst = server.PLAN_RATE_LIMITS["free"][1]
+    assert burst - 6 - 0.5 < bucket.tokens <= burst - 6 + 0.5
+    assert bucket.others_seen == 5
+
+
+def test_shared_prune_keeps_current_window_bookkeeping(db):
+    api_key, user = make_principals()
+    burst = server.PLAN_RATE_LIMITS["free"][1]
+
+    async def scenario():
+        limiter = server.RateLimiter(shared=True)
+        for _ in range(burst):
+            limiter.check(api_key, user)
+        await limiter.sync()
+        for bucket in limiter._buckets.values():
+            bucket.updated -= 100
+        limiter.prune()
+        # Our own earlier hits must not come back as another process's traffic
+        allowed, _ = limiter.check(api_key, user)
+        await limiter.sync()
+        return allowed, limiter._buckets["user:u1"].others_seen
+
+    assert asyncio.run(scenario()) == (True, 0)
@@ -0,0 +1,36 @@
+import asyncio
+from datetime import datetime
+
+from pymongo.errors import BulkWriteError
+
+import server
+
+
+def test_failed_flush_merges_back_only_failed_ops(db, monkeypatch):
+    async def partial_bulk_write(collection, operations, ordered=True):
+        raise BulkWriteError({"writeErrors": [{"index": 1, "code": 11000, "errmsg": "dup"}]})
+
+    monkeypatch.setattr(type(db.analytics_rollups), "bulk_write", partial_bulk_write)
+    writer = server.RollupWriter()
+    writer.record_status_move("u1", datetime(2024, 1, 1, 10, 30), server.EmailStatus.QUEUED, server.EmailStatus.SENT)
+    doc_ids = list(writer._deltas)
+
+    asyncio.run(writer.flush())
+    assert list(writer._deltas) == [doc_ids[1]]
+    assert writer._deltas[doc_ids[1]] == {"counts.queued": -1, "counts.sent": 1}
+
+
+def test_process_email_skips_emails_no_longer_queued(db, monkeypatch):
+    monkeypatch.setattr(server, "rollup_writer", server.RollupWriter())
+    email_log = server.EmailLog(
+        user_id="u1", api_key_id="k1", from_email="a@example.com",
+        recipients=[{"email": "b@example.com"}], subject="hi", text_content="hi",
+        status=server.EmailStatus.SENT,
+    )
+
+    async def scenario():
+        await db.email_logs.insert_one(email_log.dict())
+        return await server.process_email(email_log.id)
+
+    assert asyncio.run(scenario()) is None
+    assert server.rollup_writer._deltas == {}
@@ -0,0 +1,142 @@
+import asyncio
+
+import server
+
+
+def test_preferences_use_their_own_cache(db, monkeypatch):
+    monkeypatch.setattr(server, "provider_preference_cache", server.TTLCache())
+    auth_lookups = server.user_cache.hits + server.user_cache.misses
+
+    async def scenario():
+        await db.users.insert_one({"id": "u1", "preferred_providers": ["sendgrid"]})
+        router = server.ProviderRouter()
+        return [await router.preferences("u1") for _ in range(2)]
+
+    assert asyncio.run(scenario()) == [[server.EmailProvider.SENDGRID]] * 2
+    assert server.provider_preference_cache.get_stats()["hits"] == 1
+    assert server.user_cache.hits + server.user_cache.misses == auth_lookups
+
+
+def test_preference_lookup_failure_is_a_retryable_result(db, monkeypatch):
+    async def failing_preferences(user_id):
+        raise ConnectionError("mongo is down")
+
+    service = server.EmailService()
+    monkeypatch.setattr(service.router, "preferences", failing_preferences)
+    email_log = server.EmailLog(
+        user_id="u1", from_email="a@example.com", recipients=[{"email": "b@example.com"}], subject="hi",
+    )
+
+    result = asyncio.run(service.send_email(email_log))
+    assert result["success"] is False
+    assert result["retryable"] is True
+
+
+def test_only_5xx_refusals_are_permanent(db, monkeypatch):
+    async def no_preferences(user_id):
+        return []
+
+    service = server.EmailService()
+    monkeypatch.setattr(service.router, "preferences", no_preferences)
+    email_log = server.EmailLog(
+        user_id="u1", from_email="a@example.com", recipients=[{"email": "b@example.com"}], subject="hi",
+    )
+
+    def refusing(code):
+        async def send(email_log):
+            raise server.SmtpDeliveryError("refused", {"b@example.com": code})
+        return send
+
+    results = {}
+    for code in (450, 550):
+        service.register(server.EmailProvider.SMTP, refusing(code))
+        results[code] = asyncio.run(service.send_email(email_log))
+    assert results[450]["retryable"] is True
+    assert results[550]["retryable"] is False
+
+    greylisted = server.aiosmtplib.SMTPRecipientsRefused([
+        server.aiosmtplib.SMTPRecipientRefused(450, "4.2.0 Greylisted", "b@example.com"),
+    ])
+    assert not server.is_permanent_error(greylisted)
+
+
+SMTP, SENDGRID, AWS_SES = server.EmailProvider.SMTP, server.EmailProvider.SENDGRID, server.EmailProvider.AWS_SES
+
+
+def make_guards(latencies):
+    guards = {}
+    for provider, latency in latencies.items():
+        guards[provider] = server.ProviderGuard(provider.value)
+        guards[provider].latency_ewma = latency
+    return guards
+
+
+def trip(guard, monkeypatch):
+    monkeypatch.setattr(server, "PROVIDER_BREAKER_FAILURES", 1)
+
+    async def fail():
+        probe = await guard.acquire()
+        await guard.release(0.01, False, probe)
+
+    asyncio.run(fail())
+
+
+def test_route_puts_healthy_preferences_first():
+    router = server.ProviderRouter({SMTP: 1.0, SENDGRID: 1.0, AWS_SES: 1.0})
+    guards = make_guards({SMTP: 0.01, SENDGRID: 0.01, AWS_SES: 0.01})
+    for _ in range(20):
+        route = router.route(guards, [AWS_SES, SENDGRID])
+        assert route[:2] == [AWS_SES, SENDGRID]
+        assert sorted(route) == sorted([SMTP, SENDGRID, AWS_SES])
+
+
+def test_route_leans_toward_fast_reliable_providers(monkeypatch):
+    monkeypatch.setattr(server.random, "uniform", server.random.Random(0).uniform)
+    router = server.ProviderRouter({SMTP: 1.0, SENDGRID: 1.0})
+    guards = make_guards({SMTP: 0.05, SENDGRID: 0.5})
+    guards[SENDGRID].error_ewma = 0.5
+    firsts = [router.route(guards, [])[0] for _ in range(500)]
+    assert firsts.count(SMTP) > 450
+    # The slow provider still gets some traffic, so its recovery gets noticed
+    assert firsts.count(SENDGRID) > 0
+
+
+def test_route_puts_open_breakers_last_even_when_preferred(monkeypatch):
+    router = server.ProviderRouter({SMTP: 1.0, SENDGRID: 1.0, AWS_SES: 1.0})
+    guards = make_guards({SMTP: 0.01, SENDGRID: 0.01, AWS_SES: 0.01})
+    trip(guards[SENDGRID], monkeypatch)
+    for _ in range(20):
+        route = router.route(guards, [SENDGRID])
+        assert route[-1] == SENDGRID
+
+
+def test_route_is_capped_at_max_attempts(monkeypatch):
+    monkeypatch.setattr(server, "EMAIL_ROUTE_MAX_ATTEMPTS", 2)
+    router = server.ProviderRouter({SMTP: 1.0, SENDGRID: 1.0, AWS_SES: 1.0})
+    assert len(router.route(make_guards({SMTP: 0.01, SENDGRID: 0.01, AWS_SES: 0.01}), [])) == 2
+
+
+def test_send_email_fails_over_on_provider_errors(monkeypatch):
+    async def no_preferences(user_id):
+        return [SMTP]
+
+    async def down(email_log):
+        raise ConnectionError("relay down")
+
+    async def up(email_log):
+        return {"message_id": "m1"}
+
+    service = server.EmailService()
+    service.router = server.ProviderRouter({SMTP: 1.0, SENDGRID: 1.0})
+    monkeypatch.setattr(service.router, "preferences", no_preferences)
+    service.register(SMTP, down)
+    service.register(SENDGRID, up)
+    email_log = server.EmailLog(
+        user_id="u1", from_email="a@example.com", recipients=[{"email": "b@example.com"}], subject="hi",
+    )
+
+    result = asyncio.run(service.send_email(email_log))
+    assert result["success"] is True
+    assert result["provider"] == SENDGRID
+    assert service.router.stats["failovers"] == 1
+    assert service.guards[SMTP].stats["failed"] == 1
@@ -0,0 +1,67 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import server
+
+
+def test_release_enqueues_before_flipping_status(db, monkeypatch):
+    monkeypatch.setattr(server, "rollup_writer", server.RollupWriter())
+    monkeypatch.setattr(server, "status_writer", server.StatusWriter())
+
+    async def send_email(email_log):
+        return {"success": True, "provider": server.EmailProvider.SMTP, "provider_message_id": "m1"}
+
+    monkeypatch.setattr(server.email_service, "send_email", send_email)
+    email_log = server.EmailLog(
+        user_id="u1", from_email="a@example.com", recipients=[{"email": "b@example.com"}],
+        subject="hi", text_content="hi", status=server.EmailStatus.SCHEDULED, scheduled_at=datetime.utcnow(),
+    )
+
+    async def crashing_update_many(collection, *args, **kwargs):
+        raise ConnectionError("crashed before the status flip")
+
+    async def scenario():
+        await db.email_logs.insert_one(email_log.dict())
+        with monkeypatch.context() as patch:
+            patch.setattr(type(db.email_logs), "update_many", crashing_update_many)
+            with pytest.raises(ConnectionError):
+                await server.EmailScheduler().release([email_log.id])
+        job = await server.email_queue.claim()
+        # A worker that gets the job before the flip still sends the email
+        return job, await server.process_email(job["email_id"], job=job)
+
+    job, sent = asyncio.run(scenario())
+    assert job["email_id"] == email_log.id
+    assert sent is True
+    # The worker took the flip over, so the email leaves SCHEDULED exactly once
+    for increments in server.rollup_writer._deltas.values():
+        moved = {field: delta for field, delta in increments.items() if delta}
+        assert moved == {"counts.scheduled": -1, "counts.sent": 1}
+
+
+def test_unscheduled_request_must_send_immediately():
+    with pytest.raises(server.ValidationError):
+        server.SendEmailRequest(
+            from_email="a@example.com", to=[{"email": "b@example.com"}], subject="hi", send_immediately=False,
+        )
+
+
+def test_past_due_send_is_queued_whatever_send_immediately_says(db, monkeypatch):
+    monkeypatch.setattr(server, "rollup_writer", server.RollupWriter())
+    user = server.User(email="u@example.com", password_hash="x", name="u")
+    api_key = server.ApiKey(user_id=user.id, name="k")
+    request = server.SendEmailRequest(
+        from_email="a@example.com", to=[{"email": "b@example.com"}], subject="hi",
+        send_immediately=False, scheduled_at=datetime(2020, 1, 1),
+    )
+
+    async def scenario():
+        await db.users.insert_one(user.dict())
+        response = await server.send_email(request, None, api_key, user)
+        return response, await server.email_queue.claim()
+
+    response, job = asyncio.run(scenario())
+    assert response.status == server.EmailStatus.QUEUED
+    assert job["email_id"] == response.id
@@ -0,0 +1,101 @@
+import asyncio
+
+import aiosmtplib
+import pytest
+
+import server
+
+
+class RecordingPool:
+    def __init__(self, replies=None, error=None):
+        self.transactions = []
+        self.replies = replies or {}
+        self.error = error
+
+    async def send(self, message, sender, recipients):
+        self.transactions.append(recipients)
+        if self.error is not None:
+            raise self.error
+        return {address: self.replies[address] for address in recipients if address in self.replies}
+
+
+def make_email(bcc):
+    return server.EmailLog(
+        user_id="u1", from_email="a@example.com", subject="hi", text_content="hi",
+        recipients=[{"email": "list@example.com"}, {"email": bcc, "type": "bcc"}],
+    )
+
+
+def test_stop_dispatches_open_groups_and_waits(monkeypatch):
+    pool = RecordingPool()
+    monkeypatch.setattr(server.smtp_pools, "get", lambda *relay: pool)
+
+    async def scenario():
+        dispatcher = server.SmtpDispatcher(window=60)
+        sends = [asyncio.create_task(dispatcher.send(make_email(f"b{i}@example.com"))) for i in range(3)]
+        await asyncio.sleep(0)
+        await dispatcher.stop()
+        return await asyncio.gather(*sends), dispatcher.get_stats()
+
+    results, stats = asyncio.run(scenario())
+    assert [result["transaction_messages"] for result in results] == [3, 3, 3]
+    assert len(pool.transactions) == 1
+    assert stats["dispatching"] == 0 and stats["open_groups"] == 0
+
+
+def test_distinct_to_headers_do_not_coalesce():
+    first = make_email("b@example.com")
+    second = first.model_copy(update={"recipients": [server.EmailRecipient(email="other@example.com")]})
+    assert server.SmtpDispatcher.content_key(first) != server.SmtpDispatcher.content_key(second)
+
+
+def make_direct_email(*addresses):
+    return server.EmailLog(
+        user_id="u1", from_email="a@example.com", subject="hi", text_content="hi",
+        recipients=[{"email": address} for address in addresses],
+    )
+
+
+def test_relay_transactions_are_split_at_max_recipients(monkeypatch):
+    pool = RecordingPool()
+    monkeypatch.setattr(server.smtp_pools, "get", lambda *relay: pool)
+    email_log = make_direct_email(*(f"r{i}@example.com" for i in range(5)))
+
+    async def scenario():
+        return await server.SmtpDispatcher(window=0, max_recipients=2).send(email_log)
+
+    asyncio.run(scenario())
+    assert [len(recipients) for recipients in pool.transactions] == [2, 2, 1]
+
+
+def test_greylisted_recipient_fails_the_email_retryably(monkeypatch):
+    pool = RecordingPool(replies={
+        "grey@example.com": aiosmtplib.SMTPResponse(450, "4.2.0 Greylisted"),
+        "gone@example.com": aiosmtplib.SMTPResponse(550, "5.1.1 Mailbox unavailable"),
+    })
+    monkeypatch.setattr(server.smtp_pools, "get", lambda *relay: pool)
+
+    async def scenario(*addresses):
+        return await server.SmtpDispatcher(window=0).send(make_direct_email(*addresses))
+
+    with pytest.raises(server.SmtpDeliveryError) as greylisted:
+        asyncio.run(scenario("ok@example.com", "grey@example.com"))
+    assert greylisted.value.codes == {"grey@example.com": 450}
+    assert not greylisted.value.permanent
+
+    result = asyncio.run(scenario("ok@example.com", "gone@example.com"))
+    assert result["refused_recipients"] == {"gone@example.com": "5.1.1 Mailbox unavailable"}
+
+
+def test_unreachable_relay_fails_the_email_retryably(monkeypatch):
+    pools = {"up": RecordingPool(), "down": RecordingPool(error=ConnectionRefusedError("relay down"))}
+    monkeypatch.setattr(server, "relay_for", lambda address: (address.split("@")[1].split(".")[0], 25))
+    monkeypatch.setattr(server.smtp_pools, "get", lambda hostname, port: pools[hostname])
+
+    async def scenario():
+        return await server.SmtpDispatcher(window=0).send(make_direct_email("a@up.example", "b@down.example"))
+
+    with pytest.raises(server.SmtpDeliveryError) as undelivered:
+        asyncio.run(scenario())
+    assert undelivered.value.codes == {"b@down.example": None}
+    assert not undelivered.value.permanent
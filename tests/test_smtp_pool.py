@@ -0,0 +1,129 @@
+import asyncio
+import socket
+from email import message_from_bytes
+
+import aiosmtplib
+import pytest
+from aiosmtpd.controller import Controller
+
+import server
+from smtp_sink import SinkHandler
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class DroppingSinkHandler(SinkHandler):
+    """Accepts the message, then drops the connection before replying to DATA"""
+
+    async def handle_DATA(self, server, session, envelope):
+        await super().handle_DATA(server, session, envelope)
+        server.transport.close()
+        return "250 OK"
+
+
+@pytest.fixture
+def sink():
+    handler = SinkHandler(reject={"bad@example.com"})
+    controller = Controller(handler, hostname="127.0.0.1", port=free_port())
+    controller.start()
+    yield handler, controller
+    controller.stop()
+
+
+def make_message(subject="hi"):
+    message = server.EmailMessage()
+    message["From"] = "a@example.com"
+    message["To"] = "b@example.com"
+    message["Subject"] = subject
+    message.set_content("hello")
+    return message
+
+
+def test_pool_delivers_over_one_reused_connection(sink):
+    handler, controller = sink
+    pool = server.SmtpConnectionPool("127.0.0.1", controller.port, size=1)
+
+    async def scenario():
+        refused = [await pool.send(make_message(), "a@example.com", ["b@example.com"]) for _ in range(3)]
+        partly = await pool.send(make_message(), "a@example.com", ["b@example.com", "bad@example.com"])
+        await pool.close()
+        return refused, partly
+
+    refused, partly = asyncio.run(scenario())
+    assert refused == [{}, {}, {}]
+    assert list(partly) == ["bad@example.com"]
+    assert handler.messages == 4
+    assert len(handler.sessions) == 1
+    assert pool.stats["connections_opened"] == 1 and pool.stats["reused"] == 3
+
+
+def test_pool_recovers_after_server_drops_connection():
+    handler = SinkHandler(reject=set())
+    port = free_port()
+    controllers = [Controller(handler, hostname="127.0.0.1", port=port)]
+    controllers[0].start()
+    pool = server.SmtpConnectionPool("127.0.0.1", port, size=1)
+
+    async def scenario():
+        await pool.send(make_message(), "a@example.com", ["b@example.com"])
+        # Restarting the server drops the pooled connection under us
+        controllers[0].stop()
+        controllers.append(Controller(handler, hostname="127.0.0.1", port=port))
+        controllers[1].start()
+        await pool.send(make_message(), "a@example.com", ["b@example.com"])
+        await pool.close()
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        controllers[-1].stop()
+    assert handler.messages == 2
+    assert pool.stats["connections_opened"] == 2
+    assert pool.stats["errors"] == 0
+
+
+def test_disconnect_after_data_is_not_resent():
+    handler = DroppingSinkHandler(reject=set())
+    controller = Controller(handler, hostname="127.0.0.1", port=free_port())
+    controller.start()
+    pool = server.SmtpConnectionPool("127.0.0.1", controller.port, size=1)
+
+    async def scenario():
+        connection = await pool._connect()
+        connection.messages = 1  # a pooled connection, eligible for the reconnect retry
+        pool._checkin(connection)
+        with pytest.raises((aiosmtplib.SMTPServerDisconnected, ConnectionError)):
+            await pool.send(make_message(), "a@example.com", ["b@example.com"])
+        await pool.close()
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        controller.stop()
+    assert handler.messages == 1
+    assert pool.stats["reconnects"] == 0
+
+
+def test_mime_message_streams_attachments(db, monkeypatch):
+    data = bytes(range(256)) * 2000
+
+    async def stream(ref):
+        for start in range(0, len(data), 1000):
+            yield data[start:start + 1000]
+
+    monkeypatch.setattr(server.attachment_store, "stream", stream)
+    email_log = server.EmailLog(
+        user_id="u1", from_email="a@example.com", recipients=[{"email": "b@example.com"}],
+        subject="hi", text_content="hi",
+        attachments=[{"filename": "report.pdf", "content_type": "application/pdf", "size": len(data), "sha256": "x"}],
+    )
+
+    message = asyncio.run(server.build_mime_message(email_log))
+    parsed = message_from_bytes(message.as_bytes(), policy=server.EmailMessage().policy)
+    attachment, = parsed.iter_attachments()
+    assert attachment.get_filename() == "report.pdf"
+    assert attachment.get_content() == data
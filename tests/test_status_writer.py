@@ -0,0 +1,57 @@
+import asyncio
+
+import server
+
+
+def test_failed_ack_is_retried_on_next_flush(db, monkeypatch):
+    acked = []
+    calls = {"n": 0}
+
+    async def flaky_ack_many(jobs):
+        calls["n"] += 1
+        if calls["n"] == 1:
+            raise ConnectionError("mongo is down")
+        acked.extend(jobs)
+
+    monkeypatch.setattr(server.email_queue, "ack_many", flaky_ack_many)
+
+    async def scenario():
+        writer = server.StatusWriter()
+        job = {"_id": "job-1", "lease_token": "t"}
+        writer.update("email-1", {"status": server.EmailStatus.SENT}, job=job)
+        await writer.flush()
+        assert writer._jobs == [job]
+        await writer.flush()
+        return writer, job
+
+    writer, job = asyncio.run(scenario())
+    assert acked == [job]
+    assert writer._jobs == []
+    assert writer.stats["errors"] == 1
+
+
+def test_processing_and_sent_merge_into_one_write(db):
+    async def scenario():
+        await db.email_logs.insert_one({"id": "email-1", "status": server.EmailStatus.QUEUED})
+        writer = server.StatusWriter()
+        writer.update("email-1", {"status": server.EmailStatus.PROCESSING},
+                      expected=[server.EmailStatus.QUEUED, server.EmailStatus.PROCESSING])
+        writer.update("email-1", {"status": server.EmailStatus.SENT}, expected=[server.EmailStatus.PROCESSING])
+        await writer.flush()
+        return writer, await db.email_logs.find_one({"id": "email-1"})
+
+    writer, email_doc = asyncio.run(scenario())
+    assert email_doc["status"] == server.EmailStatus.SENT
+    assert writer.stats["writes"] == 1
+    assert writer.stats["coalesced"] == 1
+
+
+def test_write_skips_email_that_moved_on(db):
+    async def scenario():
+        await db.email_logs.insert_one({"id": "email-1", "status": server.EmailStatus.SENT})
+        writer = server.StatusWriter()
+        writer.update("email-1", {"status": server.EmailStatus.FAILED}, expected=[server.EmailStatus.PROCESSING])
+        await writer.flush()
+        return await db.email_logs.find_one({"id": "email-1"})
+
+    assert asyncio.run(scenario())["status"] == server.EmailStatus.SENT
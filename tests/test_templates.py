@@ -0,0 +1,44 @@
+import pytest
+
+import server
+
+
+def test_literal_braces_survive_rendering():
+    compiled = server.CompiledTemplate("<style>p { color: red }</style> {0} {{ name }} {{{{ {}")
+    assert compiled.names == ["name"]
+    assert compiled.render({"name": "Ada"}) == "<style>p { color: red }</style> {0} Ada {{{{ {}"
+
+
+def test_values_are_inserted_verbatim():
+    compiled = server.CompiledTemplate("Hi {{name}}")
+    assert compiled.render({"name": "{0} {{other}} <b>"}) == "Hi {0} {{other}} <b>"
+
+
+def test_repeated_placeholders_share_one_field():
+    compiled = server.CompiledTemplate("{{first_name}}, {{ first_name }} from {{company}}")
+    assert compiled.names == ["first_name", "company"]
+    assert compiled.render({"first_name": "Ada", "company": "Acme"}) == "Ada, Ada from Acme"
+
+
+def test_missing_part_renders_none():
+    assert server.CompiledTemplate(None).render({}) is None
+
+
+def test_missing_variables_are_reported():
+    with pytest.raises(KeyError):
+        server.CompiledTemplate("Hi {{name}}").render({})
+
+    template = server.EmailTemplate(
+        user_id="u1", name="welcome", subject="Hi {{first_name}}",
+        html_content="<p>{{company}}</p>", variables=["first_name", "company", "plan"],
+    )
+    compiled = server.CompiledEmailTemplate(template)
+    with pytest.raises(server.TemplateRenderError, match="company, plan"):
+        compiled.render({"first_name": "Ada"})
+
+    results = compiled.render_many([
+        {"first_name": "Ada", "company": "Acme", "plan": "pro"},
+        {"first_name": "Bob"},
+    ])
+    assert results[0] == {"subject": "Hi Ada", "html_content": "<p>Acme</p>", "text_content": None}
+    assert isinstance(results[1], server.TemplateRenderError)
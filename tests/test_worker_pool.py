@@ -0,0 +1,41 @@
+import asyncio
+
+from pymongo.errors import ServerSelectionTimeoutError
+
+import server
+
+
+class DownDatabase:
+    """Stands in for Mongo during an outage: every collection access fails"""
+
+    def __getitem__(self, name):
+        raise ServerSelectionTimeoutError("mongo is down")
+
+    __getattr__ = __getitem__
+
+
+def test_workers_survive_mongo_outage(db, monkeypatch):
+    monkeypatch.setattr(server, "EMAIL_QUEUE_POLL_INTERVAL", 0.01)
+
+    async def failing_process_email(email_id, payload=None, job=None):
+        # Mongo goes away mid-send, so handing the job back fails too
+        monkeypatch.setattr(server, "db", DownDatabase())
+        raise ServerSelectionTimeoutError("mongo is down")
+
+    monkeypatch.setattr(server, "process_email", failing_process_email)
+
+    async def scenario():
+        await server.email_queue.enqueue("email-1")
+        pool = server.EmailWorkerPool(worker_count=2)
+        await pool.start()
+        await asyncio.sleep(0.3)
+        workers = list(pool._workers)
+        errors = sum(stats["errors"] for stats in pool.worker_stats.values())
+        await pool.stop(timeout=2)
+        return workers, errors
+
+    workers, errors = asyncio.run(scenario())
+    assert errors == 1
+    for worker in workers:
+        assert worker.done() and not worker.cancelled()
+        assert worker.exception() is None